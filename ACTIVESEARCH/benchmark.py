@@ -0,0 +1,788 @@
+# ========================================================================
+# ACTIVESEARCH Search Benchmark
+#
+# index:     Compares the original per-user linear scan (User.search) with
+#            the trigram index used by /search/ on a synthetic user list.
+# fragments: Compares flask.render_template_string with the precompiled
+#            fragment registry while several threads render concurrently.
+# highlight: Renders a 500-row result page with and without <mark>ed
+#            match spans from the index.
+# typing:    Replays typing sequences through the per-client QueryCache and
+#            reports its hit rate and latency against uncached searches.
+# scan:      Compares the per-object User.search loop with the index-free
+#            PackedScan (vectorized with NumPy, and the bytes.find loop).
+# memory:    Measures the RSS of N users stored as User objects and as a
+#            columnar UserTable, each in a fresh process.
+# backends:  Compares search + ranking latency of the in-memory store with
+#            the SQLite FTS5 store.
+# load:      Drives /search/ with generated users and queries through the
+#            Flask test client or a real WSGI server; prints JSON with
+#            throughput, p50/p95/p99 latency and peak RSS.
+# burst:     Fires every keystroke of several typists at a WSGI server
+#            without waiting for the previous response, with and without
+#            X-Search-Seq, and compares the CPU time spent and the
+#            requests that were completed or abandoned.
+# mixed:     Runs searches and add/update/delete writes against one store
+#            from several threads at different write shares; reports the
+#            throughput and latency of both, and what a full index rebuild
+#            per write would cost instead.
+# sort:      Pages through matches ordered by each column, walking the
+#            precomputed permutations against sorting the matches per
+#            request.
+# import:    Streams a generated CSV or JSONL file into the in-memory store
+#            (batched ingest) and into SQLite; reports rows/s and how soon
+#            the first users are searchable.
+# shards:    Search + ranking throughput of concurrent clients against the
+#            in-process store and against 1, 4, 16 and 32 worker shards.
+#
+# Usage: python benchmark.py index [--users 1000000] [--seed 42]
+#        python benchmark.py fragments [--threads 8] [--renders 2000]
+#        python benchmark.py highlight [--users 200000] [--rows 500]
+#        python benchmark.py typing [--users 200000] [--clients 50]
+#        python benchmark.py scan [--users 1000000]
+#        python benchmark.py memory [--users 1000000]
+#        python benchmark.py backends [--users 1000000]
+#        python benchmark.py load [--users 100000] [--server wsgi]
+#                                 [--output results.jsonl] [--warm 100]
+#        python benchmark.py burst [--users 200000] [--typists 8]
+#        python benchmark.py mixed [--users 200000] [--store sqlite]
+#        python benchmark.py sort [--users 1000000]
+#        python benchmark.py shards [--users 200000] [--shards 1 4 16 32]
+#        python benchmark.py import [--users 1000000] [--format jsonl]
+# Output: Per-query or per-render latency for both code paths; JSON for load
+# ========================================================================
+
+import argparse
+import http.client
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+import flask
+from werkzeug.serving import make_server
+
+import myapp
+from datagen import generate_queries, generate_table, generate_users
+from myapp import FRAGMENTS, User, app, render_fragment
+from searchindex import (FIELDS, PackedScan, QueryCache, TrigramIndex, fold,
+                         numpy)
+from userstore import (MemoryUserStore, ShardedUserStore, SQLiteUserStore,
+                       UserTable, read_user_file)
+
+# What users end up typing; "<" is a backspace
+TYPED = ["garcia", "maria.g<garcia", "jsmith", "elena.cruz", "tech.net",
+         "davis@corp", "helen.anderson", "lopez<<<<pez", "jo"]
+
+QUERIES = ["jo", "smith", "garcia", "mgarcia17", "tech.net", "elena.cruz",
+           "xyz123nonexistent"]
+
+
+def synthetic_users(count, seed):
+    """Build count generated User objects."""
+    return [User(*record) for record in generate_users(count, seed)]
+
+
+def best_of(func, repeat):
+    """Return the fastest of repeat runs of func, in milliseconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return min(timings)
+
+
+def bench_index(args):
+    """Time the linear scan against the trigram index."""
+    print("Generating {} users...".format(args.users))
+    users = synthetic_users(args.users, args.seed)
+
+    start = time.perf_counter()
+    index = TrigramIndex(u.fname + u.lname + u.email for u in users)
+    print("Index built in {:.2f}s ({} trigrams)".format(
+        time.perf_counter() - start, len(index.postings)))
+
+    print("{:<20} {:>8} {:>14} {:>14}".format(
+        "query", "matches", "linear (ms)", "index (ms)"))
+    for query in QUERIES:
+        linear = best_of(lambda: [u for u in users if u.search(query)], 1)
+        indexed = best_of(lambda: index.search(query), 5)
+        print("{:<20} {:>8} {:>14.3f} {:>14.3f}".format(
+            query, len(index.search(query)), linear, indexed))
+
+
+def bench_scan(args):
+    """Time the per-object loop against the packed brute-force scan."""
+    users = synthetic_users(args.users, args.seed)
+
+    start = time.perf_counter()
+    scan = PackedScan(u.fname + u.lname + u.email for u in users)
+    print("Packed {} users in {:.2f}s ({:.1f} MB)".format(
+        args.users, time.perf_counter() - start, len(scan.buffer) / 2**20))
+    if numpy is None:
+        print("NumPy is not installed; only the find loop is timed")
+
+    print("{:<20} {:>8} {:>12} {:>12} {:>12}".format(
+        "query", "matches", "loop (ms)", "numpy (ms)", "find (ms)"))
+    for query in QUERIES:
+        needle = fold(query).encode('utf-8')
+        loop = best_of(lambda: [u for u in users if u.search(query)], 1)
+        vectorized = (best_of(lambda: scan._search_numpy(needle), 3)
+                      if numpy is not None else float('nan'))
+        find = best_of(lambda: scan._search_find(needle), 3)
+        print("{:<20} {:>8} {:>12.3f} {:>12.3f} {:>12.3f}".format(
+            query, len(scan.search(query)), loop, vectorized, find))
+
+
+def peak_rss_mb():
+    """Return this process's peak resident set size in MB (Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_memory(args):
+    """Measure each user layout in its own process, so peaks don't mix."""
+    if args.layout:
+        baseline = peak_rss_mb()
+        build = synthetic_users if args.layout == "objects" else \
+            generate_table
+        users = build(args.users, args.seed)
+        print("{:<8} {:>10} users {:>10.1f} MB".format(
+            args.layout, len(users), peak_rss_mb() - baseline))
+        return
+
+    for layout in ("objects", "table"):
+        subprocess.run([sys.executable, __file__, "memory", "--layout",
+                        layout, "--users", str(args.users),
+                        "--seed", str(args.seed)], check=True)
+
+
+def render_concurrently(render, threads, renders):
+    """Run render() renders times across threads; return ms per render."""
+    def worker(count):
+        with app.app_context():
+            for _ in range(count):
+                render()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(worker, [renders // threads] * threads))
+    elapsed = time.perf_counter() - start
+    return elapsed * 1000 / renders
+
+
+def bench_fragments(args):
+    """Time per-request template compilation against the registry."""
+    rows = synthetic_users(args.rows, args.seed)
+    source = FRAGMENTS['user_rows']
+
+    current = render_concurrently(
+        lambda: flask.render_template_string(source, users=rows),
+        args.threads, args.renders)
+    registry = render_concurrently(
+        lambda: render_fragment('user_rows', users=rows),
+        args.threads, args.renders)
+
+    print("{} threads, {} renders of {} rows".format(
+        args.threads, args.renders, args.rows))
+    print("render_template_string: {:.3f} ms/render".format(current))
+    print("precompiled fragment:   {:.3f} ms/render".format(registry))
+    print("speedup:                {:.1f}x".format(current / registry))
+
+
+def bench_highlight(args):
+    """Time rendering a result page with and without match highlighting."""
+    store = MemoryUserStore(generate_table(args.users, args.seed))
+    query = args.query
+    rows = [row for _, row in store.rank(query, store.search(query),
+                                         args.rows)]
+
+    def plain():
+        users = [store.get(row) for row in rows]
+        return render_fragment('user_rows', users=users)
+
+    def marked():
+        users = [myapp.highlighted(store.get(row), spans)
+                 for row, spans in zip(rows, store.spans(query, rows))]
+        return render_fragment('user_rows', users=users)
+
+    with app.app_context():
+        base = best_of(plain, args.repeat)
+        highlighted = best_of(marked, args.repeat)
+    print("{} rows matching {!r} out of {} users".format(
+        len(rows), query, args.users))
+    print("plain:       {:.3f} ms/render".format(base))
+    print("highlighted: {:.3f} ms/render".format(highlighted))
+    print("overhead:    {:.1f}%".format((highlighted / base - 1) * 100))
+
+
+def keystrokes(typed):
+    """Return the search box contents after each keystroke of typed."""
+    text = ""
+    for key in typed:
+        text = text[:-1] if key == "<" else text + key
+        if text:
+            yield text
+
+
+def bench_typing(args):
+    """Replay typing sequences with and without the per-client cache."""
+    users = synthetic_users(args.users, args.seed)
+    index = TrigramIndex(u.fname + u.lname + u.email for u in users)
+    cache = QueryCache(index)
+    rng = random.Random(args.seed)
+    sessions = [(client, list(keystrokes(rng.choice(TYPED))))
+                for client in range(args.clients)]
+
+    uncached = cached = 0.0
+    searches = 0
+    for client, terms in sessions:
+        for term in terms:
+            start = time.perf_counter()
+            expected = index.search(term)
+            uncached += time.perf_counter() - start
+
+            start = time.perf_counter()
+            rows = cache.search(client, term)
+            cached += time.perf_counter() - start
+
+            assert rows == expected, term
+            searches += 1
+
+    print("{} clients, {} searches over {} users".format(
+        args.clients, searches, args.users))
+    print("cache hit rate:    {:.1%}".format(cache.hit_rate()))
+    print("uncached: {:.3f} ms/search".format(uncached * 1000 / searches))
+    print("cached:   {:.3f} ms/search".format(cached * 1000 / searches))
+
+
+def bench_backends(args):
+    """Time search + ranking of the top 50 rows in both user stores."""
+    users = synthetic_users(args.users, args.seed)
+
+    start = time.perf_counter()
+    memory = MemoryUserStore(UserTable.from_users(users))
+    print("Memory store built in {:.2f}s".format(time.perf_counter() - start))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        start = time.perf_counter()
+        sqlite = SQLiteUserStore(os.path.join(tmpdir, "users.db"))
+        sqlite.ingest((u.fname, u.lname, u.email) for u in users)
+        print("SQLite store built in {:.2f}s".format(
+            time.perf_counter() - start))
+
+        print("{:<20} {:>8} {:>14} {:>14}".format(
+            "query", "matches", "memory (ms)", "sqlite (ms)"))
+        for query in QUERIES:
+            timings = []
+            for store in (memory, sqlite):
+                timings.append(best_of(
+                    lambda: store.rank(query, store.search(query), 50), 3))
+            print("{:<20} {:>8} {:>14.3f} {:>14.3f}".format(
+                query, len(memory.search(query)), *timings))
+        sqlite.connect().close()
+
+
+def mixed_workload(store, queries, records, write_share, seconds, seed):
+    """
+    Run one thread's share of a mixed workload for seconds; return the
+    (kind, seconds) of every operation. Writes cycle through add, update
+    and delete of users this thread added itself.
+    """
+    rng = random.Random(seed)
+    own = []
+    timings = []
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        if rng.random() < write_share:
+            if len(own) < 10 or rng.random() < 0.4:
+                own.append(store.add(*next(records)).id)
+            elif rng.random() < 0.5:
+                store.update(rng.choice(own), *next(records))
+            else:
+                store.delete(own.pop(rng.randrange(len(own))))
+            kind = 'write'
+        else:
+            snapshot = store.snapshot()
+            query = rng.choice(queries)
+            snapshot.rank(query, snapshot.search(query), 50)
+            kind = 'read'
+        timings.append((kind, time.perf_counter() - start))
+    return timings
+
+
+def bench_mixed(args):
+    """Throughput of concurrent searches and writes on one user store."""
+    start = time.perf_counter()
+    if args.store == 'sqlite':
+        tmpdir = tempfile.TemporaryDirectory()
+        store = SQLiteUserStore(os.path.join(tmpdir.name, "users.db"))
+        store.ingest(generate_users(args.users, args.seed))
+    else:
+        store = MemoryUserStore(generate_table(args.users, args.seed))
+    rebuild = time.perf_counter() - start
+    print("{} users in the {} store, built in {:.2f}s; {} threads, {}s "
+          "per run".format(args.users, args.store, rebuild, args.threads,
+                           args.seconds))
+    print("{:>7} {:>9} {:>10} {:>10} {:>10} {:>10} {:>11}".format(
+        "writes", "reads/s", "read p50", "read p99", "writes/s",
+        "write p99", "compactions"))
+
+    queries = generate_queries(1000, args.seed)
+    for share in args.write_shares:
+        # Every thread writes users of its own, drawn from a fresh seed
+        records = [generate_users(10 ** 9, args.seed + i + 1)
+                   for i in range(args.threads)]
+        compactions = getattr(store, 'compactions', 0)
+        with ThreadPoolExecutor(args.threads) as pool:
+            runs = pool.map(
+                lambda i: mixed_workload(store, queries, records[i], share,
+                                         args.seconds, args.seed + i),
+                range(args.threads))
+            timings = [timing for run in runs for timing in run]
+        reads = sorted(t for kind, t in timings if kind == 'read')
+        writes = sorted(t for kind, t in timings if kind == 'write')
+        print("{:>6.0%} {:>9.0f} {:>8.3f}ms {:>8.3f}ms {:>10.0f} {:>8.3f}ms "
+              "{:>11}".format(
+                  share, len(reads) / args.seconds,
+                  percentile(reads, 0.50) * 1000 if reads else 0,
+                  percentile(reads, 0.99) * 1000 if reads else 0,
+                  len(writes) / args.seconds,
+                  percentile(writes, 0.99) * 1000 if writes else 0,
+                  getattr(store, 'compactions', 0) - compactions))
+    print("A full rebuild per write would cap writes at {:.2f}/s".format(
+        1 / rebuild))
+    if args.store == 'sqlite':
+        store.connect().close()
+        tmpdir.cleanup()
+
+
+def bench_sort(args):
+    """Time a sorted page of 50 rows: permutation walk vs. sorting."""
+    table = generate_table(args.users, args.seed)
+    start = time.perf_counter()
+    store = MemoryUserStore(table)
+    print("Memory store and sort permutations built in {:.2f}s".format(
+        time.perf_counter() - start))
+    snapshot = store.snapshot()
+
+    print("{:<10} {:<7} {:>8} {:>11} {:>11} {:>10}".format(
+        "query", "column", "matches", "walk (ms)", "sort (ms)", "deep (ms)"))
+    for query in args.queries:
+        rows = snapshot.search(query) if query else None
+        for column in ('id',) + FIELDS:
+            key = snapshot.orders[column].key
+            walk = best_of(lambda: snapshot.sorted_page(
+                query, rows, column, 0, 50), args.repeat)
+            everything = range(len(snapshot)) if rows is None else rows
+            per_request = best_of(
+                lambda: sorted(everything, key=key)[:50], args.repeat)
+            # The last page walks (nearly) the whole permutation
+            deep = best_of(lambda: snapshot.sorted_page(
+                query, rows, column, max(len(everything) - 50, 0), 50),
+                1)
+            print("{:<10} {:<7} {:>8} {:>11.3f} {:>11.3f} {:>10.3f}".format(
+                repr(query), column, len(everything), walk, per_request,
+                deep))
+
+
+def search_throughput(store, queries, threads, seconds):
+    """
+    Search and rank the top 50 from threads clients for seconds; return
+    the searches per second and the latency of each. Like the app, remote
+    stores are only asked for the count and the ranked page.
+    """
+    def client(seed):
+        rng = random.Random(seed)
+        timings = []
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            query = rng.choice(queries)
+            start = time.perf_counter()
+            if store.remote:
+                store.count(query)
+                store.rank(query, None, 50)
+            else:
+                store.rank(query, store.search(query), 50)
+            timings.append(time.perf_counter() - start)
+        return timings
+
+    with ThreadPoolExecutor(threads) as pool:
+        timings = sorted(t for run in pool.map(client, range(threads))
+                         for t in run)
+    return len(timings) / seconds, timings
+
+
+def bench_shards(args):
+    """Throughput of one in-process store against sharded stores."""
+    table = generate_table(args.users, args.seed)
+    queries = generate_queries(1000, args.seed)
+    print("{} users, {} client threads, {} CPUs".format(
+        args.users, args.threads, os.cpu_count()))
+    print("{:<10} {:>9} {:>10} {:>10} {:>10}".format(
+        "store", "build (s)", "queries/s", "p50", "p99"))
+    for shards in [0] + args.shards:
+        start = time.perf_counter()
+        if shards:
+            store = ShardedUserStore(table, shards)
+        else:
+            store = MemoryUserStore(table)
+        build = time.perf_counter() - start
+        rate, timings = search_throughput(store, queries, args.threads,
+                                          args.seconds)
+        print("{:<10} {:>9.2f} {:>10.0f} {:>8.2f}ms {:>8.2f}ms".format(
+            "{} shards".format(shards) if shards else "in-process", build,
+            rate, percentile(timings, 0.50) * 1000,
+            percentile(timings, 0.99) * 1000))
+        if shards:
+            store.close()
+
+
+def write_user_file(path, users, seed):
+    """Write users generated users to path as CSV or JSONL."""
+    with open(path, 'w', newline='', encoding='utf-8') as out:
+        if path.endswith('.jsonl'):
+            for fname, lname, email in generate_users(users, seed):
+                out.write(json.dumps({'fname': fname, 'lname': lname,
+                                      'email': email}) + '\n')
+        else:
+            out.write('fname,lname,email\n')
+            for record in generate_users(users, seed):
+                out.write(','.join(record) + '\n')
+
+
+def bench_import(args):
+    """Rows per second of streaming a user file into each store."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'users.' + args.format)
+        write_user_file(path, args.users, args.seed)
+        print("{} users, {:.1f} MB of {}".format(
+            args.users, os.path.getsize(path) / 1e6, args.format))
+        print("{:<20} {:>10} {:>12} {:>14}".format(
+            "target", "time (s)", "rows/s", "first batch"))
+
+        def run(label, ingest):
+            first = []
+            start = time.perf_counter()
+
+            def progress(count):
+                if not first:
+                    first.append(time.perf_counter() - start)
+
+            with open(path, newline='', encoding='utf-8') as userfile:
+                count = ingest(read_user_file(userfile), progress)
+            elapsed = time.perf_counter() - start
+            print("{:<20} {:>10.2f} {:>12.0f} {:>12.3f}s".format(
+                label, elapsed, count / elapsed, first[0] if first else 0))
+
+        run("parse only", lambda records, progress: sum(
+            1 for _ in records))
+        store = MemoryUserStore(UserTable())
+        run("memory store", lambda records, progress: store.ingest(
+            records, batch=args.batch, progress=progress))
+        sqlite = SQLiteUserStore(os.path.join(tmpdir, 'users.db'))
+        run("sqlite store", lambda records, progress: sqlite.ingest(
+            records, batch=args.batch, progress=progress))
+        sqlite.connect().close()
+
+
+def post_test_client(queries):
+    """POST each query through one Flask test client; return timings."""
+    client = app.test_client()
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        client.post('/search/', data={'search': query}).get_data()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def post_http(port, queries):
+    """POST each query over HTTP, keeping the session cookie; timings."""
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        conn.request('POST', '/search/', urlencode({'search': query}),
+                     headers)
+        response = conn.getresponse()
+        response.read()
+        timings.append(time.perf_counter() - start)
+        cookie = response.getheader('Set-Cookie')
+        if cookie:
+            headers['Cookie'] = cookie.split(';', 1)[0]
+        if response.will_close:
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.close()
+    return timings
+
+
+def percentile(values, fraction):
+    """Return the value at fraction (0..1) of the sorted values."""
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def bench_load(args):
+    """Drive /search/ with generated users and queries; print JSON."""
+    start = time.perf_counter()
+    app.config['SYNTHETIC_USERS'] = args.users
+    app.config['SYNTHETIC_SEED'] = args.seed
+    myapp.set_user_store(myapp.build_user_store())
+    build_seconds = time.perf_counter() - start
+
+    queries = generate_queries(args.requests, args.seed)
+    chunks = [queries[i::args.concurrency] for i in range(args.concurrency)]
+
+    if args.warm:
+        # As if the same traffic had been running for a while: the log
+        # knows the frequent queries and the warmer has computed them
+        for query in queries:
+            myapp.query_log.record(query.strip(), 0)
+        myapp.hot_queries.top = args.warm
+        myapp.hot_queries.refresh(myapp.user_store)
+
+    server = None
+    if args.server == 'wsgi':
+        # One access log line per request would dominate the output
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        def worker(chunk):
+            return post_http(server.server_port, chunk)
+    else:
+        worker = post_test_client
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        timings = [t for chunk in pool.map(worker, chunks) for t in chunk]
+    elapsed = time.perf_counter() - start
+    if server is not None:
+        server.shutdown()
+
+    timings.sort()
+    result = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'server': args.server,
+        'users': args.users,
+        'seed': args.seed,
+        'requests': len(timings),
+        'concurrency': args.concurrency,
+        'warm': args.warm,
+        'warm_hits': myapp.hot_queries.hits,
+        'build_seconds': round(build_seconds, 3),
+        'throughput_rps': round(len(timings) / elapsed, 1),
+        'latency_ms': {
+            name: round(percentile(timings, fraction) * 1000, 3)
+            for name, fraction in (('p50', 0.50), ('p95', 0.95),
+                                   ('p99', 0.99))},
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+    line = json.dumps(result)
+    print(line)
+    if args.output:
+        with open(args.output, 'a') as out:
+            out.write(line + '\n')
+
+
+def session_cookie(port):
+    """Start a search session on the server; return its cookie header."""
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    conn.request('POST', '/search/', urlencode({'search': 'a'}),
+                 {'Content-Type': 'application/x-www-form-urlencoded'})
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return response.getheader('Set-Cookie').split(';', 1)[0]
+
+
+def post_burst(port, typed, gap, numbered):
+    """
+    Send one request per keystroke of typed, gap seconds apart, each on its
+    own connection and without waiting for earlier responses. Returns the
+    status code of every request.
+    """
+    headers = {'Content-Type': 'application/x-www-form-urlencoded',
+               'Cookie': session_cookie(port)}
+    statuses = []
+
+    def send(seq, term):
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        request_headers = dict(headers)
+        if numbered:
+            request_headers['X-Search-Seq'] = str(seq)
+        conn.request('POST', '/search/', urlencode({'search': term}),
+                     request_headers)
+        response = conn.getresponse()
+        response.read()
+        conn.close()
+        statuses.append(response.status)
+
+    threads = []
+    for seq, term in enumerate(keystrokes(typed), 1):
+        thread = threading.Thread(target=send, args=(seq, term))
+        thread.start()
+        threads.append(thread)
+        time.sleep(gap)
+    for thread in threads:
+        thread.join()
+    return statuses
+
+
+def bench_burst(args):
+    """Compare bursts of keystrokes with and without X-Search-Seq."""
+    app.config['SYNTHETIC_USERS'] = args.users
+    app.config['SYNTHETIC_SEED'] = args.seed
+    myapp.set_user_store(myapp.build_user_store())
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_port
+
+    rng = random.Random(args.seed)
+    typed = [rng.choice(TYPED) for _ in range(args.typists)]
+    print("{} users, {} typists, {} keystrokes per run, {:.0f} ms apart"
+          .format(args.users, args.typists,
+                  sum(len(list(keystrokes(t))) for t in typed),
+                  args.gap * 1000))
+
+    for numbered in (False, True):
+        # Start both runs from an empty query cache
+        myapp.set_user_store(myapp.user_store)
+        myapp.sequencer = myapp.RequestSequencer()
+        cpu, wall = time.process_time(), time.perf_counter()
+        with ThreadPoolExecutor(args.typists) as pool:
+            runs = pool.map(lambda t: post_burst(port, t, args.gap, numbered),
+                            typed)
+            statuses = [status for run in runs for status in run]
+        cpu = time.process_time() - cpu
+        wall = time.perf_counter() - wall
+        label = "X-Search-Seq" if numbered else "every request"
+        print("{:14s} cpu {:7.3f} s  wall {:7.3f} s  completed {:4d}  "
+              "abandoned {:4d}".format(label, cpu, wall, statuses.count(200),
+                                       statuses.count(204)))
+    server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark ACTIVESEARCH search paths")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    index = commands.add_parser("index", help="linear scan vs. index")
+    index.add_argument("--users", type=int, default=1000000)
+    index.add_argument("--seed", type=int, default=42)
+    index.set_defaults(func=bench_index)
+
+    fragments = commands.add_parser("fragments",
+                                    help="template compile vs. registry")
+    fragments.add_argument("--threads", type=int, default=8)
+    fragments.add_argument("--renders", type=int, default=2000)
+    fragments.add_argument("--rows", type=int, default=24)
+    fragments.add_argument("--seed", type=int, default=42)
+    fragments.set_defaults(func=bench_fragments)
+
+    highlight = commands.add_parser("highlight", help="match highlighting")
+    highlight.add_argument("--users", type=int, default=200000)
+    highlight.add_argument("--rows", type=int, default=500)
+    highlight.add_argument("--query", default="mar")
+    highlight.add_argument("--repeat", type=int, default=20)
+    highlight.add_argument("--seed", type=int, default=42)
+    highlight.set_defaults(func=bench_highlight)
+
+    typing = commands.add_parser("typing", help="incremental query cache")
+    typing.add_argument("--users", type=int, default=200000)
+    typing.add_argument("--clients", type=int, default=50)
+    typing.add_argument("--seed", type=int, default=42)
+    typing.set_defaults(func=bench_typing)
+
+    scan = commands.add_parser("scan", help="object loop vs. packed scan")
+    scan.add_argument("--users", type=int, default=1000000)
+    scan.add_argument("--seed", type=int, default=42)
+    scan.set_defaults(func=bench_scan)
+
+    memory = commands.add_parser("memory", help="User objects vs. table")
+    memory.add_argument("--users", type=int, default=1000000)
+    memory.add_argument("--seed", type=int, default=42)
+    memory.add_argument("--layout", choices=["objects", "table"],
+                        help="measure one layout in this process")
+    memory.set_defaults(func=bench_memory)
+
+    backends = commands.add_parser("backends", help="memory vs. SQLite")
+    backends.add_argument("--users", type=int, default=1000000)
+    backends.add_argument("--seed", type=int, default=42)
+    backends.set_defaults(func=bench_backends)
+
+    load = commands.add_parser("load", help="end-to-end /search/ load")
+    load.add_argument("--users", type=int, default=100000)
+    load.add_argument("--requests", type=int, default=2000)
+    load.add_argument("--concurrency", type=int, default=4)
+    load.add_argument("--server", choices=["testclient", "wsgi"],
+                      default="testclient")
+    load.add_argument("--seed", type=int, default=42)
+    load.add_argument("--output", help="append the JSON result to this file")
+    load.add_argument("--warm", type=int, default=0,
+                      help="precompute the N most frequent queries")
+    load.set_defaults(func=bench_load)
+
+    burst = commands.add_parser("burst", help="superseded query coalescing")
+    burst.add_argument("--users", type=int, default=200000)
+    burst.add_argument("--typists", type=int, default=8)
+    burst.add_argument("--gap", type=float, default=0.005,
+                       help="seconds between keystrokes")
+    burst.add_argument("--seed", type=int, default=42)
+    burst.set_defaults(func=bench_burst)
+
+    mixed = commands.add_parser("mixed", help="concurrent reads and writes")
+    mixed.add_argument("--users", type=int, default=200000)
+    mixed.add_argument("--store", choices=["memory", "sqlite"],
+                       default="memory")
+    mixed.add_argument("--threads", type=int, default=4)
+    mixed.add_argument("--seconds", type=float, default=5)
+    mixed.add_argument("--write-shares", type=float, nargs="+",
+                       default=[0, 0.01, 0.1, 0.5])
+    mixed.add_argument("--seed", type=int, default=42)
+    mixed.set_defaults(func=bench_mixed)
+
+    sort = commands.add_parser("sort", help="sorted result pages")
+    sort.add_argument("--users", type=int, default=1000000)
+    sort.add_argument("--queries", nargs="+",
+                      default=["", "a", "mar", "smith"])
+    sort.add_argument("--repeat", type=int, default=3)
+    sort.add_argument("--seed", type=int, default=42)
+    sort.set_defaults(func=bench_sort)
+
+    importer = commands.add_parser("import", help="streaming user import")
+    importer.add_argument("--users", type=int, default=1000000)
+    importer.add_argument("--format", choices=["csv", "jsonl"],
+                          default="csv")
+    importer.add_argument("--batch", type=int, default=10000)
+    importer.add_argument("--seed", type=int, default=42)
+    importer.set_defaults(func=bench_import)
+
+    shards = commands.add_parser("shards", help="multi-process shards")
+    shards.add_argument("--users", type=int, default=200000)
+    shards.add_argument("--shards", type=int, nargs="+",
+                        default=[1, 4, 16, 32])
+    shards.add_argument("--threads", type=int, default=32)
+    shards.add_argument("--seconds", type=float, default=5)
+    shards.add_argument("--seed", type=int, default=42)
+    shards.set_defaults(func=bench_shards)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
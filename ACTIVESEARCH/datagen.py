@@ -0,0 +1,110 @@
+"""
+Synthetic user data for ACTIVESEARCH performance work.
+
+The 24 sample users in myapp.py are too few to tell a fast search from a
+slow one. generate_users() produces any number of realistic-looking users;
+the same seed always produces the same users, so benchmark runs can be
+compared with each other. generate_queries() draws search terms the way
+people type them: mostly short prefixes of real names.
+"""
+
+import random
+
+from userstore import UserTable
+
+FIRST_NAMES = [
+    "James", "Mary", "John", "Patricia", "Robert", "Jennifer", "Michael",
+    "Linda", "William", "Elizabeth", "David", "Barbara", "Richard", "Susan",
+    "Joseph", "Jessica", "Thomas", "Sarah", "Charles", "Karen", "Daniel",
+    "Nancy", "Matthew", "Lisa", "Anthony", "Betty", "Mark", "Margaret",
+    "Donald", "Sandra", "Steven", "Ashley", "Paul", "Kimberly", "Andrew",
+    "Emily", "Joshua", "Donna", "Kenneth", "Michelle", "Kevin", "Carol",
+    "Brian", "Amanda", "George", "Melissa", "Edward", "Deborah", "Ronald",
+    "Stephanie", "Maria", "Jose", "Carlos", "Sofia", "Diana", "Helen",
+    "Julia", "Ana", "Elena", "Isabella", "Gabriela", "Carmen", "Luis",
+    "Miguel", "Juan", "Wei", "Yuki", "Hiroshi", "Priya", "Arjun", "Fatima",
+    "Omar", "Aisha", "Ivan", "Olga", "Sven", "Ingrid", "Pierre", "Amélie",
+    "José", "Zoë", "Björn", "Renée", "Chloé", "Søren", "Łukasz",
+]
+
+LAST_NAMES = [
+    "Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller",
+    "Davis", "Rodriguez", "Martinez", "Hernandez", "Lopez", "Gonzalez",
+    "Wilson", "Anderson", "Thomas", "Taylor", "Moore", "Jackson", "Martin",
+    "Lee", "Perez", "Thompson", "White", "Harris", "Sanchez", "Clark",
+    "Ramirez", "Lewis", "Robinson", "Walker", "Young", "Allen", "King",
+    "Wright", "Scott", "Torres", "Nguyen", "Hill", "Flores", "Green",
+    "Adams", "Nelson", "Baker", "Hall", "Rivera", "Campbell", "Mitchell",
+    "Carter", "Roberts", "Cruz", "Kim", "Chen", "Wang", "Patel", "Singh",
+    "Tanaka", "Sato", "Müller", "Schmidt", "Novak", "Ivanova", "Larsen",
+    "Dubois", "Rossi", "Silva", "Santos", "Peña", "Núñez", "Ørsted",
+]
+
+DOMAINS = [
+    "gmail.com", "yahoo.com", "outlook.com", "company.com", "email.org",
+    "tech.net", "corp.net", "business.com", "work.org", "enterprise.com",
+    "startup.net", "agency.org", "consulting.com", "studio.net",
+    "partners.org", "university.edu", "example.co.uk", "mail.de",
+]
+
+# Ways people turn their name into an email address
+EMAIL_FORMATS = [
+    "{first}.{last}", "{f}{last}", "{first}{last}{n}", "{last}.{first}",
+    "{first}_{last}{n}", "{f}.{last}{n}", "{first}{n}",
+]
+
+# How long typed queries are, as (length, weight); 8 means "8 or more"
+QUERY_LENGTHS = [(1, 5), (2, 10), (3, 20), (4, 20), (5, 15), (6, 12),
+                 (7, 8), (8, 10)]
+
+
+def email_local(text):
+    """Drop characters that rarely appear in the local part of an email."""
+    return ''.join(c for c in text.lower() if c.isascii() and c.isalnum())
+
+
+def generate_users(count, seed=42):
+    """Yield count reproducible (fname, lname, email) records."""
+    rng = random.Random(seed)
+    for _ in range(count):
+        fname = rng.choice(FIRST_NAMES)
+        lname = rng.choice(LAST_NAMES)
+        first = email_local(fname)
+        last = email_local(lname)
+        local = rng.choice(EMAIL_FORMATS).format(
+            first=first, last=last, f=first[:1], n=rng.randrange(1, 1000))
+        yield fname, lname, "{}@{}".format(local, rng.choice(DOMAINS))
+
+
+def generate_table(count, seed=42):
+    """Return a UserTable holding count generated users."""
+    table = UserTable()
+    for record in generate_users(count, seed):
+        table.append(*record)
+    return table
+
+
+def generate_queries(count, seed=42, miss_rate=0.05):
+    """
+    Return count search terms with a realistic mix of lengths.
+
+    Terms are prefixes of a generated name or email, most of them three to
+    five characters long. A small share (miss_rate) are random letters that
+    usually match nobody.
+    """
+    rng = random.Random(seed)
+    lengths = [length for length, _ in QUERY_LENGTHS]
+    weights = [weight for _, weight in QUERY_LENGTHS]
+    sample = list(generate_users(1000, seed + 1))
+    queries = []
+    for _ in range(count):
+        length = rng.choices(lengths, weights)[0]
+        if length == lengths[-1]:
+            length += rng.randrange(0, 8)
+        if rng.random() < miss_rate:
+            queries.append(''.join(rng.choice('qxzjkvw')
+                                   for _ in range(max(length, 3))))
+            continue
+        text = rng.choice(rng.choice(sample))
+        queries.append(text[:length].lower())
+    return queries
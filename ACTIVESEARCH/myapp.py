@@ -1,25 +1,45 @@
-import flask
-
-app = flask.Flask(__name__, static_url_path='/static')
-
+import functools
+import hashlib
+import os
+import threading
+import time
+import uuid
 
-class User:
-    """Simple user class for demonstration purposes."""
-    id = 0
+import click
+import flask
+from markupsafe import Markup, escape
 
-    def __init__(self, fname, lname, email):
-        User.id += 1
-        self.id = User.id
-        self.fname = fname
-        self.lname = lname
-        self.email = email
+from datagen import generate_table
+from searchindex import (FUZZY_SCORE, HotQueries, QueryCache, QueryLog,
+                         RequestSequencer, Superseded, parse_query)
+from userstore import (SORT_COLUMNS, MemoryUserStore, ShardedUserStore,
+                       SQLiteUserStore, User, UserRow, UserTable,
+                       read_user_file)
 
-    def search(self, word):
-        """Archives user data for the given word across name and email."""
-        if word is None:
-            return False
-        all_data = self.fname + self.lname + self.email
-        return word.lower() in all_data.lower()
+app = flask.Flask(__name__, static_url_path='/static')
+# Signs the session cookie that identifies each search client.
+# Replace with a strong secret key in production.
+app.config['SECRET_KEY'] = 'your_secret_key'
+# Most rows returned per response; further rows load through "More results"
+app.config['SEARCH_LIMIT'] = 50
+# Below this many exact matches, users with similar names are added
+app.config['FUZZY_THRESHOLD'] = 3
+# SQLite database to search instead of the in-memory sample users
+app.config['USER_DB'] = os.environ.get('ACTIVESEARCH_DB')
+# Number of generated users to search instead of the sample users (0: off)
+app.config['SYNTHETIC_USERS'] = int(os.environ.get('ACTIVESEARCH_USERS', 0))
+app.config['SYNTHETIC_SEED'] = int(os.environ.get('ACTIVESEARCH_SEED', 42))
+# CSV or JSONL file of users streamed into the in-memory store at startup,
+# in a background thread; searches see the users imported so far
+app.config['IMPORT_FILE'] = os.environ.get('ACTIVESEARCH_IMPORT')
+# Distinct queries kept in the query log behind /search/stats
+app.config['QUERY_LOG_SIZE'] = 1000
+# Most frequent queries whose first page is precomputed (0: no warmer),
+# and how many seconds apart the warmer checks for new ones
+app.config['WARM_QUERIES'] = int(os.environ.get('ACTIVESEARCH_WARM', 0))
+app.config['WARM_INTERVAL'] = 1.0
+# Worker processes to split the in-memory users across (0: search in-process)
+app.config['SEARCH_SHARDS'] = int(os.environ.get('ACTIVESEARCH_SHARDS', 0))
 
 
 # Sample user data for demonstration - 24iverse users
@@ -58,44 +78,538 @@ users = [
 ]
 
 
+def build_user_store():
+    """
+    Create the user store selected by the app config.
+
+    The in-memory store builds its trigram index once; every /search/
+    request reuses it. With USER_DB set, users are searched in SQLite, and
+    with SYNTHETIC_USERS set, generated users replace the sample users.
+    SEARCH_SHARDS splits the in-memory users across that many (read-only)
+    worker processes. With IMPORT_FILE set, the store starts empty and
+    the file is imported in the background.
+    """
+    if app.config['USER_DB']:
+        return SQLiteUserStore(app.config['USER_DB'])
+    if app.config['IMPORT_FILE']:
+        store = MemoryUserStore(UserTable())
+        start_import(store, app.config['IMPORT_FILE'])
+        return store
+    if app.config['SYNTHETIC_USERS']:
+        table = generate_table(app.config['SYNTHETIC_USERS'],
+                               app.config['SYNTHETIC_SEED'])
+    else:
+        table = UserTable.from_users(users)
+    if app.config['SEARCH_SHARDS']:
+        return ShardedUserStore(table, app.config['SEARCH_SHARDS'])
+    return MemoryUserStore(table)
+
+
+def start_import(store, path):
+    """Stream the users in path into store from a daemon thread."""
+    def run():
+        start = time.perf_counter()
+
+        def progress(count):
+            app.logger.info('Imported %d users (%.0f/s)', count,
+                            count / (time.perf_counter() - start))
+
+        with open(path, newline='', encoding='utf-8') as userfile:
+            count = store.ingest(read_user_file(userfile), progress=progress)
+        app.logger.info('Import of %s finished: %d users', path, count)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def set_user_store(store):
+    """Search store from now on, with a fresh per-client query cache."""
+    global user_store, query_cache, store_tag
+    user_store = store
+    # Part of every ETag, since another store may be at the same version.
+    # A store shared by several workers (SQLite) gives each the same tag.
+    store_tag = store.tag() or uuid.uuid4().hex
+    # Each client's last query, so a term that extends it only rechecks the
+    # users that matched before
+    query_cache = QueryCache(store, maxsize=1024)
+
+
+set_user_store(build_user_store())
+
+# How often each query runs and how long it takes (see /search/stats)
+query_log = QueryLog(maxsize=app.config['QUERY_LOG_SIZE'])
+
+# First pages of the most frequent queries, kept up to date in the
+# background; results are only used for the store version they were made
+# for (see result_page())
+hot_queries = HotQueries(query_log,
+                         lambda store, query: result_page(store, query),
+                         top=app.config['WARM_QUERIES'])
+if app.config['WARM_QUERIES']:
+    hot_queries.start(lambda: user_store, app.config['WARM_INTERVAL'])
+
+# Newest request number of each client; older searches stop early
+sequencer = RequestSequencer()
+
+# Result rows, headers and sort state of /search/, compiled at startup
+FRAGMENTS = {
+    'user_rows': """
+            {% if similar %}
+            <tr>
+                <td colspan="4" class="no-results">
+                    No exact matches. Showing similar users:
+                </td>
+            </tr>
+            {% endif %}
+            {% for user in users %}
+            <tr>
+                <td>{{ user.id }}</td>
+                <td>{{ user.fname }}</td>
+                <td>{{ user.lname }}</td>
+                <td>{{ user.email }}</td>
+            </tr>
+            {% endfor %}
+            {% if cursor %}
+            <!--
+              More results row:
+              - hx-get="/search/": Ask for the next slice of results
+              - name/value: Send the cursor of the last row shown
+              - hx-include: Send the current search term and sort order
+              - hx-target/hx-swap: Replace this row with the next slice
+            -->
+            <tr id="more-results">
+                <td colspan="4" class="more-results">
+                    <button class="btn" name="cursor" value="{{ cursor }}"
+                            hx-get="/search/"
+                            hx-include="#search-input, #sort-state"
+                            hx-target="#more-results" hx-swap="outerHTML">
+                        More results...
+                    </button>
+                </td>
+            </tr>
+            {% endif %}
+    """,
+    # Clicking a header asks for the current search ordered by that column
+    # (ascending, or descending if it is already sorted ascending). The
+    # response swaps in new headers and sort state out of band (oob).
+    'sort_headers': """
+        <thead id="results-head"{% if oob %} hx-swap-oob="true"{% endif %}>
+            <tr>
+                {% for column, label in columns %}
+                {% set sorted = column == sort %}
+                <th class="sortable{% if sorted %} sorted-{{ dir }}{% endif %}"
+                    hx-get="/search/" hx-include="#search-input"
+                    hx-vals='{"sort": "{{ column }}", "dir": "{{
+                        'desc' if sorted and dir == 'asc' else 'asc' }}"}'
+                    hx-target="#search-results">{{ label }}</th>
+                {% endfor %}
+            </tr>
+        </thead>""",
+    # Hidden inputs in the search form, so typing keeps the sort order
+    'sort_state': """
+        <span id="sort-state"{% if oob %} hx-swap-oob="true"{% endif %}>
+            <input type="hidden" name="sort" value="{{ sort or '' }}">
+            <input type="hidden" name="dir" value="{{ dir }}">
+        </span>""",
+    'no_results': """
+        <tr>
+        <td colspan="4" class="no-results">No users found</td>
+        </tr>""",
+}
+fragments = {name: app.jinja_env.from_string(source)
+             for name, source in FRAGMENTS.items()}
+
+# Header label of each sortable column
+COLUMN_LABELS = {'id': 'ID', 'fname': 'First Name', 'lname': 'Last Name',
+                 'email': 'Email'}
+
+
+def render_fragment(name, **context):
+    """Render a precompiled inline fragment by name."""
+    return fragments[name].render(**context)
+
+
+def mark_spans(text, spans, quote):
+    """Join the quoted pieces of text, wrapping each span in <mark>."""
+    pieces = []
+    last = 0
+    for start, end in spans:
+        pieces += (quote(text[last:start]), '<mark>',
+                   quote(text[start:end]), '</mark>')
+        last = end
+    pieces.append(quote(text[last:]))
+    return ''.join(pieces)
+
+
+# Characters escape() replaces with an entity
+HTML_SPECIAL = frozenset('&<>"\'')
+
+
+def highlight(text, spans):
+    """
+    Return text, escaped, with each (start, end) span wrapped in <mark>.
+    The Markup result is not escaped again by Jinja.
+    """
+    if not spans:
+        return text
+    if not HTML_SPECIAL.isdisjoint(text):
+        # Entities would shift the offsets; escape piece by piece instead
+        return Markup(mark_spans(text, spans, escape))
+    # Nothing needs escaping, so the offsets hold in text as it is
+    if len(spans) == 1:
+        start, end = spans[0]
+        return Markup(f'{text[:start]}<mark>{text[start:end]}</mark>'
+                      f'{text[end:]}')
+    return Markup(mark_spans(text, spans, str))
+
+
+def highlighted(user, spans):
+    """
+    Return user, or a UserRow of it with the matched spans of each field
+    marked. Cells without a match stay plain strings for Jinja to escape.
+    """
+    if not spans:
+        return user
+    fname, lname, email = user.fname, user.lname, user.email
+    if 'fname' in spans:
+        fname = highlight(fname, spans['fname'])
+    if 'lname' in spans:
+        lname = highlight(lname, spans['lname'])
+    if 'email' in spans:
+        email = highlight(email, spans['email'])
+    return UserRow(user.id, fname, lname, email)
+
+
+def client_id():
+    """Return a stable id for the current browser session."""
+    if 'client_id' not in flask.session:
+        flask.session['client_id'] = uuid.uuid4().hex
+    return flask.session['client_id']
+
+
+def parse_cursor(cursor):
+    """Turn a "score:row" cursor back into the pair it was made from."""
+    try:
+        score, row = cursor.split(':')
+        return int(score), int(row)
+    except (AttributeError, ValueError):
+        return None
+
+
+def parse_offset(cursor, size):
+    """
+    Turn a sorted-page cursor back into an offset within [0, size]; one
+    that is missing or not a number starts from the top.
+    """
+    try:
+        offset = int(cursor)
+    except (TypeError, ValueError):
+        return 0
+    return min(max(offset, 0), size)
+
+
+def result_page(store, search_word, cursor=None, cancelled=None):
+    """
+    Return the next page of (score, row) pairs for search_word in store (a
+    snapshot of the user store) and the cursor for the page after it (None
+    when there are no more rows). Raises Superseded if cancelled() turns
+    true along the way.
+    """
+    limit = app.config['SEARCH_LIMIT']
+
+    # An empty search lists every user in id order; no ranking needed
+    if not search_word or search_word.strip() == '':
+        after = cursor[1] if cursor else None
+        page = [(0, row) for row in store.page(after, limit + 1)]
+    else:
+        # Without a warmer (WARM_QUERIES=0) there is nothing to look up
+        warmed = hot_queries.top and flask.has_request_context()
+        if cursor is None and warmed:
+            hot = hot_queries.get(search_word.strip(), user_store,
+                                  store.version)
+            if hot is not None:
+                return hot
+        terms = parse_query(search_word)
+        if store.remote:
+            # The shards rank their own matches; only a count and the
+            # ranked page are sent back, so there is nothing to cache
+            rows = None
+            matches = store.count(search_word)
+        elif flask.has_request_context():
+            rows = query_cache.search(client_id(), search_word, store)
+            matches = len(rows)
+        else:
+            # Precomputing for hot_queries; there is no client
+            rows = store.search(search_word)
+            matches = len(rows)
+        if cancelled is not None and cancelled():
+            raise Superseded()
+        page = store.rank(search_word, rows, limit + 1, after=cursor,
+                          cancelled=cancelled)
+
+        # Too few exact matches for a single plain term: likely a typo, so
+        # add users with similar words. Fuzzy pairs score above every exact
+        # match, so they follow.
+        plain = len(terms) == 1 and terms[0][0] is None
+        if plain and matches < app.config['FUZZY_THRESHOLD']:
+            exact = set(store.search(search_word) if rows is None else rows)
+            similar = [pair for pair in store.fuzzy(terms[0][1])
+                       if pair[1] not in exact]
+            if cursor is not None:
+                similar = [pair for pair in similar if pair > cursor]
+            page = sorted(page + similar)[:limit + 1]
+
+    # One extra pair tells whether a "More results" row is needed
+    if len(page) > limit:
+        page = page[:limit]
+        return page, '{}:{}'.format(*page[-1])
+    return page, None
+
+
+def sorted_page(store, search_word, sort, descending, offset=0):
+    """
+    Return the page of rows for search_word in store ordered by the sort
+    column, starting offset rows in, and the offset of the page after it
+    (None when there are no more rows).
+    """
+    limit = app.config['SEARCH_LIMIT']
+    rows = None
+    # Remote stores sort the matches of search_word where they are kept
+    if search_word and search_word.strip() != '' and not store.remote:
+        rows = query_cache.search(client_id(), search_word, store)
+    page = store.sorted_page(search_word, rows, sort, offset, limit + 1,
+                             descending)
+    if len(page) > limit:
+        return page[:limit], offset + limit
+    return page, None
+
+
+def sort_fragments(sort, direction, oob=False):
+    """Render the table headers and hidden sort inputs for an order."""
+    columns = [(column, COLUMN_LABELS[column]) for column in SORT_COLUMNS]
+    return (render_fragment('sort_headers', columns=columns, sort=sort,
+                            dir=direction, oob=oob),
+            render_fragment('sort_state', sort=sort, dir=direction, oob=oob))
+
+
 @app.route('/')
 @app.route('/index.html')
 def root():
     """Provides the main search page."""
-    return flask.render_template("index.html", users=users)
+    store = user_store.snapshot()
+    page, cursor = result_page(store, None)
+    headers, sort_state = sort_fragments(None, 'asc')
+    # Identifies this page load; its search numbers start again at 1
+    page_id = uuid.uuid4().hex
+    _, users = page_users(store, page)
+    return flask.render_template("index.html", users=users,
+                                 cursor=cursor, headers=Markup(headers),
+                                 sort_state=Markup(sort_state),
+                                 page_id=page_id)
+
 
+def search_etag(store, values):
+    """
+    Return the ETag of a /search/ response: a hash of the store and its
+    version plus every parameter the response depends on. It is cheap to
+    compute, so a repeated request is answered before any searching.
+    """
+    key = repr((store_tag, store.version, flask.request.method,
+                [values.get(name) for name in
+                 ('search', 'cursor', 'sort', 'dir')]))
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=12).hexdigest()
+
+
+def cacheable(response, etag):
+    """
+    Add the validator headers of a /search/ response. Vary: HX-Request
+    keeps caches from mixing fragments with full pages of the same URL;
+    no-cache lets browsers store the response but revalidate it each time.
+    """
+    response.set_etag(etag)
+    response.vary.add('HX-Request')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
-@app.route('/search/', methods=['POST'])
+
+@app.route('/search/', methods=['GET', 'POST'])
 def search():
     """
     Handles search requests and return filtered user results as HTML fragment.
+
+    Results are ranked by relevance unless sort names one of SORT_COLUMNS;
+    dir=desc reverses that order. The page sends GET requests, which also
+    get the headers and sort state back; POST is still answered, without
+    them.
     """
-    search_word = flask.request.form.get('search', None)
+    started = time.perf_counter()
+    values = flask.request.values
+    search_word = values.get('search', None)
+    first_page = not values.get('cursor')
+    cursor = parse_cursor(values.get('cursor'))
+    sort = values.get('sort')
+    if sort not in SORT_COLUMNS:
+        sort = None
+    direction = 'desc' if values.get('dir') == 'desc' else 'asc'
 
-    # If search is empty, return all users
-    if not search_word or search_word.strip() == '':
-        match_users = users
-    else:
-        match_users = [user for user in users if user.search(search_word)]
+    # One snapshot for the whole request, so concurrent writes to the user
+    # store cannot show up halfway through
+    store = user_store.snapshot()
+
+    # Answer a repeated request with 304 Not Modified: nothing is searched,
+    # rendered or sent again until a write changes the store version
+    etag = search_etag(store, values)
+    if flask.request.if_none_match.contains(etag):
+        return cacheable(flask.Response(status=304), etag)
+
+    # The page numbers its requests (X-Search-Seq). Once a newer one from
+    # the same page arrives, the browser will discard this response, so
+    # stop working on it and answer 204 No Content, which htmx does not
+    # swap. Requests are numbered per page load (X-Search-Page), since a
+    # reloaded page or a second tab of the session counts from 1 again.
+    seq = flask.request.headers.get('X-Search-Seq', type=int)
+    cancelled = None
+    if seq is not None:
+        client = (client_id(), flask.request.headers.get('X-Search-Page'))
+        if not sequencer.start(client, seq):
+            return '', 204
+        cancelled = functools.partial(sequencer.superseded, client, seq)
+
+    try:
+        if sort is None:
+            page, next_cursor = result_page(store, search_word, cursor,
+                                            cancelled)
+        else:
+            rows, next_cursor = sorted_page(
+                store, search_word, sort, direction == 'desc',
+                parse_offset(values.get('cursor'), len(store)))
+            page = [(0, row) for row in rows]
+    except Superseded:
+        sequencer.finish(completed=False)
+        return '', 204
+    if seq is not None:
+        sequencer.finish(completed=True)
 
     # Handle no matching results (only when there was actually a search term)
-    if ((search_word) and (search_word.strip() != '') and (not match_users)):
-        return '''
-        <tr>
-        <td colspan="4" class="no-results">No users found</td>
-        </tr>'''
+    has_term = search_word and search_word.strip() != ''
+    if has_term and not page and first_page:
+        html = render_fragment('no_results')
+    else:
+        # Only similar users were found; say so above the first page
+        similar = bool(page) and page[0][0] >= FUZZY_SCORE and first_page
+        html = search_rows(store, search_word, page, next_cursor, similar)
+    if flask.request.method == 'GET':
+        html += ''.join(sort_fragments(sort, direction, oob=True))
+    query_log.record((search_word or '').strip(),
+                     time.perf_counter() - started)
+    return cacheable(flask.make_response(html), etag)
 
-    templ = """
-            {% for user in users %}
-            <tr>
-                <td>{{ user.id }}</td>
-                <td>{{ user.fname }}</td>
-                <td>{{ user.lname }}</td>
-                <td>{{ user.email }}</td>
-            </tr>
-            {% endfor %}
+
+def page_users(store, page):
+    """
+    Return (rows, users) for the (score, row) pairs of page. Rows deleted
+    since they were found are left out: stores without snapshots (SQLite)
+    can lose a row between ranking and rendering.
+    """
+    rows, users = [], []
+    for _, row in page:
+        try:
+            users.append(store.get(row))
+        except KeyError:
+            continue
+        rows.append(row)
+    return rows, users
+
+
+def search_rows(store, search_word, page, cursor, similar):
+    """Render the rows of page, marking where each one matched."""
+
+    # Mark where each row matched, using offsets from the search engine
+    rows, users = page_users(store, page)
+    if search_word and search_word.strip() != '':
+        users = [highlighted(user, spans) for user, spans in
+                 zip(users, store.spans(search_word, rows))]
+    return render_fragment('user_rows', users=users, cursor=cursor,
+                           similar=similar)
+
+
+@app.route('/search/stats')
+def search_stats():
     """
-    return flask.render_template_string(templ, users=match_users)
+    Returns the query log as JSON: latency percentiles of every search,
+    and of the ?top=N (default 20) most frequent and slowest queries.
+    """
+    top = flask.request.args.get('top', 20, type=int)
+    stats = query_log.stats(top)
+    stats['warmer'] = {'queries': len(hot_queries.results),
+                       'hits': hot_queries.hits,
+                       'misses': hot_queries.misses}
+    return flask.jsonify(stats)
+
+
+def user_fields():
+    """Return the posted fname, lname and email; 400 if one is missing."""
+    fields = [flask.request.form.get(name, '').strip()
+              for name in ('fname', 'lname', 'email')]
+    if not all(fields):
+        flask.abort(400, 'fname, lname and email are required')
+    return fields
+
+
+@app.route('/users/', methods=['POST'])
+def add_user():
+    """Adds a user and returns its table row."""
+    try:
+        user = user_store.add(*user_fields())
+    except NotImplementedError:
+        flask.abort(405, 'the user store is read-only')
+    return render_fragment('user_rows', users=[user]), 201
+
+
+@app.route('/users/<int:user_id>', methods=['PUT'])
+def update_user(user_id):
+    """Replaces a user's fields and returns the updated table row."""
+    fields = user_fields()
+    try:
+        user = user_store.update(user_id, *fields)
+    except KeyError:
+        flask.abort(404)
+    except NotImplementedError:
+        flask.abort(405, 'the user store is read-only')
+    return render_fragment('user_rows', users=[user])
+
+
+@app.route('/users/<int:user_id>', methods=['DELETE'])
+def delete_user(user_id):
+    """Deletes a user; the empty response lets htmx remove its row."""
+    try:
+        user_store.delete(user_id)
+    except KeyError:
+        flask.abort(404)
+    except NotImplementedError:
+        flask.abort(405, 'the user store is read-only')
+    return ''
+
+
+@app.cli.command('import-users')
+@click.argument('csvfile', type=click.File())
+@click.option('--db', default='users.db', show_default=True,
+              help='SQLite database to append the users to.')
+def import_users(csvfile, db):
+    """
+    Bulk load fname,lname,email rows from CSVFILE into SQLite. Files
+    ending in .jsonl hold one {"fname", "lname", "email"} object per line.
+    """
+    start = time.perf_counter()
+
+    def progress(count):
+        click.echo('{} users ({:.0f}/s)'.format(
+            count, count / (time.perf_counter() - start)), err=True)
+
+    count = SQLiteUserStore(db).ingest(read_user_file(csvfile),
+                                       progress=progress)
+    click.echo('Imported {} users into {}'.format(count, db))
 
 
 if __name__ == '__main__':
@@ -3,14 +3,28 @@
 Unit tests for ACTIVESEARCH example.
 
 Tests the active search functionality with HTMX patterns:
-- hx-post: Send search requests
+- hx-get: Send search requests
 - hx-trigger: Real-time search on input
 - hx-target: Update results table
 - hx-indicator: Show loading state
 """
 
+import os
+import re
+import tempfile
+import threading
 import unittest
-from myapp import app, User
+import myapp
+from datagen import generate_queries, generate_table, generate_users
+from myapp import app, User, users, render_fragment
+from searchindex import (FIELDS, BKTree, ColumnOrder, FieldIndex, HotQueries,
+                         LatencyHistogram, PackedScan, QueryCache, QueryLog,
+                         RequestSequencer, Superseded, TrigramIndex,
+                         edit_distance, fold, intersect, match_spans, numpy,
+                         parse_query, refines, relevance, top_ranked,
+                         unfold_spans)
+from userstore import (MemoryUserStore, ShardedUserStore, SQLiteUserStore,
+                       UserRow, UserTable, read_user_jsonl)
 
 
 class TestActiveSearch(unittest.TestCase):
@@ -21,6 +35,12 @@ class TestActiveSearch(unittest.TestCase):
         self.app = app.test_client()
         self.app.testing = True
 
+    def search_text(self, term):
+        """POST term to /search/; return the HTML without <mark> tags."""
+        response = self.app.post('/search/', data={'search': term})
+        html = response.data.decode('utf-8')
+        return html.replace('<mark>', '').replace('</mark>', '')
+
     def test_index_page_loads(self):
         """Test that the main page loads correctly."""
         response = self.app.get('/')
@@ -114,6 +134,45 @@ class TestActiveSearch(unittest.TestCase):
         self.assertFalse(user.search("xyz"))
         self.assertFalse(user.search("nonexistent"))
 
+    def test_user_search_ignores_accents(self):
+        """Test that search keys are folded and follow field updates."""
+        user = User("José", "Straße", "jose@example.com")
+        self.assertTrue(user.search("JOSE"))
+        self.assertTrue(user.search("strasse"))
+        self.assertTrue(user.search("Josè"))
+        user.lname = "Núñez"
+        self.assertEqual(user.key, "josenunezjose@example.com")
+        self.assertTrue(user.search("nunez"))
+        self.assertFalse(user.search("strasse"))
+
+    def test_fold_and_unfold_spans(self):
+        """Test folding and mapping folded spans back to the text."""
+        self.assertEqual(fold("Ｒenée ŁUKASZ ﬁ"), "renee łukasz fi")
+        self.assertEqual(unfold_spans("Straße", [(4, 6)]), [(4, 5)])
+        self.assertEqual(unfold_spans("Straße", [(2, 5)]), [(2, 5)])
+        self.assertEqual(unfold_spans("plain", [(1, 3)]), [(1, 3)])
+
+    def test_search_accented_names(self):
+        """Test that accented and plain spellings find each other."""
+        original = myapp.user_store
+        table = UserTable()
+        table.append("José", "Peña", "jpena@example.com")
+        table.append("Jose", "Pena", "jose.pena@example.com")
+        sqlite = self.make_sqlite_store()
+        sqlite.ingest(zip(table.fnames, table.lnames, table.emails))
+        for query in ['josé peña', 'PENA', 'lname:peña', 'fname:jo lname:pen']:
+            self.assertEqual(len(sqlite.search(query)), 2, query)
+        try:
+            myapp.set_user_store(MemoryUserStore(table))
+            for term in ['josé', 'JOSE', 'pena', 'lname:peña']:
+                html = self.search_text(term)
+                self.assertIn('Peña', html, term)
+                self.assertIn('Pena', html, term)
+            html = self.app.post('/search/', data={'search': 'pena'}).data
+            self.assertIn('<mark>Peña</mark>'.encode('utf-8'), html)
+        finally:
+            myapp.set_user_store(original)
+
     def test_user_search_with_none(self):
         """Test User.search method with None input."""
         user = User("Test", "User", "test@example.com")
@@ -130,6 +189,945 @@ class TestActiveSearch(unittest.TestCase):
         self.assertEqual(user1.id, 1)
         self.assertEqual(user2.id, 2)
 
+    def test_trigram_index_matches_linear_scan(self):
+        """Test that the index returns the same users as User.search."""
+        index = TrigramIndex(u.fname + u.lname + u.email for u in users)
+        for term in ['john', 'JANE', 'son', '.org', 'ez@', 'mithjs', 'zzz']:
+            expected = [row for row, user in enumerate(users)
+                        if user.search(term)]
+            self.assertEqual(index.search(term), expected)
+
+    def test_trigram_index_short_terms(self):
+        """Test that terms shorter than a trigram still match."""
+        index = TrigramIndex(["JohnSmithjs@a.com", "JaneDoejd@b.org"])
+        self.assertEqual(index.search("j"), [0, 1])
+        self.assertEqual(index.search("do"), [1])
+        self.assertEqual(index.search("qq"), [])
+
+    def test_packed_scan_matches_linear_scan(self):
+        """Test that the packed scan returns the same rows as User.search."""
+        scan = PackedScan(u.fname + u.lname + u.email for u in users)
+        keys = [(u.fname + u.lname + u.email).lower() for u in users]
+        for term in ['j', 'JO', 'son', '.org', 'ez@', 'mithjs', 'zzz',
+                     'dwhite@strategic.org', 'x' * 5000, '\0', '']:
+            expected = [row for row, key in enumerate(keys)
+                        if term.lower() in key]
+            needle = term.lower().encode('utf-8')
+            self.assertEqual(scan.search(term), expected, term)
+            if term and '\0' not in term:
+                self.assertEqual(scan._search_find(needle), expected, term)
+                if numpy is not None:
+                    self.assertEqual(scan._search_numpy(needle), expected,
+                                     term)
+
+    def test_parse_query(self):
+        """Test field scopes, quoted phrases and plain terms."""
+        self.assertEqual(parse_query('Jo email:"Corp.Net" lname:d 12:30'),
+                         [(None, 'jo'), ('email', 'corp.net'),
+                          ('lname', 'd'), (None, '12:30')])
+        self.assertEqual(parse_query('"mary ann"'), [(None, 'mary ann')])
+        self.assertEqual(parse_query('email:  '), [])
+        self.assertTrue(refines(parse_query('email:corp jo'),
+                                parse_query('corp')))
+        self.assertFalse(refines(parse_query('corp'),
+                                 parse_query('email:corp')))
+
+    def test_intersect_smallest_first(self):
+        """Test that postings intersect to the rows found in every list."""
+        self.assertEqual(intersect([[1, 2, 3, 5, 8], [2, 5], [0, 2, 5, 9]]),
+                         [2, 5])
+        self.assertEqual(intersect([[1, 2], []]), [])
+
+    def test_field_index_matches_linear_scan(self):
+        """Test scoped and multi-term queries against a per-field scan."""
+        index = FieldIndex({'fname': [u.fname for u in users],
+                            'lname': [u.lname for u in users],
+                            'email': [u.email for u in users]})
+        for query in ['email:com', 'fname:j lname:o', 'j email:.org',
+                      'lname:"son"', 'ez lname:lopez', 'email:zzz']:
+            terms = parse_query(query)
+            keys = [{'fname': u.fname.lower(), 'lname': u.lname.lower(),
+                     'email': u.email.lower()} for u in users]
+            expected = [row for row, key in enumerate(keys)
+                        if all(any(term in key[name] for name in
+                                   (FIELDS if field is None else (field,)))
+                               for field, term in terms)]
+            self.assertEqual(index.search(query), expected, query)
+        # "ndoe" runs from Jane Doe's first name into her last name; no
+        # single field contains it
+        self.assertEqual(index.search('ndoe'), [])
+        self.assertEqual(index.search('fname:ndoe'), [])
+
+        # A row add() has not given every field yet is not searched
+        index.fields['fname'].add('Zebedee')
+        index.fields['lname'].add('Zed')
+        for query in ['zeb', 'zeb zed', 'z e', 'lname:zed fname:z']:
+            self.assertNotIn(len(users), index.search(query), query)
+
+    def test_search_field_scoped(self):
+        """Test scoped queries through /search/ with both stores."""
+        original = myapp.user_store
+        try:
+            for store in [original, self.make_sqlite_store()]:
+                myapp.set_user_store(store)
+                html = self.search_text('email:corp.net')
+                self.assertIn('corp.net', html)
+                self.assertNotIn('company.com', html)
+                html = self.search_text('lname:do j')
+                self.assertIn('Doe', html)
+                self.assertNotIn('Smith', html)
+        finally:
+            myapp.set_user_store(original)
+
+    def test_match_spans(self):
+        """Test spans of scoped and unscoped terms."""
+        values = {'fname': 'john', 'lname': 'doe', 'email': 'jdoe@doe.org'}
+        self.assertEqual(match_spans(parse_query('ohn email:doe'), values),
+                         {'fname': [(1, 4)], 'email': [(1, 4)]})
+        self.assertEqual(match_spans(parse_query('oe'), values),
+                         {'lname': [(1, 3)], 'email': [(2, 4)]})
+        self.assertEqual(match_spans(parse_query('nd'), values), {})
+        self.assertEqual(match_spans(parse_query('jo oh'), values),
+                         {'fname': [(0, 3)]})
+        self.assertEqual(match_spans(parse_query('zzz'), values), {})
+
+    def test_search_highlights_matches(self):
+        """Test that matches are marked and the rest stays escaped."""
+        original = myapp.user_store
+        table = UserTable()
+        table.append('<b>Jo</b>', 'Doe', 'jo&co@example.com')
+        try:
+            for store in [MemoryUserStore(table), self.make_sqlite_store()]:
+                myapp.set_user_store(store)
+                response = self.app.post('/search/', data={'search': 'jo'})
+                html = response.data.decode('utf-8')
+                self.assertIn('<mark>Jo</mark>', html)
+                self.assertNotIn('<b>', html)
+            myapp.set_user_store(MemoryUserStore(table))
+            html = self.app.post('/search/', data={'search': 'jo'}).data
+            self.assertIn(b'&lt;b&gt;<mark>Jo</mark>&lt;/b&gt;', html)
+            self.assertIn(b'<td><mark>jo</mark>&amp;co@example.com</td>',
+                          html)
+        finally:
+            myapp.set_user_store(original)
+
+    def test_highlight_cells(self):
+        """Test that only cells with a match become marked Markup."""
+        user = UserRow(1, 'Mary Ann', 'O\'Neil', 'mo@example.com')
+        row = myapp.highlighted(user, {'fname': [(0, 2), (5, 7)],
+                                       'lname': [(2, 4)]})
+        self.assertEqual(row.fname, '<mark>Ma</mark>ry <mark>An</mark>n')
+        self.assertEqual(row.lname, 'O&#39;<mark>Ne</mark>il')
+        self.assertIs(row.email, user.email)
+        self.assertIs(myapp.highlighted(user, {}), user)
+
+    def test_edit_distance(self):
+        """Test the Levenshtein distance used for fuzzy matching."""
+        self.assertEqual(edit_distance('garcia', 'garcia'), 0)
+        self.assertEqual(edit_distance('garica', 'garcia'), 2)
+        self.assertEqual(edit_distance('smith', 'smyth'), 1)
+        self.assertEqual(edit_distance('', 'abc'), 3)
+        self.assertEqual(edit_distance('kitten', 'sitting'), 3)
+
+    def test_bktree_matches_brute_force(self):
+        """Test that the BK-tree finds exactly the words within range."""
+        words = sorted({w for record in generate_users(300, seed=3)
+                        for w in record[1:2] + (record[2].split('@')[0],)})
+        tree = BKTree(words)
+        for query in ['smiht', 'garsia', 'jonson', 'lee', 'qqqqq']:
+            expected = sorted((edit_distance(query, w), w) for w in words
+                              if edit_distance(query, w) <= 2)
+            self.assertEqual(sorted(tree.search(query, 2)), expected)
+
+    def test_fuzzy_search_on_typo(self):
+        """Test that a misspelled name still finds the user."""
+        response = self.app.post('/search/', data={'search': 'Rodriguex'})
+        html = response.data.decode('utf-8')
+        self.assertIn('Showing similar users', html)
+        self.assertIn('Rodriguez', html)
+        self.assertNotIn('No users found', html)
+
+    def test_fuzzy_search_not_used_with_enough_matches(self):
+        """Test that fuzzy matches are not added to plentiful results."""
+        html = self.search_text('son')
+        self.assertNotIn('Showing similar users', html)
+        self.assertIn('Johnson', html)
+
+    def test_query_cache_narrows_extended_terms(self):
+        """Test that a term extending the last one reuses its rows."""
+        index = TrigramIndex(u.fname + u.lname + u.email for u in users)
+        cache = QueryCache(index)
+        self.assertEqual(cache.search('a', 'jo'), index.search('jo'))
+        self.assertEqual(cache.search('a', 'john'), index.search('john'))
+        self.assertEqual(cache.search('a', 'jane'), index.search('jane'))
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_query_cache_is_bounded(self):
+        """Test that the least recently used client is evicted."""
+        index = TrigramIndex(u.fname + u.lname + u.email for u in users)
+        cache = QueryCache(index, maxsize=2)
+        for client in ['a', 'b', 'c']:
+            cache.search(client, 'jo')
+        self.assertEqual(list(cache.entries), ['b', 'c'])
+
+    def test_search_sequence_same_client(self):
+        """Test that successive searches from one client stay correct."""
+        for term, expected, unexpected in [('j', 'Jane', 'Michael'),
+                                           ('jo', 'Johnson', 'Jane'),
+                                           ('jon', 'Jones', 'Johnson'),
+                                           ('ja', 'Jane', 'Jones')]:
+            html = self.search_text(term)
+            self.assertIn(expected, html)
+            self.assertNotIn(unexpected, html)
+
+    def test_request_sequencer(self):
+        """Test that a newer request supersedes older ones per client."""
+        sequencer = RequestSequencer()
+        self.assertTrue(sequencer.start('a', 1))
+        self.assertTrue(sequencer.start('b', 1))
+        self.assertFalse(sequencer.superseded('a', 1))
+        self.assertTrue(sequencer.start('a', 2))
+        self.assertTrue(sequencer.superseded('a', 1))
+        self.assertFalse(sequencer.superseded('b', 1))
+        self.assertFalse(sequencer.start('a', 1))
+        self.assertEqual(sequencer.abandoned, 1)
+
+    def test_superseded_ranking_stops(self):
+        """Test that ranking raises Superseded once cancelled."""
+        with self.assertRaises(Superseded):
+            top_ranked(range(10), abs, 5, cancelled=lambda: True)
+        self.assertEqual(top_ranked(range(10), abs, 2,
+                                    cancelled=lambda: False), [(0, 0), (1, 1)])
+        sqlite = self.make_sqlite_store()
+        sqlite.progress_steps = 1
+        with self.assertRaises(Superseded):
+            sqlite.rank('j', sqlite.search('j'), 5, cancelled=lambda: True)
+        self.assertEqual(len(sqlite.rank('j', None, 5)), 5)
+
+    def test_search_superseded_request(self):
+        """Test that an outdated X-Search-Seq request gets 204 No Content."""
+        response = self.app.post('/search/', data={'search': 'john'},
+                                 headers={'X-Search-Seq': '2'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'John', response.data)
+        response = self.app.post('/search/', data={'search': 'jo'},
+                                 headers={'X-Search-Seq': '1'})
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(response.data, b'')
+        response = self.app.post('/search/', data={'search': 'jane'},
+                                 headers={'X-Search-Seq': '3'})
+        self.assertIn(b'Jane', response.data)
+
+    def test_search_sequence_restarts_per_page(self):
+        """Test that a reloaded page's searches are not seen as outdated."""
+        first = re.search(r'searchPage = "(\w+)"',
+                          self.app.get('/').get_data(as_text=True)).group(1)
+        for seq in range(1, 6):
+            response = self.app.post('/search/', data={'search': 'jo'},
+                                     headers={'X-Search-Page': first,
+                                              'X-Search-Seq': str(seq)})
+            self.assertEqual(response.status_code, 200)
+
+        # The reloaded page (or a second tab) counts from 1 again
+        second = re.search(r'searchPage = "(\w+)"',
+                           self.app.get('/').get_data(as_text=True)).group(1)
+        self.assertNotEqual(first, second)
+        response = self.app.post('/search/', data={'search': 'jane'},
+                                 headers={'X-Search-Page': second,
+                                          'X-Search-Seq': '1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Jane', response.data)
+        # The old page's sequence still applies to the old page
+        response = self.app.post('/search/', data={'search': 'j'},
+                                 headers={'X-Search-Page': first,
+                                          'X-Search-Seq': '4'})
+        self.assertEqual(response.status_code, 204)
+
+    def test_latency_histogram(self):
+        """Test that histogram percentiles stay within their precision."""
+        histogram = LatencyHistogram()
+        self.assertEqual(histogram.percentile(0.5), 0.0)
+        for micros in range(1, 100001):
+            histogram.record(micros / 1000000)
+        for fraction in [0.5, 0.9, 0.99, 0.999]:
+            exact = fraction * 100
+            self.assertLessEqual(histogram.percentile(fraction), exact * 1.02)
+            self.assertGreaterEqual(histogram.percentile(fraction), exact)
+        self.assertEqual(histogram.summary()['max'], 100.0)
+        self.assertLess(len(histogram.counts), 1000)
+
+    def test_query_log(self):
+        """Test that the query log is bounded and ranks its queries."""
+        log = QueryLog(maxsize=3)
+        for query, runs, seconds in [('jo', 3, 0.001), ('smith', 1, 0.5),
+                                     ('ma', 2, 0.002), ('x', 1, 0.001)]:
+            for _ in range(runs):
+                log.record(query, seconds)
+        self.assertEqual(list(log.queries), ['smith', 'ma', 'x'])
+        self.assertEqual(log.top(2), ['ma', 'x'])
+        stats = log.stats(1)
+        self.assertEqual(stats['latency_ms']['count'], 7)
+        self.assertEqual(stats['slowest'][0]['query'], 'smith')
+        self.assertEqual(stats['frequent'][0]['count'], 2)
+
+    def test_search_stats_endpoint(self):
+        """Test that /search/ requests show up in /search/stats."""
+        original = myapp.query_log
+        myapp.query_log = QueryLog()
+        try:
+            for term in ['jo', 'jo', ' jo ', 'smith']:
+                self.app.post('/search/', data={'search': term})
+            stats = self.app.get('/search/stats?top=1').get_json()
+            self.assertEqual(stats['latency_ms']['count'], 4)
+            self.assertEqual(stats['frequent'],
+                             [dict(stats['frequent'][0], query='jo',
+                                   count=3)])
+            self.assertIn('warmer', stats)
+            # No warmer runs in the tests, so no lookups are counted
+            self.assertEqual(stats['warmer']['misses'], 0)
+            self.assertEqual(stats['warmer']['hits'], 0)
+        finally:
+            myapp.query_log = original
+
+    def test_hot_queries_follow_store_versions(self):
+        """Test that the warmer serves hot queries for their version only."""
+        store = MemoryUserStore(UserTable.from_users(users))
+        original = (myapp.user_store, myapp.query_log, myapp.hot_queries)
+        log = QueryLog()
+        hot = HotQueries(log, lambda store, query: myapp.result_page(
+            store, query), top=1)
+        myapp.set_user_store(store)
+        myapp.query_log, myapp.hot_queries = log, hot
+        try:
+            for term in ['jo', 'jo', 'smith']:
+                self.app.post('/search/', data={'search': term})
+            hot.refresh(store)
+            self.assertEqual(list(hot.results), ['jo'])
+            self.assertIn('Johnson', self.search_text('jo'))
+            self.assertEqual(hot.hits, 1)
+
+            # A write makes the precomputed page stale until the refresh
+            store.add('Jo', 'Newcomer', 'jn@example.com')
+            self.assertIn('Newcomer', self.search_text('jo'))
+            self.assertEqual(hot.hits, 1)
+            hot.refresh(store)
+            self.assertIn('Newcomer', self.search_text('jo'))
+            self.assertEqual(hot.hits, 2)
+        finally:
+            myapp.set_user_store(original[0])
+            myapp.query_log, myapp.hot_queries = original[1:]
+
+    def test_relevance_ranking(self):
+        """Test that name prefixes rank above email substrings."""
+        self.assertEqual(relevance('jo', 'john', 'smith', 'js@a.com'), 0)
+        self.assertEqual(relevance('oh', 'john', 'smith', 'js@a.com'), 1)
+        self.assertEqual(relevance('js', 'john', 'smith', 'js@a.com'), 2)
+        self.assertEqual(relevance('a.c', 'john', 'smith', 'js@a.com'), 3)
+        self.assertEqual(relevance('nsm', 'john', 'smith', 'js@a.com'), 4)
+
+    def test_top_ranked_pages(self):
+        """Test that top_ranked returns the best pairs, page by page."""
+        scores = {0: 3, 1: 0, 2: 1, 3: 0, 4: 2}
+        first = top_ranked(scores, scores.get, 2)
+        self.assertEqual(first, [(0, 1), (0, 3)])
+        second = top_ranked(scores, scores.get, 2, after=first[-1])
+        self.assertEqual(second, [(1, 2), (2, 4)])
+
+    def test_search_results_are_ranked(self):
+        """Test that name matches are listed before email-only matches."""
+        html = self.search_text('lo')
+        # Lopez starts with "lo"; Flores only contains it
+        self.assertLess(html.index('Lopez'), html.index('Flores'))
+
+    def test_search_limit_and_more_results(self):
+        """Test that results are capped and the rest load by cursor."""
+        app.config['SEARCH_LIMIT'] = 10
+        try:
+            response = self.app.post('/search/', data={'search': ''})
+            html = response.data.decode('utf-8')
+            self.assertEqual(html.count('<tr>'), 10)
+            self.assertIn('id="more-results"', html)
+            self.assertIn('value="0:9"', html)
+
+            response = self.app.post('/search/',
+                                     data={'search': '', 'cursor': '0:9'})
+            html = response.data.decode('utf-8')
+            self.assertIn('<td>11</td>', html)
+            self.assertNotIn('<td>10</td>', html)
+
+            response = self.app.post('/search/',
+                                     data={'search': '', 'cursor': '0:19'})
+            html = response.data.decode('utf-8')
+            self.assertEqual(html.count('<tr>'), 4)
+            self.assertNotIn('more-results', html)
+        finally:
+            app.config['SEARCH_LIMIT'] = 50
+
+    def test_column_order(self):
+        """Test that ColumnOrder walks, sorts and merges to one order."""
+        values = ['m', 'b', 'x', 'b', 'a', 'q']
+        order = ColumnOrder(values)
+        self.assertEqual(list(order.ordered(None, 6)), [4, 1, 3, 0, 5, 2])
+        self.assertEqual(list(order.ordered([0, 1, 2, 3], 6, True)),
+                         [2, 0, 3, 1])
+        # Small sets are sorted directly, in the same order
+        order.WALK_RATIO = 1
+        self.assertEqual(list(order.ordered([0, 3], 6)), [3, 0])
+        # Rows appended after the build are merged in; end hides later ones
+        values += ['c', 'a']
+        self.assertEqual(list(order.ordered(None, 7)),
+                         [4, 1, 3, 6, 0, 5, 2])
+        self.assertEqual(list(order.ordered([1, 2, 7], 8, True)), [2, 1, 7])
+
+    def test_search_sorted_by_column(self):
+        """Test that header clicks return the matches in column order."""
+        response = self.app.get('/search/', query_string={
+            'search': 'an', 'sort': 'lname', 'dir': 'asc'})
+        html = response.data.decode('utf-8').replace('<mark>', '')
+        html = html.replace('</mark>', '')
+        lnames = sorted(u.lname for u in users if u.search('an'))
+        positions = [html.index('<td>{}</td>'.format(lname))
+                     for lname in lnames]
+        self.assertEqual(positions, sorted(positions))
+        # New headers come back out of band, the clicked one toggled
+        self.assertIn('id="results-head" hx-swap-oob="true"', html)
+        self.assertIn('sorted-asc', html)
+        self.assertIn('"sort": "lname", "dir": "desc"', html)
+
+        # Typing keeps the order through the hidden sort inputs
+        response = self.app.post('/search/', data={
+            'search': 'an', 'sort': 'lname', 'dir': 'desc'})
+        html = response.data.decode('utf-8').replace('<mark>', '')
+        html = html.replace('</mark>', '')
+        self.assertNotIn('results-head', html)
+        positions = [html.index('<td>{}</td>'.format(lname))
+                     for lname in lnames]
+        self.assertEqual(positions, sorted(positions, reverse=True))
+
+    def test_sorted_search_pages(self):
+        """Test that sorted results page by offset."""
+        app.config['SEARCH_LIMIT'] = 10
+        try:
+            emails = sorted(u.email for u in users)
+            response = self.app.post('/search/', data={'sort': 'email'})
+            html = response.data.decode('utf-8')
+            self.assertEqual(html.count('<tr>'), 10)
+            self.assertIn('value="10"', html)
+            self.assertIn(emails[9], html)
+            response = self.app.post('/search/', data={
+                'sort': 'email', 'cursor': '20'})
+            html = response.data.decode('utf-8')
+            self.assertEqual(html.count('<tr>'), 4)
+            self.assertIn(emails[23], html)
+            self.assertNotIn('more-results', html)
+        finally:
+            app.config['SEARCH_LIMIT'] = 50
+
+    def test_sorted_search_bad_cursor(self):
+        """Test that negative, huge or garbled sorted cursors are clamped."""
+        first = self.app.get('/search/?sort=id').data
+        for query in ['sort=id&cursor=-1', 'sort=id&cursor=abc',
+                      'sort=lname&search=jo&cursor=-1']:
+            response = self.app.get('/search/?' + query)
+            self.assertEqual(response.status_code, 200, query)
+        self.assertEqual(self.app.get('/search/?sort=id&cursor=-1').data,
+                         first)
+        response = self.app.get(
+            '/search/?sort=id&cursor=99999999999999999999999')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(b'<td>', response.data)
+
+    def test_stores_sort_alike(self):
+        """Test that both stores and later writes agree on sort order."""
+        memory = MemoryUserStore(UserTable.from_users(users))
+        memory.add('Aaron', 'Zuniga', 'az@example.com')
+        memory.delete(3)
+        sqlite = self.make_sqlite_store()
+        sqlite.add('Aaron', 'Zuniga', 'az@example.com')
+        sqlite.delete(3)
+        for query in [None, 'a', 'email:.org']:
+            for column in ['id', 'fname', 'lname', 'email']:
+                for descending in [False, True]:
+                    expected = [memory.get(row).id for row in
+                                memory.sorted_page(
+                                    query, query and memory.search(query),
+                                    column, 2, 10, descending)]
+                    found = sqlite.sorted_page(query, None, column, 2, 10,
+                                               descending)
+                    self.assertEqual(found, expected,
+                                     (query, column, descending))
+
+    def make_sqlite_store(self):
+        """Return an SQLite store in a temporary file holding all users."""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        store = SQLiteUserStore(os.path.join(tmpdir.name, 'users.db'))
+        store.ingest((u.fname, u.lname, u.email) for u in users)
+        self.addCleanup(store.connect().close)
+        return store
+
+    def test_sqlite_store_matches_memory_store(self):
+        """Test that both stores find the same users for each term."""
+        memory = MemoryUserStore(UserTable.from_users(users))
+        sqlite = self.make_sqlite_store()
+        self.assertEqual(len(sqlite), len(memory))
+        for term in ['john', 'JANE', 'son', '.org', 'ez@', 'mithjs', 'zzz',
+                     'j', '%', '_', 'ndoe', 'nd', 'oe']:
+            expected = [memory.get(row).email for row in memory.search(term)]
+            found = [sqlite.get(row).email for row in sqlite.search(term)]
+            self.assertEqual(found, expected, term)
+
+    def test_sqlite_store_rank_and_page(self):
+        """Test ranking and id-order paging in the SQLite store."""
+        sqlite = self.make_sqlite_store()
+        pairs = sqlite.rank('lo', sqlite.search('lo'), 2)
+        self.assertEqual(sqlite.get(pairs[0][1]).lname, 'Lopez')
+        self.assertEqual(sqlite.page(None, 2), [1, 2])
+        self.assertEqual(sqlite.page(23, 5), [24])
+        self.assertEqual(sqlite.get(1).id, 1)
+
+    def test_sqlite_row_deleted_mid_search(self):
+        """Test that a row deleted after ranking is skipped, not a 500."""
+        original = myapp.user_store
+        sqlite = self.make_sqlite_store()
+        rank = sqlite.rank
+
+        def rank_then_delete(*args, **kwargs):
+            pairs = rank(*args, **kwargs)
+            sqlite.delete(pairs[0][1])
+            return pairs
+
+        sqlite.rank = rank_then_delete
+        myapp.set_user_store(sqlite)
+        try:
+            response = self.app.get('/search/?search=lo')
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn(b'Lopez', response.data)
+            self.assertIn(b'Tay<mark>lo</mark>r', response.data)
+        finally:
+            myapp.set_user_store(original)
+        with self.assertRaises(KeyError):
+            sqlite.get(10 ** 6)
+        self.assertEqual(sqlite.spans('lo', [10 ** 6]), [{}])
+
+    def test_sharded_store_matches_memory_store(self):
+        """Test that merged shard results equal one in-memory store."""
+        table = generate_table(500)
+        memory = MemoryUserStore(table)
+        sharded = ShardedUserStore(table, 3)
+        self.addCleanup(sharded.close)
+        self.assertEqual(len(sharded), 500)
+        for query in ['a', 'mar', 'lname:son', 'jo email:.org', 'zzz']:
+            rows = memory.search(query)
+            self.assertEqual(sharded.search(query), rows, query)
+            first = memory.rank(query, rows, 10)
+            self.assertEqual(sharded.rank(query, rows, 10), first, query)
+            if first:
+                self.assertEqual(
+                    sharded.rank(query, rows, 10, after=first[-1]),
+                    memory.rank(query, rows, 10, after=first[-1]), query)
+            for column in ['id', 'lname']:
+                self.assertEqual(
+                    sharded.sorted_page(query, rows, column, 5, 10, True),
+                    memory.sorted_page(query, rows, column, 5, 10, True))
+        self.assertEqual(sharded.fuzzy('smtih'), memory.fuzzy('smtih'))
+        with self.assertRaises(NotImplementedError):
+            sharded.add('a', 'b', 'c')
+
+    def test_search_with_sharded_store(self):
+        """Test /search/ and the read-only write endpoints when sharded."""
+        original = myapp.user_store
+        app.config['SEARCH_SHARDS'] = 2
+        try:
+            myapp.set_user_store(myapp.build_user_store())
+            self.addCleanup(myapp.user_store.close)
+            self.assertEqual(myapp.user_store.count('son'),
+                             len(myapp.user_store.search('son')))
+            self.assertIn('jsmith@company.com', self.search_text('smith'))
+            # Only counts and pages come back; no match list is cached
+            self.assertIn('Johnson', self.search_text('son'))
+            html = self.app.get('/search/?search=son&sort=lname').data
+            self.assertLess(html.index(b'Ander<mark>'),
+                            html.index(b'Wil<mark>'))
+            self.assertEqual(myapp.query_cache.hits, 0)
+            self.assertEqual(myapp.query_cache.misses, 0)
+            response = self.app.post('/users/', data={
+                'fname': 'a', 'lname': 'b', 'email': 'c'})
+            self.assertEqual(response.status_code, 405)
+        finally:
+            app.config['SEARCH_SHARDS'] = 0
+            myapp.set_user_store(original)
+
+    def test_search_with_sqlite_store(self):
+        """Test the /search/ endpoint backed by the SQLite store."""
+        sqlite = self.make_sqlite_store()
+        original = myapp.user_store
+        myapp.set_user_store(sqlite)
+        try:
+            response = self.app.post('/search/', data={'search': 'smith'})
+            self.assertIn(b'j<mark>smith</mark>@company.com', response.data)
+            self.assertNotIn(b'Jane', response.data)
+
+            # Another worker opening the same file gives the same ETags
+            etag = self.app.get('/search/?search=jo').headers['ETag']
+            other = SQLiteUserStore(sqlite.path)
+            myapp.set_user_store(other)
+            response = self.app.get('/search/?search=jo',
+                                    headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            other.connect().close()
+            myapp.set_user_store(MemoryUserStore(UserTable.from_users(users)))
+            self.assertNotEqual(
+                self.app.get('/search/?search=jo').headers['ETag'], etag)
+        finally:
+            myapp.set_user_store(original)
+
+    def test_import_users_command(self):
+        """Test that the import-users command loads a CSV file."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            csv_path = os.path.join(tmpdir, 'users.csv')
+            db_path = os.path.join(tmpdir, 'users.db')
+            with open(csv_path, 'w') as out:
+                out.write('fname,lname,email\n')
+                out.write('Ada,Lovelace,ada@engine.org\n')
+                out.write('Alan,Turing,alan@bletchley.uk\n')
+            result = app.test_cli_runner().invoke(
+                args=['import-users', csv_path, '--db', db_path])
+            self.assertIn('Imported 2 users', result.output)
+            store = SQLiteUserStore(db_path)
+            self.assertEqual(store.search('turing'), [2])
+            store.connect().close()
+
+    def test_import_users_jsonl(self):
+        """Test JSON Lines parsing and import."""
+        lines = ['{"fname": "Ada", "lname": "Lovelace", "email": "a@e.org"}',
+                 '', '{"fname": "Alan"}', '[1, 2, 3]',
+                 '{"fname": "Alan", "lname": "Turing", "email": "t@b.uk"}']
+        self.assertEqual(list(read_user_jsonl(lines)),
+                         [('Ada', 'Lovelace', 'a@e.org'),
+                          ('Alan', 'Turing', 't@b.uk')])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'users.jsonl')
+            db_path = os.path.join(tmpdir, 'users.db')
+            with open(path, 'w') as out:
+                out.write('\n'.join(lines))
+            result = app.test_cli_runner().invoke(
+                args=['import-users', path, '--db', db_path])
+            self.assertIn('Imported 2 users', result.output)
+
+    def test_memory_store_ingest(self):
+        """Test that batched ingest serves partial results and catches up."""
+        records = list(generate_users(2500))
+        store = MemoryUserStore(UserTable())
+        seen = []
+
+        def progress(count):
+            snapshot = store.snapshot()
+            seen.append((count, len(snapshot), len(snapshot.search('a'))))
+
+        self.assertEqual(store.ingest(records, batch=1000,
+                                      progress=progress), 2500)
+        self.assertEqual([count for count, _, _ in seen], [1000, 2000, 2500])
+        self.assertEqual([size for _, size, _ in seen], [1000, 2000, 2500])
+        self.assertEqual(store.version, 3)
+
+        expected = MemoryUserStore(generate_table(2500))
+        self.assertEqual(seen[-1][2], len(expected.search('a')))
+        self.assertEqual(len(store.snapshot().orders['id']), 2500)
+        for query in ['a', 'ma', 'smith', 'email:.org']:
+            self.assertEqual(store.search(query), expected.search(query))
+            self.assertEqual(
+                store.sorted_page(query, store.search(query), 'lname', 0,
+                                  20),
+                expected.sorted_page(query, expected.search(query),
+                                     'lname', 0, 20))
+
+    def test_background_import(self):
+        """Test that start_import fills a store from a file."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'users.csv')
+            with open(path, 'w') as out:
+                out.write('fname,lname,email\n')
+                for record in generate_users(300):
+                    out.write(','.join(record) + '\n')
+            store = MemoryUserStore(UserTable())
+            myapp.start_import(store, path).join()
+        self.assertEqual(len(store), 300)
+        self.assertEqual(store.get(0).id, 1)
+
+    def test_result_fragments(self):
+        """Test the result rows and the out-of-band sort state."""
+        html = render_fragment('user_rows', users=users[:1], cursor='1:7')
+        self.assertIn('<td>John</td>', html)
+        self.assertIn('value="1:7"', html)
+        self.assertNotIn('more-results',
+                         render_fragment('user_rows', users=users[:1]))
+        html = render_fragment('sort_state', sort='lname', dir='desc',
+                               oob=True)
+        self.assertIn('id="sort-state" hx-swap-oob="true"', html)
+        self.assertIn('name="dir" value="desc"', html)
+
+    def test_user_id_allocation_is_thread_safe(self):
+        """Test that concurrently created users get distinct ids."""
+        created = []
+
+        def create():
+            created.extend(User("T", "U", "t@u.com") for _ in range(2000))
+
+        threads = [threading.Thread(target=create) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        ids = [user.id for user in created]
+        self.assertEqual(len(set(ids)), len(ids))
+
+    def test_user_table_columns(self):
+        """Test that UserTable stores columns and hands out slot views."""
+        table = UserTable()
+        self.assertEqual(table.append("Ana", "Cruz", "ana@a.com"), 0)
+        name = "".join(["A", "na"])
+        self.assertEqual(table.append(name, "Lee", "al@b.com", id=10), 1)
+        self.assertEqual(table.append("Bo", "Lee", "bo@c.com"), 2)
+        self.assertEqual(list(table.ids), [1, 10, 11])
+        self.assertIs(table.fnames[0], table.fnames[1])
+        row = table[2]
+        self.assertEqual((row.id, row.fname, row.lname, row.email),
+                         (11, "Bo", "Lee", "bo@c.com"))
+        self.assertFalse(hasattr(row, '__dict__'))
+        self.assertEqual(list(table.keys())[1], "AnaLeeal@b.com")
+
+    def test_generated_users_are_reproducible(self):
+        """Test that the same seed always generates the same users."""
+        first = list(generate_users(500, seed=7))
+        self.assertEqual(len(first), 500)
+        self.assertEqual(first, list(generate_users(500, seed=7)))
+        self.assertNotEqual(first, list(generate_users(500, seed=8)))
+        for fname, lname, email in first:
+            self.assertIn('@', email)
+        table = generate_table(500, seed=7)
+        self.assertEqual(table[499].email, first[499][2])
+
+    def test_generated_queries_mix_lengths(self):
+        """Test that generated queries are mostly short prefixes."""
+        queries = generate_queries(2000, seed=7)
+        self.assertEqual(queries, generate_queries(2000, seed=7))
+        lengths = [len(query) for query in queries]
+        self.assertEqual(min(lengths), 1)
+        short = sum(1 for length in lengths if 3 <= length <= 5)
+        self.assertGreater(short, len(queries) // 3)
+
+    def test_synthetic_users_store(self):
+        """Test that SYNTHETIC_USERS replaces the sample users."""
+        original = myapp.user_store
+        app.config['SYNTHETIC_USERS'] = 1000
+        try:
+            myapp.set_user_store(myapp.build_user_store())
+            self.assertEqual(len(myapp.user_store), 1000)
+            response = self.app.post('/search/', data={'search': 'a'})
+            self.assertIn(b'more-results', response.data)
+        finally:
+            app.config['SYNTHETIC_USERS'] = 0
+            myapp.set_user_store(original)
+
+    def test_memory_store_writes(self):
+        """Test add, update and delete on the in-memory store."""
+        store = MemoryUserStore(UserTable.from_users(users))
+        user = store.add('Zelda', 'Quartz', 'zq@example.com')
+        self.assertEqual(user.id, 25)
+        self.assertEqual(store.search('zelda'), [24])
+        self.assertEqual(store.search('ze'), [24])
+        self.assertEqual(len(store), 25)
+
+        store.update(user.id, 'Zelda', 'Onyx', 'zo@example.com')
+        rows = store.search('zelda')
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(store.get(rows[0]).lname, 'Onyx')
+        self.assertEqual(store.get(rows[0]).id, 25)
+        self.assertEqual(store.search('quartz'), [])
+        self.assertEqual(len(store), 25)
+
+        store.delete(1)
+        self.assertNotIn(0, store.search('john'))
+        self.assertNotIn(0, store.page(None, 5))
+        self.assertEqual(len(store), 24)
+        self.assertEqual(store.version, 3)
+        with self.assertRaises(KeyError):
+            store.delete(1)
+        with self.assertRaises(KeyError):
+            store.update(99, 'a', 'b', 'c')
+        self.assertEqual(store.version, 3)
+
+    def test_snapshot_isolation(self):
+        """Test that a snapshot does not see later writes."""
+        store = MemoryUserStore(UserTable.from_users(users))
+        before = store.snapshot()
+        store.add('Jonas', 'Late', 'jl@example.com')
+        store.delete(2)
+        self.assertEqual(before.search('jane'), [1])
+        self.assertEqual(len(before.search('jon')), len(
+            [u for u in users if 'jon' in (u.fname + u.lname).lower()]))
+        self.assertEqual(store.search('jane'), [])
+        self.assertIn(24, store.search('jon'))
+        self.assertNotIn(24, before.search('jo'))
+        self.assertEqual([row for row in before.page(None, 30)],
+                         list(range(24)))
+
+    def test_compaction(self):
+        """Test that compaction drops tombstones and replays late writes."""
+        store = MemoryUserStore(UserTable.from_users(users))
+        for user_id in range(1, 11):
+            store.delete(user_id)
+        store.update(20, 'Paul', 'Stone', 'ps@example.com')
+
+        def build(table, version):
+            # A write that arrives while the compaction is running
+            store._build = MemoryUserStore._build
+            store.add('Late', 'Writer', 'lw@example.com')
+            return MemoryUserStore._build(table, version)
+
+        store._build = build
+        version = store.version
+        self.assertTrue(store.compact())
+        self.assertGreater(store.version, version + 1)
+        self.assertEqual(store.compactions, 1)
+        self.assertEqual(len(store.users), 15)
+        self.assertEqual(len(store), 15)
+        ids = [store.get(row).id for row in store.page(None, 20)]
+        self.assertEqual(ids, list(range(11, 26)))
+        self.assertEqual([store.get(row).fname for row in
+                          store.search('stone')], ['Paul'])
+        self.assertEqual(len(store.search('writer')), 1)
+
+    def test_background_compaction(self):
+        """Test that enough tombstones start a compaction thread."""
+        store = MemoryUserStore(UserTable.from_users(users))
+        store.compact_min = 5
+        before = threading.enumerate()
+        for user_id in range(1, 6):
+            store.delete(user_id)
+        for thread in set(threading.enumerate()) - set(before):
+            thread.join()
+        self.assertEqual(store.compactions, 1)
+        self.assertEqual(len(store.users), 19)
+
+    def test_concurrent_reads_and_writes(self):
+        """Test that searches stay consistent while users change."""
+        store = MemoryUserStore(UserTable.from_users(users))
+        store.compact_min = 20
+        errors = []
+
+        def write():
+            for i in range(300):
+                user = store.add('Temp', 'User{}'.format(i), 't@x.com')
+                store.delete(user.id)
+
+        def read():
+            for _ in range(300):
+                snapshot = store.snapshot()
+                rows = snapshot.search('temp')
+                if len(rows) > 1 or any(not snapshot.alive(row)
+                                        for row in rows):
+                    errors.append(rows)
+                if len(snapshot.search('john')) != 2:
+                    errors.append('john')
+
+        threads = [threading.Thread(target=write)]
+        threads += [threading.Thread(target=read) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(store.search('temp'), [])
+
+    def test_query_cache_follows_versions(self):
+        """Test that a write invalidates narrowing from older results."""
+        store = MemoryUserStore(UserTable.from_users(users))
+        cache = QueryCache(store)
+        cache.search('a', 'jo')
+        store.add('Joanna', 'New', 'jn@example.com')
+        self.assertIn(24, cache.search('a', 'joa'))
+
+    def test_search_etag(self):
+        """Test 304 for a repeated search until a write changes the store."""
+        original = myapp.user_store
+        store = MemoryUserStore(UserTable.from_users(users))
+        myapp.set_user_store(store)
+        try:
+            url = '/search/?search=jo&sort=lname&dir=asc'
+            response = self.app.get(url)
+            etag = response.headers['ETag']
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('HX-Request', response.vary)
+            self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+
+            response = self.app.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, b'')
+            self.assertEqual(response.headers['ETag'], etag)
+            # Other parameters are other responses
+            response = self.app.get(url.replace('asc', 'desc'),
+                                    headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+
+            # The search box sends GET, so browsers revalidate its results
+            index = self.app.get('/').data.decode('utf-8')
+            search_input = index[index.index('id="search-input"'):]
+            search_input = search_input[:search_input.index('>')]
+            self.assertIn('hx-get="/search/"', search_input)
+            self.assertIn('hx-include="#sort-state"', search_input)
+            self.assertNotIn('hx-post', index)
+
+            # POSTed searches get their own validators too
+            response = self.app.post('/search/', data={'search': 'jo'})
+            response = self.app.post('/search/', data={'search': 'jo'},
+                                     headers={'If-None-Match':
+                                              response.headers['ETag']})
+            self.assertEqual(response.status_code, 304)
+
+            store.add('Jo', 'Newcomer', 'jn@example.com')
+            response = self.app.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers['ETag'], etag)
+            self.assertIn(b'Newcomer', response.data)
+        finally:
+            myapp.set_user_store(original)
+
+    def test_user_endpoints(self):
+        """Test the add, update and delete endpoints with both stores."""
+        original = myapp.user_store
+        try:
+            for store in [MemoryUserStore(UserTable.from_users(users)),
+                          self.make_sqlite_store()]:
+                myapp.set_user_store(store)
+                response = self.app.post('/users/', data={
+                    'fname': 'Quinn', 'lname': 'Zephyr',
+                    'email': 'qz@example.com'})
+                self.assertEqual(response.status_code, 201)
+                self.assertIn(b'<td>25</td>', response.data)
+                self.assertIn('Zephyr', self.search_text('zeph'))
+
+                response = self.app.put('/users/25', data={
+                    'fname': 'Quinn', 'lname': 'Yarrow',
+                    'email': 'qy@example.com'})
+                self.assertIn(b'Yarrow', response.data)
+                self.assertIn('No users found', self.search_text('zeph'))
+                self.assertIn('Yarrow', self.search_text('yarr'))
+
+                response = self.app.delete('/users/25')
+                self.assertEqual(response.status_code, 200)
+                self.assertIn('No users found', self.search_text('yarrow'))
+                self.assertEqual(self.app.delete('/users/25').status_code,
+                                 404)
+                self.assertEqual(self.app.put('/users/25', data={
+                    'fname': 'a', 'lname': 'b', 'email': 'c'}).status_code,
+                    404)
+                self.assertEqual(self.app.post('/users/', data={
+                    'fname': 'a'}).status_code, 400)
+        finally:
+            myapp.set_user_store(original)
+
     def test_css_class_names(self):
         """Test that proper CSS class names are used."""
         response = self.app.get('/')
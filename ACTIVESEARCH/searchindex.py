@@ -0,0 +1,907 @@
+"""
+Trigram search index for the ACTIVESEARCH example.
+
+The naive search lowercases ``fname + lname + email`` for every user on
+every keystroke, so each query costs O(users x record length). This module
+builds an inverted index of 3-character substrings (trigrams) once, when the
+user list is loaded. A query then only has to look at the users that share
+its rarest trigram.
+
+PackedScan is the index-free fallback: a brute-force substring scan over
+all keys packed into one buffer, used for terms shorter than a trigram.
+
+Queries may scope terms to one field (email:corp.net), quote phrases and
+combine several terms, which must all match. FieldIndex keeps one index
+per field so that a scoped term only touches that field's postings.
+"""
+
+import bisect
+import heapq
+import re
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict, defaultdict
+
+try:
+    import numpy
+except ImportError:
+    # Optional: pip install numpy (the "fast-scan" extra) to vectorize
+    # PackedScan; without it a bytes.find loop is used instead
+    numpy = None
+
+# Length of the substrings stored in the index
+NGRAM = 3
+
+
+def fold(text):
+    """
+    Return text the way search keys store it: compatibility-decomposed
+    (NFKD), without combining marks, and casefolded, so "José", "JOSE"
+    and "jose" are all "jose". Queries are folded the same way.
+    """
+    if text.isascii():
+        return text.lower()
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(c for c in decomposed
+                   if not unicodedata.combining(c)).casefold()
+
+
+def unfold_spans(text, spans):
+    """
+    Map (start, end) spans of fold(text) back to spans of text.
+
+    Folding works character by character, but a character may fold to
+    several ("ß" to "ss") or to none (a lone combining mark), so offsets
+    only carry over unchanged for ASCII text.
+    """
+    if text.isascii():
+        return spans
+    # Offset in fold(text) at which each character of text starts
+    starts = []
+    offset = 0
+    for char in text:
+        starts.append(offset)
+        offset += len(fold(char))
+    starts.append(offset)
+    return [(bisect.bisect_right(starts, start) - 1,
+             bisect.bisect_left(starts, end)) for start, end in spans]
+
+
+def ngrams(text, n=NGRAM):
+    """Return the set of distinct n-character substrings of text."""
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+class PackedScan:
+    """
+    Brute-force substring search over keys packed into one bytes buffer.
+
+    Keys are folded, UTF-8 encoded and joined with NUL separators, so a
+    match can never span two records. starts holds the offset of each key
+    in the buffer; a match position maps back to its row by binary search
+    over starts. Nothing has to be maintained beyond the buffer itself.
+    """
+
+    SEPARATOR = b'\0'
+
+    def __init__(self, keys):
+        encoded = [fold(key).encode('utf-8') for key in keys]
+        self.buffer = self.SEPARATOR.join(encoded)
+        starts = []
+        offset = 0
+        for key in encoded:
+            starts.append(offset)
+            offset += len(key) + 1
+        self.rows = len(encoded)
+        if numpy is not None:
+            self.starts = numpy.array(starts, dtype=numpy.int64)
+            self.bytes = numpy.frombuffer(self.buffer, dtype=numpy.uint8)
+            # How often each byte value occurs, to start from the rarest one
+            self.frequency = numpy.bincount(self.bytes, minlength=256)
+        else:
+            self.starts = starts
+
+    def search(self, term):
+        """Return the rows whose key contains term, in row order."""
+        needle = fold(term).encode('utf-8')
+        if not needle:
+            return list(range(self.rows))
+        if self.SEPARATOR in needle:
+            return []
+        if numpy is not None:
+            return self._search_numpy(needle)
+        return self._search_find(needle)
+
+    def _search_find(self, needle):
+        """Find every match with bytes.find, one record at a time."""
+        rows = []
+        find = self.buffer.find
+        starts = self.starts
+        pos = find(needle)
+        while pos != -1:
+            row = bisect.bisect_right(starts, pos) - 1
+            rows.append(row)
+            # Skip the rest of this record; each row is reported once
+            if row + 1 == self.rows:
+                break
+            pos = find(needle, starts[row + 1])
+        return rows
+
+    def _search_numpy(self, needle):
+        """Find every match with vectorized byte comparisons."""
+        data = self.bytes
+        pattern = numpy.frombuffer(needle, dtype=numpy.uint8)
+        size = len(data) - len(pattern) + 1
+        if size <= 0:
+            return []
+
+        # Candidates are the positions of the needle's rarest byte; every
+        # other byte of the needle is then checked at those positions only
+        anchor = int(numpy.argmin(self.frequency[pattern]))
+        hits = numpy.flatnonzero(
+            data[anchor:anchor + size] == pattern[anchor])
+        for i, byte in enumerate(pattern):
+            if i != anchor and len(hits):
+                hits = hits[data[hits + i] == byte]
+
+        # hits are ascending, so repeated rows are adjacent
+        rows = numpy.searchsorted(self.starts, hits, side='right') - 1
+        if len(rows):
+            rows = rows[numpy.concatenate(([True], rows[1:] != rows[:-1]))]
+        return rows.tolist()
+
+
+class TrigramIndex:
+    """
+    Inverted index mapping each n-gram to the rows that contain it.
+
+    Rows are positions in the sequence of keys the index was built from.
+    Posting lists are kept in row order, so results come back in the same
+    order as a linear scan would return them.
+
+    add() appends a row without rebuilding anything: the key is stored
+    first and the row is then appended to its posting lists, so a search
+    running at the same time never sees a row without its key. Rows added
+    after the index was built are not in the packed scan; short terms
+    check them one by one until the index is rebuilt.
+    """
+
+    def __init__(self, keys, n=NGRAM):
+        self.n = n
+        self.keys = [fold(key) for key in keys]
+        postings = defaultdict(list)
+        for row, key in enumerate(self.keys):
+            for gram in ngrams(key, n):
+                postings[gram].append(row)
+        self.postings = dict(postings)
+        self.scan = PackedScan(self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key):
+        """Append key as the next row and return that row."""
+        key = fold(key)
+        row = len(self.keys)
+        self.keys.append(key)
+        postings = self.postings
+        for gram in ngrams(key, self.n):
+            rows = postings.get(gram)
+            if rows is None:
+                postings[gram] = [row]
+            else:
+                rows.append(row)
+        return row
+
+    def candidates(self, term):
+        """
+        Return the posting list of the rarest n-gram in term.
+
+        Every row containing term must appear in this list. Verifying each
+        candidate against its stored key is as cheap as probing another
+        posting list, so the remaining lists are never intersected.
+        """
+        grams = ngrams(term, self.n)
+        rarest = min((self.postings.get(gram, ()) for gram in grams), key=len)
+        return rarest
+
+    def search(self, term, within=None):
+        """
+        Return the rows whose key contains term, in row order.
+
+        If within is given, only those rows are checked. Callers pass the
+        result of an earlier term contained in this one, since no row
+        outside it can match.
+        """
+        term = fold(term)
+        keys = self.keys
+
+        if within is not None:
+            return [row for row in within if term in keys[row]]
+
+        # Terms shorter than one n-gram cannot use the postings
+        if len(term) < self.n:
+            # reindex() may swap the scan; use one for both parts
+            scan = self.scan
+            rows = scan.search(term)
+            rows += [row for row in range(scan.rows, len(keys))
+                     if term in keys[row]]
+            return rows
+
+        return [row for row in self.candidates(term) if term in keys[row]]
+
+
+# Fields a query term can be scoped to, as in "email:corp.net"
+FIELDS = ('fname', 'lname', 'email')
+
+# field:term, field:"quoted phrase", "quoted phrase" or a bare term
+TOKEN = re.compile(r'(?:(\w+):)?(?:"([^"]*)"?|(\S*))')
+
+
+def parse_query(text):
+    """
+    Split a query into folded (field, term) pairs, all of which must
+    match. field is None for terms matching anywhere in the user's key.
+    A prefix that is not a known field stays part of the term, so "12:30"
+    is a plain term.
+    """
+    terms = []
+    for match in TOKEN.finditer(text or ''):
+        field, phrase, word = match.groups()
+        term = phrase if phrase is not None else word
+        if field is not None and field.lower() not in FIELDS:
+            field, term = None, match.group(0).replace('"', '')
+        if term:
+            terms.append((field and field.lower(), fold(term)))
+    return terms
+
+
+def refines(terms, previous):
+    """
+    Return True if every row matching terms also matches previous, i.e.
+    each earlier term is contained in a new term on the same field (or
+    the earlier term was not scoped to a field).
+    """
+    return all(any(term in new_term and field in (None, new_field)
+                   for new_field, new_term in terms)
+               for field, term in previous)
+
+
+def intersect(lists):
+    """
+    Return the rows found in every sorted list, in row order.
+
+    Lists are visited smallest first; each surviving row is looked up in
+    the next list by binary search, so the work depends on the smallest
+    list rather than the largest.
+    """
+    lists = sorted(lists, key=len)
+    rows = list(lists[0])
+    for other in lists[1:]:
+        if not rows:
+            break
+        kept = []
+        lo = 0
+        for row in rows:
+            lo = bisect.bisect_left(other, row, lo)
+            if lo < len(other) and other[lo] == row:
+                kept.append(row)
+        rows = kept
+    return rows
+
+
+def union(lists):
+    """Return the rows found in any sorted list, in row order."""
+    if len(lists) == 1:
+        return lists[0]
+    return sorted(set().union(*lists))
+
+
+def merge_spans(spans):
+    """Sort (start, end) spans, joining those that overlap or touch."""
+    merged = []
+    for start, end in sorted(spans):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def match_spans(terms, values):
+    """
+    Return where terms match values, a dict of folded field values, as
+    {field: [(start, end), ...]}. An unscoped term is marked in every
+    field that contains it. Terms that do not occur (fuzzy matches) have
+    no span.
+    """
+    spans = {}
+    for field, term in terms:
+        for name in FIELDS if field is None else (field,):
+            start = values[name].find(term)
+            if start != -1:
+                spans.setdefault(name, []).append((start, start + len(term)))
+    if len(terms) > 1:
+        spans = {field: merge_spans(found) for field, found in spans.items()}
+    return spans
+
+
+class FieldIndex:
+    """
+    A TrigramIndex per field.
+
+    Scoped terms use their field's index. An unscoped term matches a user
+    when one of the fields contains it, so its candidates are the union of
+    the three fields' candidates; "ndoe" does not find Jane Doe by running
+    from one field into the next. For a query of several terms, the
+    candidate lists of the terms are intersected and the survivors checked
+    against each term, so no term is ever searched on its own.
+    """
+
+    def __init__(self, columns, n=NGRAM):
+        self.n = n
+        self.fields = {field: TrigramIndex(columns[field], n)
+                       for field in FIELDS}
+
+    def __len__(self):
+        # The last field gets each new row last
+        return len(self.fields[FIELDS[-1]])
+
+    def add(self, values):
+        """Append a row of {field: value} to every index; return the row."""
+        for field in FIELDS:
+            row = self.fields[field].add(values[field])
+        return row
+
+    def indexes(self, field):
+        """Return the indexes a term scoped to field (or None) looks in."""
+        if field is None:
+            return [self.fields[name] for name in FIELDS]
+        return [self.fields[field]]
+
+    def search(self, query, within=None):
+        """
+        Return the rows matching every term of query, in row order. If
+        within is given, only those rows are checked.
+        """
+        # add() appends a row field by field; only rows every field holds
+        # already can be checked
+        size = min(len(index.keys) for index in self.fields.values())
+        terms = [(self.indexes(field), term)
+                 for field, term in parse_query(query)]
+        if not terms:
+            return list(range(size)) if within is None else within
+        if len(terms) == 1:
+            # Each field's index finds and checks its own matches
+            indexes, term = terms[0]
+            rows = union([index.search(term, within) for index in indexes])
+            return rows[:bisect.bisect_left(rows, size)]
+
+        lists = [union([index.candidates(term) for index in indexes])
+                 for indexes, term in terms if len(term) >= self.n]
+        if within is not None:
+            lists.append(within)
+        if lists:
+            rows = intersect(lists)
+        else:
+            # Only short terms: scan for the first one
+            indexes, term = terms[0]
+            rows = union([index.search(term) for index in indexes])
+        checks = [([index.keys for index in indexes], term)
+                  for indexes, term in terms]
+        rows = rows[:bisect.bisect_left(rows, size)]
+        return [row for row in rows
+                if all(any(term in keys[row] for keys in columns)
+                       for columns, term in checks)]
+
+    def spans(self, query, rows):
+        """Return match_spans() of query for each row, from the keys."""
+        terms = parse_query(query)
+        fnames, lnames, emails = (self.fields[field].keys
+                                  for field in FIELDS)
+        if len(terms) != 1 or terms[0][0] is not None:
+            return [match_spans(terms, {'fname': fnames[row],
+                                        'lname': lnames[row],
+                                        'email': emails[row]})
+                    for row in rows]
+
+        # A single plain term, the common case: one find per field
+        term = terms[0][1]
+        size = len(term)
+        found = []
+        for row in rows:
+            spans = {}
+            start = fnames[row].find(term)
+            if start != -1:
+                spans['fname'] = [(start, start + size)]
+            start = lnames[row].find(term)
+            if start != -1:
+                spans['lname'] = [(start, start + size)]
+            start = emails[row].find(term)
+            if start != -1:
+                spans['email'] = [(start, start + size)]
+            found.append(spans)
+        return found
+
+
+def edit_distance(a, b):
+    """Return the Levenshtein distance between strings a and b."""
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree of words for nearest-neighbour lookups.
+
+    Each child hangs off its parent under their edit distance. By the
+    triangle inequality, a word within max_distance of the query can only
+    sit below children whose key is within max_distance of the parent's
+    own distance, so most of the tree is never compared against.
+    """
+
+    def __init__(self, words=()):
+        self.root = None
+        for word in words:
+            self.add(word)
+
+    def add(self, word):
+        """Insert word; duplicates are ignored."""
+        if self.root is None:
+            self.root = (word, {})
+            return
+        node_word, children = self.root
+        while True:
+            distance = edit_distance(word, node_word)
+            if distance == 0:
+                return
+            if distance not in children:
+                children[distance] = (word, {})
+                return
+            node_word, children = children[distance]
+
+    def search(self, word, max_distance):
+        """Return (distance, word) pairs within max_distance of word."""
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node_word, children = stack.pop()
+            distance = edit_distance(word, node_word)
+            if distance <= max_distance:
+                found.append((distance, node_word))
+            low, high = distance - max_distance, distance + max_distance
+            # list() copies the children in one step, so add() may run
+            # in another thread meanwhile
+            stack.extend(child for key, child in list(children.items())
+                         if low <= key <= high)
+        return found
+
+
+# Fuzzy matches rank after every exact tier of relevance()
+FUZZY_SCORE = 5
+
+# A run of letters (no digits or underscores)
+WORD = re.compile(r'[^\W\d_]+')
+
+
+def words_of(fname, lname, email):
+    """
+    Return the folded words a user could be looked up by: the names and
+    the runs of letters in the email's local part (digits are dropped, so
+    "jsmith42" and "jsmith7" share one word).
+    """
+    local = email.split('@', 1)[0]
+    return set(WORD.findall(fold(' '.join((fname, lname, local)))))
+
+
+class FuzzyIndex:
+    """
+    Typo-tolerant lookup of users by name or email words.
+
+    Distinct words go into a BKTree, and each word maps to the rows that
+    contain it. Names repeat a lot, so the tree is far smaller than the
+    user list, and a lookup only compares against part of the tree.
+    """
+
+    def __init__(self, records):
+        rows = defaultdict(list)
+        for row, (fname, lname, email) in enumerate(records):
+            for word in words_of(fname, lname, email):
+                rows[word].append(row)
+        self.rows = dict(rows)
+        self.tree = BKTree(self.rows)
+
+    def add(self, row, fname, lname, email):
+        """Make row findable by its words; new words join the tree."""
+        for word in words_of(fname, lname, email):
+            rows = self.rows.get(word)
+            if rows is None:
+                # Rows first, so a search that finds the word has its rows
+                self.rows[word] = [row]
+                self.tree.add(word)
+            else:
+                rows.append(row)
+
+    @staticmethod
+    def max_distance(term):
+        """Allow one typo in short terms and two in longer ones."""
+        return 1 if len(term) <= 4 else 2
+
+    def search(self, term):
+        """Return (score, row) pairs for words near term, best first."""
+        term = fold(term)
+        best = {}
+        for distance, word in self.tree.search(term, self.max_distance(term)):
+            for row in self.rows[word]:
+                best[row] = min(best.get(row, distance), distance)
+        return sorted((FUZZY_SCORE + distance, row)
+                      for row, distance in best.items())
+
+
+def relevance(term, fname, lname, email):
+    """
+    Rank how well a matching user fits term; lower is better.
+
+    All arguments are expected to be folded already.
+    """
+    if fname.startswith(term) or lname.startswith(term):
+        return 0
+    if term in fname or term in lname:
+        return 1
+    if email.startswith(term):
+        return 2
+    if term in email:
+        return 3
+    # No single field contains term
+    return 4
+
+
+class Superseded(Exception):
+    """Raised at a checkpoint once a newer query from the client arrived."""
+
+
+def checkpointed(items, cancelled, every=1024):
+    """Yield items, raising Superseded if cancelled() every so often."""
+    for i, item in enumerate(items):
+        if i % every == 0 and cancelled():
+            raise Superseded()
+        yield item
+
+
+def top_ranked(rows, score, limit, after=None, cancelled=None):
+    """
+    Return the limit best (score, row) pairs, best first.
+
+    heapq.nsmallest keeps a heap of at most limit items, so ranking costs
+    O(matches x log limit) instead of sorting every match. Passing the last
+    pair of the previous page as after returns the next page. If cancelled
+    is given, it is polled while ranking and Superseded stops the work.
+    """
+    if cancelled is not None:
+        rows = checkpointed(rows, cancelled)
+    ranked = ((score(row), row) for row in rows)
+    if after is not None:
+        ranked = (pair for pair in ranked if pair > after)
+    return heapq.nsmallest(limit, ranked)
+
+
+class ColumnOrder:
+    """
+    The rows of one column sorted by value, ties by row, computed once.
+
+    ordered() returns a set of rows in that order without sorting it: the
+    permutation is walked and only rows in the set are kept, which is
+    linear and stops as soon as the caller has read enough rows. Sets much
+    smaller than the column are cheaper to sort directly. values may grow
+    after the permutation was built; rows added since then are sorted on
+    their own and merged in. size limits the permutation to the first rows
+    of values.
+    """
+
+    # Walk the permutation for sets of at least 1/WALK_RATIO of the rows
+    WALK_RATIO = 16
+
+    def __init__(self, values, size=None):
+        self.values = values
+        size = len(values) if size is None else size
+        self.order = array('q', sorted(range(size), key=values.__getitem__))
+
+    def __len__(self):
+        return len(self.order)
+
+    def key(self, row):
+        return self.values[row], row
+
+    def ordered(self, rows, end, descending=False):
+        """
+        Return an iterator over rows (None: every row) in column order,
+        leaving out rows from end on.
+        """
+        size = len(self.order)
+        if rows is not None and len(rows) * self.WALK_RATIO < size:
+            return iter(sorted((row for row in rows if row < end),
+                               key=self.key, reverse=descending))
+        walk = reversed(self.order) if descending else iter(self.order)
+        if rows is None:
+            added = range(size, end)
+        else:
+            members = set(rows)
+            walk = (row for row in walk if row in members)
+            added = [row for row in rows if size <= row < end]
+        if not added:
+            return walk
+        added = sorted(added, key=self.key, reverse=descending)
+        return heapq.merge(walk, added, key=self.key, reverse=descending)
+
+
+class QueryCache:
+    """
+    Bounded per-client cache of each client's last query and its rows.
+
+    With a debounced search box, the next query from a client usually
+    extends the previous one. A query whose terms contain the cached terms
+    (see refines()) can only match a subset of the cached rows, so only
+    those rows are checked.
+    Clients are evicted least recently used first once maxsize is reached.
+    """
+
+    def __init__(self, index, maxsize=1024):
+        self.index = index
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def search(self, client, query, index=None):
+        """
+        Return the rows matching query, narrowing client's last result.
+
+        index defaults to the one the cache was made for; pass a snapshot
+        of it to search a fixed version. Results are only narrowed from an
+        earlier result of the same version, since rows may have been added
+        or renumbered since.
+        """
+        index = self.index if index is None else index
+        version = getattr(index, 'version', None)
+        terms = parse_query(query)
+        with self.lock:
+            entry = self.entries.get(client)
+
+        current = entry is not None and entry[0] == version
+        if current and refines(terms, entry[1]):
+            _, last_terms, last_rows = entry
+            if last_terms == terms:
+                rows = last_rows
+            else:
+                rows = index.search(query, within=last_rows)
+            hit = True
+        else:
+            rows = index.search(query)
+            hit = False
+
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.entries[client] = (version, terms, rows)
+            self.entries.move_to_end(client)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return rows
+
+    def hit_rate(self):
+        """Return the fraction of searches served from a cached result."""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class RequestSequencer:
+    """
+    Track the newest search request of each client.
+
+    The browser numbers its requests; a request is superseded as soon as
+    one with a higher number arrives from the same client. A client is
+    any hashable key; the app uses one per page load, since a reloaded
+    page numbers its requests from 1 again. Searches poll
+    superseded() at checkpoints and give up early, since the browser will
+    only show the newest result anyway. Clients are evicted least recently
+    used first once maxsize is reached.
+    """
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.latest = OrderedDict()
+        self.lock = threading.Lock()
+        self.completed = 0
+        self.abandoned = 0
+
+    def start(self, client, seq):
+        """Register request seq; False if a newer one already arrived."""
+        with self.lock:
+            if seq < self.latest.get(client, seq):
+                self.abandoned += 1
+                return False
+            self.latest[client] = seq
+            self.latest.move_to_end(client)
+            while len(self.latest) > self.maxsize:
+                self.latest.popitem(last=False)
+            return True
+
+    def superseded(self, client, seq):
+        """Return True once a newer request than seq arrived from client."""
+        return self.latest.get(client, seq) > seq
+
+    def finish(self, completed):
+        """Count a started request as completed or abandoned."""
+        with self.lock:
+            if completed:
+                self.completed += 1
+            else:
+                self.abandoned += 1
+
+
+class LatencyHistogram:
+    """
+    HDR-style histogram of latencies with a bounded relative error.
+
+    Latencies are counted in whole microseconds. Each power-of-two range
+    is split into 2 ** (PRECISION - 1) equal buckets, so a bucket is never
+    wider than 1/64 of the values it holds, whether they are microseconds
+    or minutes. Only buckets that were hit are stored.
+    """
+
+    PRECISION = 7
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.total = 0
+        self.max = 0
+
+    def record(self, seconds):
+        """Count one latency, given in seconds."""
+        value = int(seconds * 1000000)
+        shift = max(value.bit_length() - self.PRECISION, 0)
+        self.counts[value >> shift << shift] += 1
+        self.total += 1
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction):
+        """
+        Return the latency in milliseconds that fraction of the recorded
+        ones do not exceed: the upper end of the bucket that holds it.
+        """
+        if not self.total:
+            return 0.0
+        rank = fraction * self.total
+        seen = 0
+        for start in sorted(self.counts):
+            seen += self.counts[start]
+            if seen >= rank:
+                width = 1 << max(start.bit_length() - self.PRECISION, 0)
+                return min(start + width - 1, self.max) / 1000
+        return self.max / 1000
+
+    def summary(self):
+        """Return the count and common percentiles, in milliseconds."""
+        return {'count': self.total, 'p50': self.percentile(0.5),
+                'p90': self.percentile(0.9), 'p99': self.percentile(0.99),
+                'p999': self.percentile(0.999), 'max': self.max / 1000}
+
+
+class QueryLog:
+    """
+    Bounded log of how often each query ran and how long it took.
+
+    Every query keeps a LatencyHistogram; so does the log as a whole.
+    Queries are evicted least recently used first once maxsize is
+    reached, so one-off queries do not push out the frequent ones for
+    long.
+    """
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.queries = OrderedDict()
+        self.overall = LatencyHistogram()
+        self.lock = threading.Lock()
+
+    def record(self, query, seconds):
+        """Log one run of query that took seconds."""
+        with self.lock:
+            histogram = self.queries.get(query)
+            if histogram is None:
+                histogram = self.queries[query] = LatencyHistogram()
+                while len(self.queries) > self.maxsize:
+                    self.queries.popitem(last=False)
+            else:
+                self.queries.move_to_end(query)
+            histogram.record(seconds)
+            self.overall.record(seconds)
+
+    def top(self, n):
+        """Return the n most frequent queries, most frequent first."""
+        with self.lock:
+            counts = [(histogram.total, query)
+                      for query, histogram in self.queries.items()]
+        return [query for _, query in heapq.nlargest(n, counts)]
+
+    def stats(self, n):
+        """
+        Return the overall latency summary plus the n most frequent and
+        the n slowest (by p99) queries, each with its own summary.
+        """
+        with self.lock:
+            overall = self.overall.summary()
+            queries = [dict(histogram.summary(), query=query)
+                       for query, histogram in self.queries.items()]
+        return {'latency_ms': overall,
+                'frequent': heapq.nlargest(n, queries,
+                                           key=lambda q: q['count']),
+                'slowest': heapq.nlargest(n, queries,
+                                          key=lambda q: q['p99'])}
+
+
+class HotQueries:
+    """
+    Precomputed results of the most frequent queries.
+
+    refresh() asks the QueryLog for its top queries and computes the
+    result of each one against a store snapshot, unless the result for
+    that store and version is already there. A write changes the store's
+    version, so the next refresh recomputes everything, and get() never
+    returns a result of another version in the meantime. start() runs
+    refresh() in a background thread.
+    """
+
+    def __init__(self, log, compute, top=20):
+        self.log = log
+        self.compute = compute
+        self.top = top
+        self.results = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, query, store, version):
+        """Return the precomputed result of query, or None."""
+        entry = self.results.get(query)
+        if entry is None or entry[:2] != (store, version):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[2]
+
+    def refresh(self, store):
+        """Precompute the top queries for the current version of store."""
+        snapshot = store.snapshot()
+        version = snapshot.version
+        queries = self.log.top(self.top)
+        results = {}
+        for query in queries:
+            entry = self.results.get(query)
+            if entry is None or entry[:2] != (store, version):
+                entry = (store, version, self.compute(snapshot, query))
+            results[query] = entry
+        # Swapped whole, so get() never sees a half-refreshed dict
+        self.results = results
+
+    def start(self, get_store, interval=1.0):
+        """Refresh against get_store() every interval seconds, forever."""
+        def run():
+            while True:
+                self.refresh(get_store())
+                time.sleep(interval)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,1025 @@
+"""
+User stores for the ACTIVESEARCH example.
+
+/search/ talks to a user store instead of a global list, so the users can
+live in process memory (MemoryUserStore, the default) or in an SQLite file
+shared by every worker process (SQLiteUserStore).
+
+ShardedUserStore splits the users across worker processes, so searches
+are not limited to the one core the GIL allows a process.
+
+Every store identifies users by an integer row. Rows only have to be
+ordered; they are not necessarily the same as the user ids. Stores take
+queries in the syntax of searchindex.parse_query().
+"""
+
+import csv
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import threading
+from array import array
+from collections import OrderedDict
+
+from searchindex import (FIELDS, ColumnOrder, FieldIndex, FuzzyIndex,
+                         PackedScan, Superseded, fold, match_spans,
+                         parse_query, relevance, top_ranked, unfold_spans)
+
+# Columns results can be sorted by
+SORT_COLUMNS = ('id',) + FIELDS
+
+
+class User:
+    """Simple user class for demonstration purposes."""
+    id = 0
+    id_lock = threading.Lock()
+
+    def __init__(self, fname, lname, email, id=None):
+        if id is None:
+            # Two threads must never receive the same id
+            with User.id_lock:
+                User.id += 1
+                id = User.id
+        self.id = id
+        self.__dict__.update(fname=fname, lname=lname, email=email)
+        self.key = fold(fname + lname + email)
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        # Keep the folded search key in step with the fields it is made of
+        if name in FIELDS:
+            self.key = fold(self.fname + self.lname + self.email)
+
+    def search(self, word):
+        """Archives user data for the given word across name and email."""
+        if word is None:
+            return False
+        return self.matches(fold(word))
+
+    def matches(self, term):
+        """Return True if the already folded term occurs in the search key."""
+        return term in self.key
+
+
+class UserRow:
+    """Lightweight, read-only view of one user, used for rendering."""
+    __slots__ = ('id', 'fname', 'lname', 'email')
+
+    def __init__(self, id, fname, lname, email):
+        self.id = id
+        self.fname = fname
+        self.lname = lname
+        self.email = email
+
+
+class UserTable:
+    """
+    Column-oriented user storage.
+
+    Instead of one object (and one instance __dict__) per user, each field
+    is a column: ids in an array of machine integers, names and emails in
+    lists. First and last names are interned, so users sharing a name share
+    one string. Rows are positions in the columns; table[row] builds a
+    UserRow view on demand.
+    """
+
+    def __init__(self):
+        self.ids = array('q')
+        self.fnames = []
+        self.lnames = []
+        self.emails = []
+        self.next_id = 1
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_users(cls, users):
+        """Build a table from objects with id, fname, lname and email."""
+        table = cls()
+        for user in users:
+            table.append(user.fname, user.lname, user.email, id=user.id)
+        return table
+
+    def append(self, fname, lname, email, id=None):
+        """Add a user, allocating the next id if none is given; return row."""
+        with self.lock:
+            if id is None:
+                id = self.next_id
+            self.next_id = max(self.next_id, id + 1)
+            self.ids.append(id)
+            self.fnames.append(sys.intern(fname))
+            self.lnames.append(sys.intern(lname))
+            self.emails.append(email)
+            return len(self.ids) - 1
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, row):
+        return UserRow(self.ids[row], self.fnames[row], self.lnames[row],
+                       self.emails[row])
+
+    def keys(self):
+        """Yield the fname + lname + email search key of every row."""
+        for fname, lname, email in zip(self.fnames, self.lnames,
+                                       self.emails):
+            yield fname + lname + email
+
+
+class UserStore:
+    """Interface shared by every user store."""
+
+    # Changes whenever users are added, updated or deleted
+    version = 0
+
+    # True if search() has to copy its matches from other processes;
+    # callers then ask for count() and ranked pages instead
+    remote = False
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def tag(self):
+        """
+        Return a string naming this store's data in every process that
+        opens it, or None if the data lives in this process only.
+        """
+        return None
+
+    def snapshot(self):
+        """
+        Return a read-only view that stays consistent while other threads
+        write. Stores whose reads are consistent anyway return themselves.
+        """
+        return self
+
+    def add(self, fname, lname, email):
+        """Store a new user with the next free id; return it as a UserRow."""
+        raise NotImplementedError
+
+    def update(self, user_id, fname, lname, email):
+        """Replace the fields of user user_id; KeyError if there is none."""
+        raise NotImplementedError
+
+    def delete(self, user_id):
+        """Remove user user_id; KeyError if there is none."""
+        raise NotImplementedError
+
+    def get(self, row):
+        """
+        Return a view of the user stored at row (id, fname, ...); KeyError
+        if a store without snapshots no longer has it.
+        """
+        raise NotImplementedError
+
+    def page(self, after, limit):
+        """Return up to limit rows following row after (None: the first)."""
+        raise NotImplementedError
+
+    def search(self, query, within=None):
+        """
+        Return the rows matching every term of query, in row order. If
+        within is given, only those rows are checked.
+        """
+        raise NotImplementedError
+
+    def count(self, query):
+        """Return how many users match every term of query."""
+        return len(self.search(query))
+
+    def rank(self, query, rows, limit, after=None, cancelled=None):
+        """
+        Return the limit best (score, row) pairs of rows for query, ranked
+        by its first term. Raises Superseded if cancelled() turns true
+        while ranking.
+        """
+        term = ranking_term(query)
+
+        def score(row):
+            user = self.get(row)
+            return relevance(term, fold(user.fname), fold(user.lname),
+                             fold(user.email))
+
+        return top_ranked(rows, score, limit, after=after,
+                          cancelled=cancelled)
+
+    def sorted_page(self, query, rows, column, offset, limit,
+                    descending=False):
+        """
+        Return up to limit of rows, the matches of query (None: every
+        user), ordered by column (one of SORT_COLUMNS) and then by row,
+        after skipping the first offset of them.
+        """
+        raise NotImplementedError
+
+    def fuzzy(self, term):
+        """
+        Return (score, row) pairs of users with a word close to term, best
+        first. Stores without a fuzzy index return no suggestions.
+        """
+        return []
+
+    def spans(self, query, rows):
+        """
+        Return where query matched each of rows, as one dict per row of
+        {field: [(start, end), ...]} in the characters of the stored field.
+        """
+        terms = parse_query(query)
+        spans = []
+        for row in rows:
+            try:
+                user = self.get(row)
+            except KeyError:
+                spans.append({})
+                continue
+            values = {field: getattr(user, field) for field in FIELDS}
+            found = match_spans(terms, {field: fold(value)
+                                        for field, value in values.items()})
+            spans.append({field: unfold_spans(values[field], field_spans)
+                          for field, field_spans in found.items()})
+        return spans
+
+
+def ranking_term(query):
+    """Return the term results are ranked by: the first one of query."""
+    terms = parse_query(query)
+    return terms[0][1] if terms else ''
+
+
+class MemorySnapshot(UserStore):
+    """
+    Read-only view of a MemoryUserStore as of one version.
+
+    The table and indexes of a store only grow: writes append rows, and
+    deleting a row records a tombstone stamped with the version that
+    deleted it. A snapshot therefore only remembers how many rows existed
+    and its version. Later rows and later tombstones are ignored, so
+    nothing is copied and a search sees the store as it was when the
+    search started.
+
+    orders holds a ColumnOrder per column of SORT_COLUMNS, built with the
+    indexes, so sorted results walk a permutation instead of sorting.
+    """
+
+    def __init__(self, users, index, fuzzy_index, orders, tombstones, size,
+                 removed, version):
+        self.users = users
+        self.index = index
+        self.fuzzy_index = fuzzy_index
+        self.orders = orders
+        self.tombstones = tombstones
+        self.size = size
+        self.removed = removed
+        self.version = version
+
+    def __len__(self):
+        return self.size - self.removed
+
+    def alive(self, row):
+        """Return True if row exists and is not deleted in this version."""
+        deleted = self.tombstones.get(row)
+        return row < self.size and (deleted is None or deleted > self.version)
+
+    def live(self, rows):
+        """Return rows, in order, without rows this version cannot see."""
+        if not self.tombstones and (not rows or max(rows) < self.size):
+            return rows
+        return [row for row in rows if self.alive(row)]
+
+    def get(self, row):
+        return self.users[row]
+
+    def page(self, after, limit):
+        start = 0 if after is None else after + 1
+        if not self.tombstones:
+            return list(range(start, min(start + limit, self.size)))
+        rows = (row for row in range(start, self.size) if self.alive(row))
+        return list(itertools.islice(rows, limit))
+
+    def search(self, query, within=None):
+        return self.live(self.index.search(query, within=within))
+
+    def fuzzy(self, term):
+        return [pair for pair in self.fuzzy_index.search(term)
+                if self.alive(pair[1])]
+
+    def rank(self, query, rows, limit, after=None, cancelled=None):
+        # Score against the folded keys the index already holds
+        term = ranking_term(query)
+        fnames, lnames, emails = (self.index.fields[field].keys
+                                  for field in FIELDS)
+
+        def score(row):
+            return relevance(term, fnames[row], lnames[row], emails[row])
+
+        return top_ranked(rows, score, limit, after=after,
+                          cancelled=cancelled)
+
+    def sorted_page(self, query, rows, column, offset, limit,
+                    descending=False):
+        ordered = self.orders[column].ordered(rows, self.size, descending)
+        if rows is None and self.tombstones:
+            ordered = (row for row in ordered if self.alive(row))
+        return list(itertools.islice(ordered, offset, offset + limit))
+
+    def spans(self, query, rows):
+        columns = {'fname': self.users.fnames, 'lname': self.users.lnames,
+                   'email': self.users.emails}
+        spans = self.index.spans(query, rows)
+        for row, found in zip(rows, spans):
+            for field, field_spans in found.items():
+                found[field] = unfold_spans(columns[field][row], field_spans)
+        return spans
+
+
+class MemoryUserStore(UserStore):
+    """
+    Users kept in a UserTable, searched through a FieldIndex.
+
+    Reads go through snapshot(). Writes are serialized by a lock: they
+    append to the table and indexes (posting lists only gain rows at the
+    end), turn deleted or replaced rows into tombstones and then publish
+    the next MemorySnapshot. An update is a tombstone plus a new row
+    carrying the same user id.
+
+    Tombstones cost time on every search, so once they reach
+    compact_ratio of the rows (and at least compact_min), a background
+    thread rebuilds the table and indexes from the live rows of a
+    snapshot, replays the writes made meanwhile and swaps the result in.
+    Rows are renumbered by the rebuild; user ids are not. Rows appended
+    since the last build are sorted per request when results are sorted
+    by a column, so they count towards the same threshold.
+
+    ingest() streams users in batches, one snapshot per batch, so searches
+    can run on the users imported so far; reindex() catches the packed
+    scans and sort permutations up with the appended rows.
+    """
+
+    compact_ratio = 0.1
+    compact_min = 1000
+
+    def __init__(self, users):
+        self.lock = threading.Lock()
+        self.journal = None
+        self.compactions = 0
+        self.current, self.rows = self._build(users, version=0)
+
+    @staticmethod
+    def _build(users, version):
+        """Index users; return their first snapshot and id -> row map."""
+        index = FieldIndex({'fname': users.fnames, 'lname': users.lnames,
+                            'email': users.emails})
+        fuzzy_index = FuzzyIndex(zip(users.fnames, users.lnames,
+                                     users.emails))
+        orders = {'id': ColumnOrder(users.ids)}
+        for field in FIELDS:
+            orders[field] = ColumnOrder(index.fields[field].keys)
+        snapshot = MemorySnapshot(users, index, fuzzy_index, orders, {},
+                                  len(users), 0, version)
+        return snapshot, {user_id: row for row, user_id in
+                          enumerate(users.ids)}
+
+    def snapshot(self):
+        return self.current
+
+    @property
+    def version(self):
+        return self.current.version
+
+    @property
+    def users(self):
+        return self.current.users
+
+    @property
+    def index(self):
+        return self.current.index
+
+    def __len__(self):
+        return len(self.current)
+
+    def get(self, row):
+        return self.current.get(row)
+
+    def page(self, after, limit):
+        return self.current.page(after, limit)
+
+    def search(self, query, within=None):
+        return self.current.search(query, within=within)
+
+    def fuzzy(self, term):
+        return self.current.fuzzy(term)
+
+    def rank(self, query, rows, limit, after=None, cancelled=None):
+        return self.current.rank(query, rows, limit, after=after,
+                                 cancelled=cancelled)
+
+    def sorted_page(self, query, rows, column, offset, limit,
+                    descending=False):
+        return self.current.sorted_page(query, rows, column, offset, limit,
+                                        descending)
+
+    def spans(self, query, rows):
+        return self.current.spans(query, rows)
+
+    def add(self, fname, lname, email):
+        return self._write('add', None, fname, lname, email)
+
+    def update(self, user_id, fname, lname, email):
+        return self._write('update', user_id, fname, lname, email)
+
+    def delete(self, user_id):
+        self._write('delete', user_id)
+
+    def _write(self, kind, user_id, *fields):
+        """Apply one write, publish the new snapshot and return its row."""
+        with self.lock:
+            snapshot, rows = self.current, self.rows
+            written, row = self._apply(snapshot, rows, kind, user_id, fields)
+            self.current = written
+            if row is not None:
+                user_id = snapshot.users.ids[row]
+            if self.journal is not None:
+                self.journal.append((kind, user_id, fields))
+            threshold = max(self.compact_min,
+                            self.compact_ratio * snapshot.size)
+            appended = written.size - len(written.orders['id'])
+            compact = max(len(snapshot.tombstones), appended) >= threshold
+            compact = compact and self.journal is None
+        if compact:
+            threading.Thread(target=self.compact, daemon=True).start()
+        return None if row is None else written.get(row)
+
+    @staticmethod
+    def _apply(snapshot, rows, kind, user_id, fields):
+        """
+        Apply an 'add', 'update' or 'delete' to the table and indexes of
+        snapshot. Returns the next snapshot and the new row, if any.
+        """
+        version = snapshot.version + 1
+        removed = snapshot.removed
+        if kind != 'add':
+            # Unknown ids raise KeyError before anything has changed
+            snapshot.tombstones[rows.pop(user_id)] = version
+            removed += 1
+        row = None
+        if kind != 'delete':
+            row = MemoryUserStore._append(snapshot, rows, user_id, fields)
+        return MemorySnapshot(snapshot.users, snapshot.index,
+                              snapshot.fuzzy_index, snapshot.orders,
+                              snapshot.tombstones, len(snapshot.users),
+                              removed, version), row
+
+    @staticmethod
+    def _append(snapshot, rows, user_id, fields):
+        """Add a user to the table and indexes of snapshot; return row."""
+        fname, lname, email = fields
+        row = snapshot.users.append(fname, lname, email, id=user_id)
+        snapshot.index.add({'fname': fname, 'lname': lname, 'email': email})
+        snapshot.fuzzy_index.add(row, fname, lname, email)
+        rows[snapshot.users.ids[row]] = row
+        return row
+
+    def ingest(self, records, batch=10000, progress=None):
+        """
+        Append (fname, lname, email) records in batches; return the number
+        of records added. Each batch is one write and one new snapshot.
+        progress(count) is called after every batch.
+
+        Appended rows are only caught by the packed scans and sort
+        permutations once reindex() runs, so it runs whenever they have
+        doubled in size (linear in total) and at the end.
+        """
+        records = iter(records)
+        count = 0
+        for chunk in iter(lambda: list(itertools.islice(records, batch)),
+                          []):
+            with self.lock:
+                snapshot = self.current
+                for fields in chunk:
+                    row = self._append(snapshot, self.rows, None, fields)
+                    if self.journal is not None:
+                        self.journal.append(
+                            ('add', snapshot.users.ids[row], fields))
+                self.current = MemorySnapshot(
+                    snapshot.users, snapshot.index, snapshot.fuzzy_index,
+                    snapshot.orders, snapshot.tombstones,
+                    len(snapshot.users), snapshot.removed,
+                    snapshot.version + 1)
+            count += len(chunk)
+            if progress is not None:
+                progress(count)
+            if self.current.size > 2 * len(self.current.orders['id']):
+                self.reindex()
+        self.reindex()
+        return count
+
+    def reindex(self):
+        """
+        Rebuild the packed scans and sort permutations over every row of
+        the current snapshot. Returns False if a compaction replaced the
+        table meanwhile (it rebuilt them anyway).
+        """
+        snapshot = self.current
+        fields = snapshot.index.fields
+        scans = {field: PackedScan(fields[field].keys[:snapshot.size])
+                 for field in fields}
+        orders = {column: ColumnOrder(order.values, snapshot.size)
+                  for column, order in snapshot.orders.items()}
+        with self.lock:
+            current = self.current
+            if current.users is not snapshot.users:
+                return False
+            # Searches of older snapshots drop the rows they cannot see
+            for field, scan in scans.items():
+                fields[field].scan = scan
+            self.current = MemorySnapshot(
+                current.users, current.index, current.fuzzy_index, orders,
+                current.tombstones, current.size, current.removed,
+                current.version)
+        return True
+
+    def compact(self):
+        """
+        Rebuild the table and indexes without tombstones, in id order.
+        Returns False if another compaction is already running.
+        """
+        with self.lock:
+            if self.journal is not None:
+                return False
+            self.journal = []
+            snapshot = self.current
+
+        # The slow part runs without the lock; writes continue meanwhile
+        # and are journaled
+        ids = snapshot.users.ids
+        live = sorted((row for row in range(snapshot.size)
+                       if snapshot.alive(row)), key=ids.__getitem__)
+        table = UserTable()
+        for row in live:
+            user = snapshot.users[row]
+            table.append(user.fname, user.lname, user.email, id=user.id)
+        table.next_id = max(table.next_id, snapshot.users.next_id)
+        fresh, rows = self._build(table, snapshot.version)
+
+        with self.lock:
+            for kind, user_id, fields in self.journal:
+                fresh, _ = self._apply(fresh, rows, kind, user_id, fields)
+            fresh.version = self.current.version + 1
+            self.current, self.rows = fresh, rows
+            self.journal = None
+            self.compactions += 1
+        return True
+
+
+class Shard:
+    """
+    The users of one ShardedUserStore worker, rows start to start + len.
+
+    Runs inside the worker process and answers in the rows of the whole
+    store. The rows of the last few queries are kept, so ranking right
+    after a search of the same query does not search again.
+    """
+
+    recent_size = 64
+
+    def __init__(self, records, start):
+        table = UserTable()
+        for user_id, fname, lname, email in records:
+            table.append(fname, lname, email, id=user_id)
+        self.store = MemoryUserStore(table)
+        self.start = start
+        self.recent = OrderedDict()
+
+    def matches(self, query):
+        """Return the local rows matching query."""
+        rows = self.recent.pop(query, None)
+        if rows is None:
+            rows = self.store.search(query)
+        self.recent[query] = rows
+        if len(self.recent) > self.recent_size:
+            self.recent.popitem(last=False)
+        return rows
+
+    def search(self, query):
+        # An array pickles as one block of machine integers
+        return array('q', [row + self.start for row in self.matches(query)])
+
+    def count(self, query):
+        return len(self.matches(query))
+
+    def rank(self, query, limit, after):
+        if after is not None:
+            after = (after[0], after[1] - self.start)
+        pairs = self.store.rank(query, self.matches(query), limit,
+                                after=after)
+        return [(score, row + self.start) for score, row in pairs]
+
+    def fuzzy(self, term):
+        return [(score, row + self.start)
+                for score, row in self.store.fuzzy(term)]
+
+    def sorted_page(self, query, column, limit, descending):
+        """Return the first limit (sort value, row) pairs of query."""
+        rows = self.matches(query) if query else None
+        page = self.store.sorted_page(query, rows, column, 0, limit,
+                                      descending)
+        values = self.store.snapshot().orders[column].values
+        return [(values[row], row + self.start) for row in page]
+
+
+def serve_shard(conn, records, start):
+    """Worker process: build a Shard, then answer calls until None."""
+    shard = Shard(records, start)
+    conn.send(len(records))
+    for method, args in iter(conn.recv, None):
+        try:
+            result = getattr(shard, method)(*args)
+        except Exception as error:
+            result = error
+        conn.send(result)
+
+
+class ShardedUserStore(UserStore):
+    """
+    Read-only users split into contiguous row ranges, one per worker
+    process.
+
+    Each worker indexes its shard in a MemoryUserStore of its own. A search
+    sends the query to every worker and merges their answers: the match
+    lists are concatenated (shards are in row order) and the ranked pages
+    of each worker are merged by (score, row). While one request waits for
+    a worker, other threads can already use the workers that answered.
+    The table itself stays in this process for rendering.
+
+    The match lists of a broad query are large, so the app only asks for
+    their count() and the ranked or sorted pages, which the shards answer
+    from the rows they keep.
+    """
+
+    remote = True
+
+    def __init__(self, users, shards):
+        self.users = users
+        self.connections = []
+        self.locks = []
+        self.processes = []
+        context = multiprocessing.get_context()
+        bounds = [len(users) * i // shards for i in range(shards + 1)]
+        for start, end in zip(bounds, bounds[1:]):
+            records = list(zip(users.ids[start:end], users.fnames[start:end],
+                               users.lnames[start:end],
+                               users.emails[start:end]))
+            conn, child = context.Pipe()
+            process = context.Process(target=serve_shard,
+                                      args=(child, records, start),
+                                      daemon=True)
+            process.start()
+            self.connections.append(conn)
+            self.locks.append(threading.Lock())
+            self.processes.append(process)
+        # Workers build their indexes in parallel; wait until all are ready
+        for conn in self.connections:
+            conn.recv()
+
+    def close(self):
+        """Stop the worker processes."""
+        for lock, conn in zip(self.locks, self.connections):
+            with lock:
+                conn.send(None)
+        for process in self.processes:
+            process.join()
+
+    def call(self, method, *args):
+        """Call method of every shard; return their results in order."""
+        sent = []
+        try:
+            for lock, conn in zip(self.locks, self.connections):
+                lock.acquire()
+                sent.append(lock)
+                conn.send((method, args))
+            results = []
+            for conn in self.connections:
+                results.append(conn.recv())
+                sent.pop(0).release()
+        finally:
+            for lock in sent:
+                lock.release()
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def __len__(self):
+        return len(self.users)
+
+    def get(self, row):
+        return self.users[row]
+
+    def page(self, after, limit):
+        start = 0 if after is None else after + 1
+        return list(range(start, min(start + limit, len(self.users))))
+
+    def search(self, query, within=None):
+        # within only narrows the work; the shards keep recent rows anyway
+        rows = []
+        for part in self.call('search', query):
+            rows.extend(part)
+        return rows
+
+    def count(self, query):
+        return sum(self.call('count', query))
+
+    def rank(self, query, rows, limit, after=None, cancelled=None):
+        """
+        Return the limit best (score, row) pairs for query. Like the
+        SQLite store, the shards rank their own matches of query, so rows
+        is not sent to them.
+        """
+        if cancelled is not None and cancelled():
+            raise Superseded()
+        pages = self.call('rank', query, limit, after)
+        return list(itertools.islice(heapq.merge(*pages), limit))
+
+    def fuzzy(self, term):
+        return sorted(pair for pairs in self.call('fuzzy', term)
+                      for pair in pairs)
+
+    def sorted_page(self, query, rows, column, offset, limit,
+                    descending=False):
+        # Every shard returns its first offset + limit rows with their
+        # sort values; merging them gives the first ones of the store
+        pages = self.call('sorted_page', query, column, offset + limit,
+                          descending)
+        merged = heapq.merge(*pages, reverse=descending)
+        return [row for _, row in itertools.islice(merged, offset,
+                                                   offset + limit)]
+
+
+class SQLiteUserStore(UserStore):
+    """
+    Users kept in an SQLite FTS5 table with the trigram tokenizer.
+
+    The table indexes each folded field on its own, like the in-memory
+    index: scoped terms look in their field's column and unscoped terms in
+    all three, so substring queries are answered from the trigram postings
+    (SQLite 3.34 or newer). The fields as entered are stored next to them,
+    unindexed.
+    Each thread opens its own connection the first time it touches the
+    store and reuses it afterwards. Databases created before the per-field
+    key columns must be imported again.
+    """
+
+    # SQLite virtual machine instructions between cancellation checks
+    progress_steps = 10000
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.connect().executescript("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS users USING fts5(
+                fname_key, lname_key, email_key,
+                fname UNINDEXED, lname UNINDEXED, email UNINDEXED,
+                tokenize='trigram');
+        """)
+
+    def connect(self):
+        """Return this thread's connection, opening it on first use."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path)
+            self.local.conn = conn
+        return conn
+
+    def tag(self):
+        # Every worker opening this file names it alike; an import to a
+        # new file gets a new inode
+        info = os.stat(self.path)
+        return '{}:{}:{}'.format(os.path.realpath(self.path), info.st_dev,
+                                 info.st_ino)
+
+    def __len__(self):
+        return self.connect().execute(
+            "SELECT count(*) FROM users").fetchone()[0]
+
+    def get(self, row):
+        # There is no snapshot: a row found by a search may be deleted
+        # before it is read
+        found = self.connect().execute(
+            "SELECT fname, lname, email FROM users WHERE rowid = ?",
+            (row,)).fetchone()
+        if found is None:
+            raise KeyError(row)
+        return UserRow(row, *found)
+
+    def page(self, after, limit):
+        cursor = self.connect().execute(
+            "SELECT rowid FROM users WHERE rowid > ? ORDER BY rowid LIMIT ?",
+            (-1 if after is None else after, limit))
+        return [row for row, in cursor]
+
+    @staticmethod
+    def _where(query):
+        """Return the WHERE clause and named parameters matching query."""
+        phrases = []
+        clauses = []
+        params = {}
+        for i, (field, term) in enumerate(parse_query(query)):
+            # An unscoped term must occur within one of the fields
+            columns = [name + '_key' for name in
+                       (FIELDS if field is None else (field,))]
+            if len(term) >= 3:
+                # A quoted phrase of consecutive trigrams is a substring
+                # match within one column; {columns}: limits it to those
+                # columns' postings
+                phrases.append('{{{}}}: "{}"'.format(
+                    ' '.join(columns), term.replace('"', '""')))
+            else:
+                # Shorter terms have no trigram to look up; scan the columns
+                clauses.append('({})'.format(' OR '.join(
+                    "instr({}, :q{}) > 0".format(column, i)
+                    for column in columns)))
+                params['q{}'.format(i)] = term
+        if phrases:
+            clauses.insert(0, "users MATCH :match")
+            params['match'] = ' AND '.join(phrases)
+        return ' AND '.join(clauses) or '1', params
+
+    def search(self, query, within=None):
+        where, params = self._where(query)
+        cursor = self.connect().execute(
+            "SELECT rowid FROM users WHERE {} ORDER BY rowid".format(where),
+            params)
+        rows = [row for row, in cursor]
+        if within is not None:
+            keep = set(within)
+            rows = [row for row in rows if row in keep]
+        return rows
+
+    def rank(self, query, rows, limit, after=None, cancelled=None):
+        """
+        Return the limit best (score, row) pairs for query.
+
+        rows is always the full match list of query, so SQLite scores and
+        orders the matches itself with the same rules as relevance() and
+        only hands back the requested page. cancelled() is polled from an
+        SQLite progress handler, which interrupts the query.
+        """
+        where, params = self._where(query)
+        term = ranking_term(query)
+        after = after or (-1, -1)
+        params.update({'n': len(term), 't': term, 'score': after[0],
+                       'row': after[1], 'limit': limit})
+        conn = self.connect()
+        if cancelled is not None:
+            conn.set_progress_handler(cancelled, self.progress_steps)
+        try:
+            return conn.execute("""
+                SELECT score, rowid FROM (
+                    SELECT rowid, CASE
+                        WHEN substr(fname_key, 1, :n) = :t
+                          OR substr(lname_key, 1, :n) = :t THEN 0
+                        WHEN instr(fname_key, :t) OR instr(lname_key, :t)
+                          THEN 1
+                        WHEN substr(email_key, 1, :n) = :t THEN 2
+                        WHEN instr(email_key, :t) THEN 3
+                        ELSE 4 END AS score
+                    FROM users WHERE {}
+                )
+                WHERE (score, rowid) > (:score, :row)
+                ORDER BY score, rowid LIMIT :limit
+            """.format(where), params).fetchall()
+        except sqlite3.OperationalError:
+            if cancelled is not None and cancelled():
+                raise Superseded()
+            raise
+        finally:
+            conn.set_progress_handler(None, 0)
+
+    def sorted_page(self, query, rows, column, offset, limit,
+                    descending=False):
+        """
+        Like MemorySnapshot.sorted_page(), but SQLite sorts the matches
+        itself: FTS5 tables cannot carry an index on a column.
+        """
+        where, params = self._where(query or '')
+        order = 'rowid' if column == 'id' else column + '_key'
+        direction = 'DESC' if descending else 'ASC'
+        params.update({'limit': limit, 'offset': offset})
+        cursor = self.connect().execute(
+            "SELECT rowid FROM users WHERE {} ORDER BY {} {}, rowid {} "
+            "LIMIT :limit OFFSET :offset".format(where, order, direction,
+                                                 direction), params)
+        return [row for row, in cursor]
+
+    def ingest(self, records, batch=10000, progress=None):
+        """
+        Append (fname, lname, email) records in batches of one transaction
+        each. Returns the number of records written; progress(count) is
+        called after every batch.
+        """
+        conn = self.connect()
+        count = 0
+        chunk = []
+        for record in records:
+            chunk.append(self._columns(*record))
+            if len(chunk) == batch:
+                count += self._insert(conn, chunk)
+                chunk = []
+                if progress is not None:
+                    progress(count)
+        if chunk:
+            count += self._insert(conn, chunk)
+            if progress is not None:
+                progress(count)
+        return count
+
+    @staticmethod
+    def _columns(fname, lname, email):
+        """Return the column values stored for one user."""
+        return (fold(fname), fold(lname), fold(email), fname, lname, email)
+
+    @staticmethod
+    def _bump_version(conn):
+        """Count a change; runs inside the writing transaction."""
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        conn.execute("PRAGMA user_version = {:d}".format(version + 1))
+
+    @classmethod
+    def _insert(cls, conn, chunk):
+        with conn:
+            conn.executemany(
+                "INSERT INTO users (fname_key, lname_key, email_key, "
+                "fname, lname, email) VALUES (?, ?, ?, ?, ?, ?)", chunk)
+            cls._bump_version(conn)
+        return len(chunk)
+
+    @property
+    def version(self):
+        # Kept in the database header, so every process sees the changes
+        return self.connect().execute("PRAGMA user_version").fetchone()[0]
+
+    def add(self, fname, lname, email):
+        conn = self.connect()
+        with conn:
+            cursor = conn.execute(
+                "INSERT INTO users (fname_key, lname_key, email_key, "
+                "fname, lname, email) VALUES (?, ?, ?, ?, ?, ?)",
+                self._columns(fname, lname, email))
+            self._bump_version(conn)
+        return self.get(cursor.lastrowid)
+
+    def update(self, user_id, fname, lname, email):
+        # FTS5 updates its postings for the changed columns itself
+        conn = self.connect()
+        with conn:
+            cursor = conn.execute(
+                "UPDATE users SET fname_key = ?, lname_key = ?, "
+                "email_key = ?, fname = ?, lname = ?, email = ? "
+                "WHERE rowid = ?",
+                self._columns(fname, lname, email) + (user_id,))
+            if cursor.rowcount == 0:
+                raise KeyError(user_id)
+            self._bump_version(conn)
+        return self.get(user_id)
+
+    def delete(self, user_id):
+        conn = self.connect()
+        with conn:
+            cursor = conn.execute("DELETE FROM users WHERE rowid = ?",
+                                  (user_id,))
+            if cursor.rowcount == 0:
+                raise KeyError(user_id)
+            self._bump_version(conn)
+
+
+def read_user_csv(csvfile):
+    """Yield (fname, lname, email) rows from a CSV file, skipping a header."""
+    for record in csv.reader(csvfile):
+        if len(record) != 3 or record == ['fname', 'lname', 'email']:
+            continue
+        yield tuple(record)
+
+
+def read_user_jsonl(jsonfile):
+    """
+    Yield (fname, lname, email) rows from JSON Lines, one object with
+    those keys per line. Blank lines and incomplete objects are skipped.
+    """
+    for line in jsonfile:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        try:
+            yield record['fname'], record['lname'], record['email']
+        except (KeyError, TypeError):
+            continue
+
+
+def read_user_file(userfile):
+    """Yield the rows of a .jsonl file, or of a CSV file otherwise."""
+    if getattr(userfile, 'name', '').endswith('.jsonl'):
+        return read_user_jsonl(userfile)
+    return read_user_csv(userfile)
@@ -3,6 +3,47 @@ import flask
 app = flask.Flask(__name__)
 
 
+# The three selects /callback/ returns; compiled below, not per request
+FRAGMENTS = {
+    'selects': """
+        <div class="col-md-4">
+            <select name="pos1" hx-post="/callback/1" hx-target="#idx_row"
+                    class="form-select">
+                <option value="0" {{ s1[0] }}>&lt;None&gt;</option>
+                <option value="1" {{ s1[1] }}>1</option>
+                <option value="2" {{ s1[2] }}>2</option>
+                <option value="3" {{ s1[3] }}>3</option>
+            </select>
+        </div>
+        <div class="col-md-4">
+            <select name="pos2" hx-post="/callback/2" hx-target="#idx_row"
+                    class="form-select">
+                <option value="0" {{ s2[0] }}>&lt;None&gt;</option>
+                <option value="1" {{ s2[1] }}>1</option>
+                <option value="2" {{ s2[2] }}>2</option>
+                <option value="3" {{ s2[3] }}>3</option>
+            </select>
+        </div>
+        <div class="col-md-4">
+            <select name="pos3" hx-post="/callback/3" hx-target="#idx_row"
+                    class="form-select">
+                <option value="0" {{ s3[0] }}>&lt;None&gt;</option>
+                <option value="1" {{ s3[1] }}>1</option>
+                <option value="2" {{ s3[2] }}>2</option>
+                <option value="3" {{ s3[3] }}>3</option>
+            </select>
+        </div>
+    """,
+}
+fragments = {name: app.jinja_env.from_string(source)
+             for name, source in FRAGMENTS.items()}
+
+
+def render_fragment(name, **context):
+    """Render a precompiled inline fragment by name."""
+    return fragments[name].render(**context)
+
+
 @app.route('/')
 def index():
     """Main page that displays the three interdependent select dropdowns."""
@@ -72,35 +113,7 @@ def callback(selectnum):
     s3 = get_selected_states(sel3)
 
     # Return updated HTML for all three dropdowns
-    return flask.render_template_string("""
-        <div class="col-md-4">
-            <select name="pos1" hx-post="/callback/1" hx-target="#idx_row"
-                    class="form-select">
-                <option value="0" {{ s1[0] }}>&lt;None&gt;</option>
-                <option value="1" {{ s1[1] }}>1</option>
-                <option value="2" {{ s1[2] }}>2</option>
-                <option value="3" {{ s1[3] }}>3</option>
-            </select>
-        </div>
-        <div class="col-md-4">
-            <select name="pos2" hx-post="/callback/2" hx-target="#idx_row"
-                    class="form-select">
-                <option value="0" {{ s2[0] }}>&lt;None&gt;</option>
-                <option value="1" {{ s2[1] }}>1</option>
-                <option value="2" {{ s2[2] }}>2</option>
-                <option value="3" {{ s2[3] }}>3</option>
-            </select>
-        </div>
-        <div class="col-md-4">
-            <select name="pos3" hx-post="/callback/3" hx-target="#idx_row"
-                    class="form-select">
-                <option value="0" {{ s3[0] }}>&lt;None&gt;</option>
-                <option value="1" {{ s3[1] }}>1</option>
-                <option value="2" {{ s3[2] }}>2</option>
-                <option value="3" {{ s3[3] }}>3</option>
-            </select>
-        </div>
-    """, s1=s1, s2=s2, s3=s3)
+    return render_fragment('selects', s1=s1, s2=s2, s3=s3)
 
 
 if __name__ == '__main__':
@@ -9,7 +9,8 @@ Tests the three interdependent dropdowns with HTMX patterns:
 """
 
 import unittest
-from myapp import app, get_selected_states
+from myapp import (app, get_selected_states, fragments,
+                   render_fragment)
 
 
 class TestPly3(unittest.TestCase):
@@ -148,6 +149,18 @@ class TestPly3(unittest.TestCase):
         # Should contain option text
         self.assertIn('&lt;None&gt;', html)  # HTML entity for <None>
 
+    def test_selects_fragment(self):
+        """Test that each select of the fragment shows its own choice."""
+        self.assertEqual(set(fragments), {'selects'})
+        html = render_fragment('selects', s1=get_selected_states(1),
+                               s2=get_selected_states(0),
+                               s3=get_selected_states(3))
+        self.assertEqual(html.count(' selected'), 3)
+        for pos, value in [(1, 1), (2, 0), (3, 3)]:
+            select = html[html.index('name="pos{}"'.format(pos)):]
+            select = select[:select.index('</select>')]
+            self.assertIn('value="{}" selected'.format(value), select)
+
     def test_debug_output(self):
         """Test that prints actual HTML output for debugging."""
         print("\n=== MAIN PAGE HTML OUTPUT ===")
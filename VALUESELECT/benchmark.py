@@ -0,0 +1,401 @@
+# ========================================================================
+# VALUESELECT Benchmark
+#
+# models:    Compares rendering the /models/ fragment on every request with
+#            the pre-rendered bytes, and with a 304 for a known ETag.
+#
+# Usage: python benchmark.py models [--makes 500] [--models 40]
+# Output: Requests per second and per-request latency of each path
+#
+# load:      Compares reading a catalog CSV into a dict of lists with
+#            compiling it once and opening the compiled file with mmap.
+#
+# Usage: python benchmark.py load [--makes 20000] [--models 100]
+# Output: Load time, Python heap used, and per-lookup latency of each
+#
+# makes:     Compares the index page listing every make with listing the
+#            first MAKES_LIMIT, and type-ahead prefix lookups in the
+#            sorted make index with a scan over every make.
+#
+# Usage: python benchmark.py makes [--makes 100000]
+# Output: Page size and requests/s; per-keystroke lookup latency
+#
+# levels:    Builds a make/model/trim/year hierarchy with makes x models x
+#            trims x years leaf rows and times /level/ at random nodes.
+#
+# Usage: python benchmark.py levels [--makes 1000] [--models 50]
+# Output: Build time and size; per-request latency, uncached and cached
+#
+# extract:   Streams a generated HTML table page through getdata.py into a
+#            CSV, then parses several pages in one and in --jobs processes.
+#
+# Usage: python benchmark.py extract [--rows 200000] [--pages 8] [--jobs 4]
+# Output: Rows per second of each run; peak heap of the streamed page
+# ========================================================================
+
+import argparse
+import csv
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import flask
+from markupsafe import Markup
+
+import myapp
+from cardb import CarDB, compile_csv
+import getdata
+from hierarchy import Hierarchy
+from myapp import CarSnapshot, app, render_fragment
+
+
+def synthetic_catalog(makes, models, seed):
+    """Return {make: [model, ...]} with made-up names."""
+    rng = random.Random(seed)
+    catalog = {}
+    for i in range(makes):
+        make = "Make{:05d}".format(i)
+        catalog[make] = ["Model {} {}".format(i, rng.randrange(10 ** 6))
+                         for _ in range(models)]
+    return catalog
+
+
+def throughput(func, seconds):
+    """Call func for seconds; return calls per second."""
+    calls = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        func()
+        calls += 1
+    return calls / seconds
+
+
+def bench_models(args):
+    """Requests/s of /models/ rendered per request vs. pre-rendered."""
+    catalog = synthetic_catalog(args.makes, args.models, args.seed)
+    start = time.perf_counter()
+    myapp.snapshot = CarSnapshot(catalog, myapp.prerender_models(catalog),
+                                 None)
+    print("{} makes x {} models pre-rendered in {:.3f}s".format(
+        args.makes, args.models, time.perf_counter() - start))
+
+    # The handler as it was before: render the fragment on every request
+    def rendered():
+        make = flask.request.args['makeselected']
+        return render_fragment('model_options', models=catalog[make])
+
+    app.add_url_rule('/models-rendered/', 'models_rendered', rendered)
+    client = app.test_client()
+    rng = random.Random(args.seed)
+    makes = sorted(catalog)
+
+    def get(path, headers=None):
+        def request():
+            make = rng.choice(makes)
+            client.get(path, query_string={'makeselected': make},
+                       headers=headers(make) if headers else None)
+        return request
+
+    def if_none_match(make):
+        return {'If-None-Match': myapp.snapshot.pages[make][1]}
+
+    print("{:<22} {:>12} {:>12}".format("path", "requests/s", "ms/request"))
+    for label, request in [
+            ("render per request", get('/models-rendered/')),
+            ("pre-rendered bytes", get('/models/')),
+            ("304 Not Modified", get('/models/', if_none_match))]:
+        rate = throughput(request, args.seconds)
+        print("{:<22} {:>12.0f} {:>12.3f}".format(label, rate, 1000 / rate))
+
+    # The test client costs more than either handler; time them alone
+    with app.test_request_context('/models/',
+                                  query_string={'makeselected': makes[0]}):
+        print("{:<22} {:>12} {:>12}".format("handler only", "calls/s",
+                                            "us/call"))
+        for label, handler in [("render per request", rendered),
+                               ("pre-rendered bytes", myapp.getmodels)]:
+            rate = throughput(handler, args.seconds)
+            print("{:<22} {:>12.0f} {:>12.1f}".format(label, rate,
+                                                      1000000 / rate))
+
+
+def read_csv_dict(path):
+    """Read path into {make: [model, ...]} the way load_car_data() does."""
+    cars = {}
+    with open(path) as csvfile:
+        for make, model in csv.reader(csvfile, quotechar="'"):
+            if make not in cars:
+                cars[make] = []
+            cars[make].append(model)
+    return cars
+
+
+def traced(func, *args):
+    """Return (result, seconds, peak bytes allocated) of func(*args)."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def bench_load(args):
+    """Dict of lists read from CSV vs. the compiled, mapped CarDB."""
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'car.csv')
+        with open(path, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile, quotechar="'")
+            for make, models in synthetic_catalog(
+                    args.makes, args.models, args.seed).items():
+                writer.writerows((make, model) for model in models)
+        print("{} makes x {} models, CSV {:.1f} MB".format(
+            args.makes, args.models, os.path.getsize(path) / 2 ** 20))
+
+        db = os.path.join(tmp, 'car.db')
+        start = time.perf_counter()
+        with open(path, newline='') as csvfile:
+            compile_csv(csvfile, db)
+        print("compile-cars once: {:.2f}s, {:.1f} MB".format(
+            time.perf_counter() - start, os.path.getsize(db) / 2 ** 20))
+
+        # Open before the dict exists, so no garbage collection of its
+        # lists lands in the timing
+        start = time.perf_counter()
+        mapped = CarDB(db)
+        db_load = time.perf_counter() - start
+        db_heap = traced(CarDB, db)[2]
+        # Time without tracing first; tracemalloc slows allocation down
+        start = time.perf_counter()
+        cars = read_csv_dict(path)
+        dict_load = time.perf_counter() - start
+        del cars
+        cars, _, dict_heap = traced(read_csv_dict, path)
+
+        rng = random.Random(args.seed)
+        makes = rng.choices(sorted(cars), k=args.lookups)
+
+        def lookups(func):
+            start = time.perf_counter()
+            for make in makes:
+                func(make)
+            return (time.perf_counter() - start) / len(makes) * 10 ** 6
+
+        print("{:<22} {:>10} {:>10} {:>12}".format(
+            "", "load ms", "heap MB", "us/lookup"))
+        rows = [("csv -> dict", dict_load, dict_heap,
+                 lookups(cars.__getitem__)),
+                ("CarDB [make] (str)", db_load, db_heap,
+                 lookups(mapped.__getitem__)),
+                ("CarDB models (views)", db_load, db_heap,
+                 lookups(mapped.models))]
+        for label, load, heap, lookup in rows:
+            print("{:<22} {:>10.2f} {:>10.2f} {:>12.1f}".format(
+                label, load * 1000, heap / 2 ** 20, lookup))
+        mapped.close()
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_makes(args):
+    """Index page with every make vs. MAKES_LIMIT; prefix vs. scan."""
+    rng = random.Random(args.seed)
+    words = ["Alpha", "beta", "Gamma", "delta", "Omega"]
+    catalog = {"{} {:06d}".format(rng.choice(words), i): ["Model"]
+               for i in range(args.makes)}
+    start = time.perf_counter()
+    snap = CarSnapshot(catalog, {}, None)
+    snap.makes
+    print("{} makes indexed in {:.3f}s".format(
+        args.makes, time.perf_counter() - start))
+    myapp.snapshot = snap
+
+    # The index page as it was before: every make, sorted per request
+    def every_make():
+        makers = sorted(snap.mmdb.keys())
+        options = render_fragment('make_options', makes=makers, more=0)
+        return flask.render_template('index.html',
+                                     models=snap.mmdb[makers[0]],
+                                     make_options=Markup(options))
+
+    app.add_url_rule('/index-every-make/', 'every_make', every_make)
+    client = app.test_client()
+    print("{:<22} {:>12} {:>12}".format("index page", "KB", "requests/s"))
+    for label, path in [("every make", '/index-every-make/'),
+                        ("first MAKES_LIMIT", '/')]:
+        size = len(client.get(path).data)
+        rate = throughput(lambda: client.get(path), args.seconds)
+        print("{:<22} {:>12.1f} {:>12.1f}".format(label, size / 1024, rate))
+
+    names = sorted(catalog)
+    prefixes = [rng.choice(names)[:rng.randint(1, 8)]
+                for _ in range(args.lookups)]
+    limit = app.config['MAKES_LIMIT']
+
+    def scan(prefix, limit):
+        key = prefix.casefold()
+        matches = [make for make in names if make.casefold().startswith(key)]
+        return matches[:limit], len(matches)
+
+    print("{:<22} {:>12}".format("keystroke lookup", "us/lookup"))
+    for label, lookup, count in [("scan every make", scan, 100),
+                                 ("sorted prefix index", snap.makes.search,
+                                  len(prefixes))]:
+        start = time.perf_counter()
+        for prefix in prefixes[:count]:
+            lookup(prefix, limit)
+        elapsed = time.perf_counter() - start
+        print("{:<22} {:>12.1f}".format(label, elapsed / count * 10 ** 6))
+    client.get('/makes/', query_string={'q': prefixes[0]})
+    rate = throughput(lambda: client.get(
+        '/makes/', query_string={'q': rng.choice(prefixes)}), args.seconds)
+    print("/makes/ type-ahead: {:.0f} requests/s".format(rate))
+
+
+def synthetic_rows(makes, models, trims, years):
+    """Yield grouped (make, model, trim, year) rows."""
+    trim_names = ["Trim {}".format(t) for t in range(trims)]
+    year_names = [str(2000 + y) for y in range(years)]
+    for m in range(makes):
+        make = "Make{:05d}".format(m)
+        for n in range(models):
+            model = "Model {}-{}".format(m, n)
+            for trim in trim_names:
+                for year in year_names:
+                    yield make, model, trim, year
+
+
+def bench_levels(args):
+    """Hierarchy build cost and /level/ latency at random nodes."""
+    rows = synthetic_rows(args.makes, args.models, args.trims, args.years)
+    levels = ('make', 'model', 'trim', 'year')
+    start = time.perf_counter()
+    tree = Hierarchy.from_rows(levels, rows)
+    seconds = time.perf_counter() - start
+    arrays = sum(a.buffer_info()[1] * a.itemsize
+                 for a in tree.labels + tree.starts)
+    strings = sys.getsizeof(tree.names) + sum(map(sys.getsizeof, tree.names))
+    print("{} leaf rows built in {:.1f}s; node arrays {:.0f} MB, "
+          "{} distinct labels {:.0f} MB".format(
+              len(tree), seconds, arrays / 2 ** 20, len(tree.names),
+              strings / 2 ** 20))
+
+    snap = CarSnapshot({}, {}, None)
+    snap.hierarchy = tree
+    myapp.snapshot = snap
+    client = app.test_client()
+    rng = random.Random(args.seed)
+    requests = [(depth, rng.randrange(tree.size(depth - 1)))
+                for depth in rng.choices(range(1, 4), k=args.requests)]
+
+    print("{:<22} {:>12}".format("/level/", "ms/request"))
+    for label in ("uncached", "cached"):
+        start = time.perf_counter()
+        for depth, node in requests:
+            client.get('/level/{}/'.format(depth),
+                       query_string={'node': node})
+        elapsed = time.perf_counter() - start
+        print("{:<22} {:>12.3f}".format(
+            label, elapsed / len(requests) * 1000))
+
+
+def write_table_page(path, rows, seed):
+    """Write an HTML page whose first table has rows make/model rows."""
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf-8') as page:
+        page.write('<html><body><table class="wikitable">\n'
+                   '<tr><th>Make</th><th>Model</th><th>Years</th></tr>\n')
+        for i in range(rows):
+            page.write('<tr><td><a href="/wiki/Make{0}">Make {0}</a></td>'
+                       '<td><a href="/wiki/M{1}">Model {1}</a> <sup>[{0}]'
+                       '</sup></td><td>2001&ndash;2024</td></tr>\n'.format(
+                           i % 500, rng.randrange(10 ** 6)))
+        page.write('</table></body></html>\n')
+
+
+def bench_extract(args):
+    """Streaming extraction rate, memory, and pages across processes."""
+    tmp = tempfile.mkdtemp()
+    try:
+        pages = [os.path.join(tmp, 'page{}.html'.format(i))
+                 for i in range(args.pages)]
+        for i, page in enumerate(pages):
+            write_table_page(page, args.rows // args.pages, args.seed + i)
+        big = os.path.join(tmp, 'big.html')
+        write_table_page(big, args.rows, args.seed)
+        print("one page of {} rows ({:.1f} MB), {} pages of {}".format(
+            args.rows, os.path.getsize(big) / 2 ** 20, args.pages,
+            args.rows // args.pages))
+        out = os.path.join(tmp, 'car.csv')
+
+        print("{:<22} {:>12}".format("run", "rows/s"))
+        runs = [("one page, streamed", [big], 1),
+                ("pages, 1 process", pages, 1),
+                ("pages, {} processes".format(args.jobs), pages, args.jobs)]
+        for label, sources, jobs in runs:
+            start = time.perf_counter()
+            count = getdata.write_csv(getdata.source_rows(sources, jobs), out)
+            print("{:<22} {:>12.0f}".format(
+                label, count / (time.perf_counter() - start)))
+        peak = traced(getdata.write_csv, getdata.source_rows([big], 1),
+                      out)[2]
+        print("peak heap streaming the {:.1f} MB page: {:.2f} MB".format(
+            os.path.getsize(big) / 2 ** 20, peak / 2 ** 20))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark VALUESELECT endpoints")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    models = commands.add_parser("models", help="render vs. pre-rendered")
+    models.add_argument("--makes", type=int, default=500)
+    models.add_argument("--models", type=int, default=40)
+    models.add_argument("--seconds", type=float, default=3)
+    models.add_argument("--seed", type=int, default=42)
+    models.set_defaults(func=bench_models)
+
+    load = commands.add_parser("load", help="CSV dict vs. mapped CarDB")
+    load.add_argument("--makes", type=int, default=20000)
+    load.add_argument("--models", type=int, default=100)
+    load.add_argument("--lookups", type=int, default=10000)
+    load.add_argument("--seed", type=int, default=42)
+    load.set_defaults(func=bench_load)
+
+    makes = commands.add_parser("makes", help="make list vs. type-ahead")
+    makes.add_argument("--makes", type=int, default=100000)
+    makes.add_argument("--lookups", type=int, default=10000)
+    makes.add_argument("--seconds", type=float, default=3)
+    makes.add_argument("--seed", type=int, default=42)
+    makes.set_defaults(func=bench_makes)
+
+    levels = commands.add_parser("levels", help="N-level cascade")
+    levels.add_argument("--makes", type=int, default=1000)
+    levels.add_argument("--models", type=int, default=50)
+    levels.add_argument("--trims", type=int, default=5)
+    levels.add_argument("--years", type=int, default=4)
+    levels.add_argument("--requests", type=int, default=2000)
+    levels.add_argument("--seed", type=int, default=42)
+    levels.set_defaults(func=bench_levels)
+
+    extract = commands.add_parser("extract", help="getdata.py extraction")
+    extract.add_argument("--rows", type=int, default=200000)
+    extract.add_argument("--pages", type=int, default=8)
+    extract.add_argument("--jobs", type=int, default=4)
+    extract.add_argument("--seed", type=int, default=42)
+    extract.set_defaults(func=bench_extract)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
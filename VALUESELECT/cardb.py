@@ -0,0 +1,206 @@
+"""
+Compact, memory-mapped car database for the VALUESELECT example.
+
+load_car_data() reads car.csv into a dict of Python lists, which is slow to
+build and takes a lot of memory once a catalog holds millions of rows.
+compile_csv() turns the CSV into one binary file instead, and CarDB opens
+that file with mmap: opening it costs nothing no matter how large the
+catalog is, and every worker process shares the same page-cache pages.
+
+File layout (all integers little-endian):
+
+    header   MAGIC, make count, model count, string table offset
+    makes    one MAKE record per make, sorted by the make's UTF-8 bytes:
+             name offset, name length, first model, model count
+    models   one MODEL record per model, grouped by make in CSV order:
+             name offset, name length
+    strings  every make and model name, UTF-8, back to back
+
+Offsets in the records are relative to the string table.
+
+MakeIndex answers type-ahead lookups of makes by prefix over either kind
+of make-model mapping.
+"""
+
+import bisect
+import csv
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from array import array
+from collections.abc import Mapping
+
+MAGIC = b'CARDB\x00\x01\x00'
+HEADER = struct.Struct('<8sIIQ')
+MAKE = struct.Struct('<QIII')
+MODEL = struct.Struct('<QI')
+
+
+def compile_csv(csvfile, path):
+    """
+    Write the make,model rows of csvfile (quotechar "'") to path as a
+    CarDB file. Model names are spooled to a temporary file as they are
+    read, so only 12 bytes per model are held in memory. The file is
+    replaced atomically. Return (makes, models).
+    """
+    # make -> (model offsets, model lengths) into the spooled strings
+    makes = {}
+    models = 0
+    with tempfile.TemporaryFile() as strings:
+        size = 0
+        for make, model in csv.reader(csvfile, quotechar="'"):
+            if make not in makes:
+                makes[make] = (array('Q'), array('I'))
+            offsets, lengths = makes[make]
+            data = model.encode('utf-8')
+            offsets.append(size)
+            lengths.append(len(data))
+            strings.write(data)
+            size += len(data)
+            models += 1
+
+        names = sorted(make.encode('utf-8') for make in makes)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as out:
+            tables = len(names) * MAKE.size + models * MODEL.size
+            out.write(HEADER.pack(MAGIC, len(names), models,
+                                  HEADER.size + tables))
+            first = 0
+            name_offset = size
+            for name in names:
+                count = len(makes[name.decode('utf-8')][0])
+                out.write(MAKE.pack(name_offset, len(name), first, count))
+                name_offset += len(name)
+                first += count
+            for name in names:
+                offsets, lengths = makes[name.decode('utf-8')]
+                for offset, length in zip(offsets, lengths):
+                    out.write(MODEL.pack(offset, length))
+            strings.seek(0)
+            shutil.copyfileobj(strings, out)
+            for name in names:
+                out.write(name)
+        os.replace(tmp, path)
+    return len(names), models
+
+
+class CarDB(Mapping):
+    """
+    Read-only {make: [model, ...]} mapping over a compile_csv() file.
+
+    Makes iterate in sorted order and are found by binary search over the
+    make records. models() returns memoryview slices of the mapped file,
+    so listing a make's models copies nothing; looking a make up returns
+    the models as str, like the dict load_car_data() builds.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as dbfile:
+            self.mm = mmap.mmap(dbfile.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.make_count, self.model_count, self.strings = \
+            HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            self.mm.close()
+            raise ValueError('{} is not a car database'.format(path))
+        self.view = memoryview(self.mm)
+        self.models_at = HEADER.size + self.make_count * MAKE.size
+
+    def close(self):
+        """Unmap the file; lookups fail from now on."""
+        self.view.release()
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _make(self, i):
+        """Return the MAKE record of the i-th make."""
+        return MAKE.unpack_from(self.mm, HEADER.size + i * MAKE.size)
+
+    def _string(self, offset, length):
+        start = self.strings + offset
+        return self.view[start:start + length]
+
+    def find(self, make):
+        """Return the position of make among the sorted makes, or -1."""
+        key = make.encode('utf-8')
+        lo, hi = 0, self.make_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset, length, _, _ = self._make(mid)
+            start = self.strings + offset
+            name = self.mm[start:start + length]
+            if name < key:
+                lo = mid + 1
+            elif name == key:
+                return mid
+            else:
+                hi = mid
+        return -1
+
+    def make(self, i):
+        """Return the name of the i-th make."""
+        offset, length, _, _ = self._make(i)
+        return str(self._string(offset, length), 'utf-8')
+
+    def models(self, make):
+        """
+        Return make's models as memoryviews of their UTF-8 bytes, without
+        copying them; raise KeyError for an unknown make.
+        """
+        i = self.find(make)
+        if i < 0:
+            raise KeyError(make)
+        _, _, first, count = self._make(i)
+        start = self.models_at + first * MODEL.size
+        records = self.view[start:start + count * MODEL.size]
+        view, base = self.view, self.strings
+        return [view[base + offset:base + offset + length]
+                for offset, length in MODEL.iter_unpack(records)]
+
+    def __getitem__(self, make):
+        return [str(name, 'utf-8') for name in self.models(make)]
+
+    def __contains__(self, make):
+        return isinstance(make, str) and self.find(make) >= 0
+
+    def __iter__(self):
+        return (self.make(i) for i in range(self.make_count))
+
+    def __len__(self):
+        return self.make_count
+
+
+class MakeIndex:
+    """
+    Prefix index of make names for type-ahead lookups.
+
+    keys holds every make casefolded and sorted, and names the matching
+    make names in the same order. All makes that start with a prefix are
+    one contiguous range of keys, found with two binary searches, so a
+    lookup only touches the makes it returns.
+    """
+
+    def __init__(self, makes):
+        pairs = sorted((make.casefold(), make) for make in makes)
+        self.keys = [key for key, _ in pairs]
+        self.names = [make for _, make in pairs]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def search(self, prefix, limit):
+        """
+        Return (makes, total): the first limit makes, in casefolded order,
+        that start with prefix ignoring case, and how many makes do.
+        """
+        key = prefix.casefold()
+        lo = bisect.bisect_left(self.keys, key)
+        # Every key that starts with key sorts before key + U+10FFFF
+        hi = bisect.bisect_left(self.keys, key + '\U0010ffff', lo)
+        return self.names[lo:min(hi, lo + limit)], hi - lo
@@ -1,55 +1,217 @@
 # ========================================================================
 # Sample Data Retrieval Script
 #
-# This script demonstrates how to scrape car data from Wikipedia to create
-# the car.csv file used by the VALUESELECT example.
+# This script demonstrates how to extract car data from Wikipedia's SUV
+# list to create the car.csv file used by the VALUESELECT example.
 #
-# Usage: python getdata.py
+# Pages are read in chunks and parsed as a stream of html.parser events.
+# The rows of each chunk are written to car.csv straight away and no
+# document tree is built, so memory use does not grow with the page.
+#
+# Usage: python getdata.py                  (fetch the Wikipedia page)
+#        python getdata.py page.html ...    (saved pages; - for stdin)
+#        python getdata.py pages/*.html --jobs 4 --output car.csv
 # Output: Creates car.csv with make,model pairs
-# ===============================================================================
+# ========================================================================
+
+import argparse
+import csv
+import io
+import multiprocessing
+import os
+import sys
+import urllib.request
+from html.parser import HTMLParser
+
+# Wikipedia URL containing SUV data
+URL = "https://en.wikipedia.org/wiki/List_of_sport_utility_vehicles"
 
-from bs4 import BeautifulSoup
-import requests
+# Characters read from a page per parser.feed() call
+CHUNK = 65536
 
 
-def reducecol(part):
+class TableRowParser(HTMLParser):
     """
-    Extract text content from BeautifulSoup element, handling nested links.
+    Collect the rows of the first <table> in a page as it is fed.
+
+    A row with at least two <td> cells yields (make, model) from its
+    first two cells. A cell's value is the text of its first link, or its
+    first text when it has no link. Completed rows wait in rows until the
+    caller takes them; done turns True at the end of the table.
     """
-    if part.find("a"):
-        part = part.find("a")
-    if isinstance(part.contents, list):
-        part = part.contents[0]
-    return part
 
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.rows = []
+        self.done = False
+        # Open <table> elements; nested tables belong to the first one
+        self.tables = 0
+        # Cells of the open row; each is a list of [text, in a link]
+        # segments, one per stretch of text between two tags
+        self.cells = None
+        self.cell = None
+        # A chunk boundary can split a text; its parts join one segment
+        self.joining = False
+        self.in_link = False
 
-# Wikipedia URL containing SUV data
-url = "https://en.wikipedia.org/wiki/List_of_sport_utility_vehicles"
-
-print("Fetching SUV data from Wikipedia...")
-resp = requests.get(url)
-if resp.status_code != 200:
-    raise Exception("ERROR: Can't read url: %s" % url)
-
-print("Parsing HTML content...")
-soup = BeautifulSoup(resp.text, 'html.parser')
-table = soup.find("table")
-rows = table.findAll("tr")
-
-# Extract make and model data from table rows
-suvs = []
-for row in rows:
-    cols = row.findAll("td")
-    if len(cols) > 1:
-        make = reducecol(cols[0])
-        model = reducecol(cols[1])
-        suvs.append((make, model))
-
-# Write data to CSV file
-print("Writing data to car.csv...")
-with open("car.csv", "w") as out:
-    for make, model in suvs:
-        out.write("'{}','{}'\n".format(make.strip(), model.strip()))
-
-print("Successfully created car.csv with {} car entries".format(len(suvs)))
-print("Data includes makes and models from the Wikipedia SUV list")
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        self.joining = False
+        if tag == 'table':
+            self.tables += 1
+        elif self.tables == 1 and tag == 'tr':
+            self.cells = []
+        elif self.cells is not None and tag == 'td':
+            self.cell = []
+            self.cells.append(self.cell)
+        elif tag == 'a':
+            self.in_link = True
+
+    def handle_endtag(self, tag):
+        if self.done:
+            return
+        self.joining = False
+        if tag == 'table':
+            self.tables -= 1
+            self.done = self.tables == 0
+        elif tag == 'a':
+            self.in_link = False
+        elif tag == 'td':
+            self.cell = None
+        elif tag == 'tr' and self.cells is not None:
+            if len(self.cells) > 1:
+                self.rows.append(tuple(cell_value(cell)
+                                       for cell in self.cells[:2]))
+            self.cells = self.cell = None
+
+    def handle_data(self, data):
+        if self.cell is None:
+            return
+        if self.joining:
+            self.cell[-1][0] += data
+        else:
+            self.cell.append([data, self.in_link])
+            self.joining = True
+
+
+def cell_value(segments):
+    """
+    Return the text a cell stands for: the first text inside a link, or
+    the first text when it has no link.
+    """
+    texts = [(text.strip(), in_link) for text, in_link in segments]
+    links = [text for text, in_link in texts if text and in_link]
+    plain = [text for text, _ in texts if text]
+    return (links or plain or [''])[0]
+
+
+def extract_rows(page):
+    """
+    Yield the (make, model) rows of the first table in page, a text file,
+    while reading it CHUNK characters at a time. Reading stops at the end
+    of the table.
+    """
+    parser = TableRowParser()
+    for chunk in iter(lambda: page.read(CHUNK), ''):
+        parser.feed(chunk)
+        yield from parser.rows
+        parser.rows.clear()
+        if parser.done:
+            return
+    parser.close()
+    yield from parser.rows
+
+
+def open_page(source):
+    """Open a file name, - (stdin) or an http(s) URL as a text stream."""
+    if source == '-':
+        return io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+    if source.startswith(('http://', 'https://')):
+        request = urllib.request.Request(
+            source, headers={'User-Agent': 'VALUESELECT getdata.py'})
+        response = urllib.request.urlopen(request)
+        charset = response.headers.get_content_charset() or 'utf-8'
+        return io.TextIOWrapper(response, encoding=charset)
+    return open(source, encoding='utf-8')
+
+
+def page_rows(source):
+    """Return every row of one page (run in the worker processes)."""
+    with open_page(source) as page:
+        return list(extract_rows(page))
+
+
+def source_rows(sources, jobs):
+    """
+    Yield the rows of every source, in order. With jobs > 1, the pages are
+    parsed by that many worker processes and each page's rows are yielded
+    as soon as it and the pages before it are done. Workers cannot read
+    this process's stdin, so - is always parsed here.
+    """
+    if jobs > 1 and len(sources) > 1:
+        with multiprocessing.Pool(jobs) as pool:
+            pending = [None if source == '-'
+                       else pool.apply_async(page_rows, (source,))
+                       for source in sources]
+            for source, result in zip(sources, pending):
+                if result is None:
+                    yield from stream_rows(source)
+                else:
+                    yield from result.get()
+        return
+    for source in sources:
+        yield from stream_rows(source)
+
+
+def stream_rows(source):
+    """Yield the rows of one page as they are parsed."""
+    with open_page(source) as page:
+        yield from extract_rows(page)
+
+
+def write_csv(rows, path):
+    """
+    Write rows to path in car.csv's format as they arrive; return how many
+    were written. The finished file replaces path in one step, so the app
+    never reloads a half-written car.csv. Without any rows, path is left
+    as it was and 0 is returned.
+    """
+    count = 0
+    tmp = path + '.tmp'
+    with open(tmp, 'w', newline='') as out:
+        writer = csv.writer(out, quotechar="'", quoting=csv.QUOTE_ALL)
+        for make, model in rows:
+            writer.writerow((make, model))
+            count += 1
+    if count == 0:
+        # A page without the table; keep the data the app is serving
+        os.remove(tmp)
+        return 0
+    os.replace(tmp, path)
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Extract make,model rows from HTML tables into car.csv")
+    parser.add_argument("pages", nargs="*", default=[URL],
+                        help="saved HTML pages, - for stdin, or URLs "
+                             "(default: the Wikipedia SUV list)")
+    parser.add_argument("-o", "--output", default="car.csv")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="worker processes for parsing many pages")
+    args = parser.parse_args()
+
+    print("Extracting rows from {} page(s)...".format(len(args.pages)),
+          file=sys.stderr)
+    count = write_csv(source_rows(args.pages, args.jobs), args.output)
+    if count == 0:
+        sys.exit("No make,model rows found; {} left unchanged".format(
+            args.output))
+    print("Successfully created {} with {} car entries".format(
+        args.output, count), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""
+N-level hierarchy of choices (make -> model -> trim -> year, ...) for the
+VALUESELECT cascade.
+
+mmdb only knows two levels, as a dict of lists. Hierarchy holds any number
+of levels as a tree of integer-coded nodes: each level is an array of
+label ids, and every distinct label is stored once in a string table. The
+children of a node are a contiguous run of the next level, so finding them
+is two array reads, whatever the size of the tree.
+
+Nodes are numbered per level, in input order. Level d's node i has the
+children starts[d][i]:starts[d][i + 1] in level d + 1; the root's children
+are all of level 0.
+"""
+
+import csv
+from array import array
+
+
+class Hierarchy:
+    """Immutable tree of labelled nodes, one array per level."""
+
+    def __init__(self, levels, names, labels, starts):
+        self.levels = tuple(levels)
+        # Label id -> label
+        self.names = names
+        # Per level: node -> label id
+        self.labels = labels
+        # Per level but the last: node -> first child (plus an end marker)
+        self.starts = starts
+
+    @classmethod
+    def from_rows(cls, levels, rows):
+        """
+        Build the tree from rows of one label per level.
+
+        Rows must be grouped: all rows under a node come one after
+        another, as in a CSV sorted by its columns. That lets the tree be
+        built in one streaming pass, keeping only the current path in
+        memory besides the arrays. Repeated rows are ignored; a node that
+        comes back after its group ended raises ValueError.
+        """
+        depth = len(levels)
+        names, ids = [], {}
+        labels = [array('I') for _ in levels]
+        starts = [array('I') for _ in levels[1:]]
+        path = [None] * depth
+        # Labels of the current path's children, to catch ungrouped rows
+        seen = [set() for _ in levels]
+        for line, row in enumerate(rows, 1):
+            if not row:
+                continue
+            if len(row) != depth:
+                raise ValueError('row {}: expected {} columns, got {}'.format(
+                    line, depth, len(row)))
+            coded = []
+            for name in row:
+                if name not in ids:
+                    ids[name] = len(names)
+                    names.append(name)
+                coded.append(ids[name])
+            level = 0
+            while level < depth and coded[level] == path[level]:
+                level += 1
+            if level == depth:
+                continue
+            if coded[level] in seen[level]:
+                raise ValueError('row {}: {} appears again after other rows; '
+                                 'sort the rows by their columns'.format(
+                                     line, ' > '.join(row[:level + 1])))
+            for d in range(level, depth):
+                if d > level:
+                    seen[d].clear()
+                seen[d].add(coded[d])
+                labels[d].append(coded[d])
+                if d + 1 < depth:
+                    starts[d].append(len(labels[d + 1]))
+                path[d] = coded[d]
+        for d, level_starts in enumerate(starts):
+            level_starts.append(len(labels[d + 1]))
+        return cls(levels, names, labels, starts)
+
+    @classmethod
+    def from_mapping(cls, levels, mapping):
+        """
+        Build a two-level tree from {parent: [child, ...]}. A child listed
+        twice under one parent is kept once, where it first appears.
+        """
+        return cls.from_rows(levels, ((parent, child)
+                                      for parent, children in mapping.items()
+                                      for child in dict.fromkeys(children)))
+
+    @classmethod
+    def from_csv(cls, csvfile):
+        """
+        Build the tree from a CSV file whose header row names the levels,
+        e.g. make,model,trim,year.
+        """
+        reader = csv.reader(csvfile)
+        levels = next(reader, None)
+        if not levels:
+            raise ValueError('missing header row naming the levels')
+        return cls.from_rows(levels, reader)
+
+    def __len__(self):
+        """Number of leaves."""
+        return len(self.labels[-1])
+
+    def size(self, depth):
+        """Number of nodes at depth."""
+        return len(self.labels[depth])
+
+    def label(self, depth, node):
+        """Return the label of node at depth."""
+        return self.names[self.labels[depth][node]]
+
+    def children(self, depth, node=None):
+        """
+        Return the nodes at depth below node, which is a node at
+        depth - 1 (the root for depth 0), as a range; raise IndexError
+        for a node that does not exist.
+        """
+        if depth == 0:
+            return range(len(self.labels[0]))
+        starts = self.starts[depth - 1]
+        if node is None or not 0 <= node < len(starts) - 1:
+            raise IndexError(node)
+        return range(starts[node], starts[node + 1])
+
+    def options(self, depth, node=None):
+        """Return [(node, label), ...] of the children of node at depth."""
+        labels, names = self.labels[depth], self.names
+        return [(child, names[labels[child]])
+                for child in self.children(depth, node)]
@@ -1,34 +1,329 @@
 import csv
+import functools
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import click
 import flask
+from markupsafe import Markup
+
+from cardb import CarDB, MakeIndex, compile_csv
+from hierarchy import Hierarchy
 
 app = flask.Flask(__name__, static_url_path='/static')
+# Seconds browsers and proxies may reuse a /models/ response unasked
+app.config['MODELS_MAX_AGE'] = 3600
+# Make,model rows loaded at startup
+app.config['CAR_CSV'] = 'car.csv'
+# Compiled car database (flask compile-cars) to map instead of car.csv
+app.config['CAR_DB'] = os.environ.get('VALUESELECT_DB')
+# Seconds between checks of the car data file for changes (0: never reload)
+app.config['RELOAD_INTERVAL'] = float(os.environ.get('VALUESELECT_RELOAD', 0))
+# Most makes listed by the index page and each /makes/ type-ahead response
+app.config['MAKES_LIMIT'] = 50
+# CSV of choices for /cascade/, with a header row naming its levels (e.g.
+# make,model,trim,year); without it the cascade offers make and model
+app.config['HIERARCHY_CSV'] = os.environ.get('VALUESELECT_HIERARCHY')
+# /level/ responses kept per snapshot; the least recently used go first
+app.config['LEVEL_CACHE_SIZE'] = 10000
 
-# Global database to store make-model relationships
-mmdb = {}
+NO_MODELS = b'<option value="">No models available</option>'
 
 
-def load_car_data():
-    """Load car make-model data from CSV file into memory."""
+class CarSnapshot:
+    """
+    One loaded version of the car data.
+
+    mmdb maps make -> [model, ...]: a dict read from car.csv, or a CarDB
+    over the compiled file. pages holds every make's /models/ response,
+    rendered once: make -> (body, etag). stamp identifies the file both
+    were built from (see file_stamp()).
+
+    A snapshot is complete before it is published and is never modified
+    afterwards, except that a CarDB snapshot fills in its pages on first
+    use. A request reads the global snapshot once and uses only that one,
+    so a reload never shows it a mix of old and new data.
+    """
+
+    def __init__(self, mmdb, pages, stamp):
+        self.mmdb = mmdb
+        self.pages = pages
+        self.stamp = stamp
+        # (depth, node) -> (body, etag) of /level/ responses
+        self.level_pages = OrderedDict()
+        self.level_lock = threading.Lock()
+
+    @functools.cached_property
+    def makes(self):
+        """MakeIndex of mmdb for type-ahead lookups, built on first use."""
+        return MakeIndex(self.mmdb)
+
+    @functools.cached_property
+    def hierarchy(self):
+        """Hierarchy of choices for /cascade/, built on first use."""
+        return load_hierarchy(self.mmdb)
+
+    def level_page(self, depth, node):
+        """
+        Return the (body, etag) of the /level/ response for node's
+        children at depth, rendering it unless it is cached.
+        """
+        key = (depth, node)
+        with self.level_lock:
+            page = self.level_pages.get(key)
+            if page is not None:
+                self.level_pages.move_to_end(key)
+                return page
+        page = render_level(self.hierarchy, depth, node)
+        with self.level_lock:
+            self.level_pages[key] = page
+            while len(self.level_pages) > app.config['LEVEL_CACHE_SIZE']:
+                self.level_pages.popitem(last=False)
+        return page
+
+    def model_page(self, make):
+        """
+        Return the (body, etag) of make's /models/ response, or None for
+        an unknown make. Makes of a mapped CarDB are rendered on first use.
+        """
+        page = self.pages.get(make)
+        if page is None and make in self.mmdb:
+            page = self.pages[make] = render_models(self.mmdb[make])
+        return page
+
+
+# The published car data; replaced whole by load_car_data()
+snapshot = CarSnapshot({}, {}, None)
+# Serializes rebuilds; requests never take it
+reload_lock = threading.Lock()
+
+
+def car_data_path():
+    """Return the file the car data is loaded from."""
+    return app.config['CAR_DB'] or app.config['CAR_CSV']
+
+
+def file_stamp(path):
+    """
+    Return (inode, mtime, size) of path, or None if it does not exist.
+    Rewriting the file in place changes the mtime or size; replacing it
+    (as compile-cars does) changes the inode.
+    """
     try:
-        with open("car.csv") as csvfile:
-            for make, model in csv.reader(csvfile, quotechar="'"):
-                if make not in mmdb:
-                    mmdb[make] = []
-                mmdb[make].append(model)
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def read_car_csv(path):
+    """Read make,model rows from path into {make: [model, ...]}."""
+    mmdb = {}
+    with open(path) as csvfile:
+        for make, model in csv.reader(csvfile, quotechar="'"):
+            if make not in mmdb:
+                mmdb[make] = []
+            mmdb[make].append(model)
+    return mmdb
+
+
+def load_hierarchy(mmdb):
+    """
+    Load the HIERARCHY_CSV file, or make a make -> model hierarchy of mmdb
+    when there is none.
+    """
+    path = app.config['HIERARCHY_CSV']
+    if path:
+        with open(path, newline='', encoding='utf-8') as csvfile:
+            return Hierarchy.from_csv(csvfile)
+    return Hierarchy.from_mapping(('make', 'model'), mmdb)
+
+
+def build_snapshot():
+    """
+    Build a CarSnapshot from the car data file without publishing it. The
+    stamp is taken before reading, so a change made while reading makes
+    the snapshot look stale rather than current.
+    """
+    path = car_data_path()
+    stamp = file_stamp(path)
+    if app.config['CAR_DB']:
+        # Opening the file reads nothing; model pages render on first use
+        fresh = CarSnapshot(CarDB(path), {}, stamp)
+    else:
+        try:
+            mmdb = read_car_csv(path)
+        except FileNotFoundError:
+            print(f"Warning: {path} not found. Using sample data.")
+            # Fallback sample data
+            mmdb = {
+                'Toyota': ['RAV4', 'Highlander', '4Runner', 'Sequoia'],
+                'Honda': ['CR-V', 'Pilot', 'Passport', 'Ridgeline'],
+                'Ford': ['Escape', 'Explorer', 'Edge', 'Expedition']
+            }
+        fresh = CarSnapshot(mmdb, prerender_models(mmdb), stamp)
+        # Build the make index and the cascade here rather than on the
+        # first request, so data they reject keeps the old snapshot
+        fresh.makes
+        fresh.hierarchy
+    if app.config['HIERARCHY_CSV']:
+        # A large hierarchy file takes seconds to read; never on a request
+        fresh.hierarchy
+    return fresh
+
+
+def load_car_data():
+    """
+    Load car make-model data from CSV file into memory, or map the
+    compiled database when CAR_DB is set, and publish it.
+    """
+    global snapshot
+    with reload_lock:
+        snapshot = build_snapshot()
+    mmdb = snapshot.mmdb
+    if isinstance(mmdb, CarDB):
+        print(f"Mapped {len(mmdb)} car makes with {mmdb.model_count} "
+              f"total models from {car_data_path()}")
+    else:
         total_models = sum(len(models) for models in mmdb.values())
         print(f"Loaded {len(mmdb)} car makes with {total_models} total models")
-    except FileNotFoundError:
-        print("Warning: car.csv not found. Using sample data.")
-        # Fallback sample data
-        mmdb.update({
-            'Toyota': ['RAV4', 'Highlander', '4Runner', 'Sequoia'],
-            'Honda': ['CR-V', 'Pilot', 'Passport', 'Ridgeline'],
-            'Ford': ['Escape', 'Explorer', 'Edge', 'Expedition']
-        })
+
+
+def reload_car_data():
+    """
+    Rebuild and publish the car data if its file changed since the current
+    snapshot was built. Return True if a new snapshot was published.
+
+    The rebuild runs on the calling thread, off the request path; requests
+    keep using the old snapshot until the new one is complete. A file that
+    disappeared, changed again while being read or does not parse leaves
+    the old snapshot in place (the next check tries again).
+    """
+    global snapshot
+    with reload_lock:
+        stamp = file_stamp(car_data_path())
+        if stamp is None or stamp == snapshot.stamp:
+            return False
+        fresh = build_snapshot()
+        if fresh.stamp != file_stamp(car_data_path()):
+            return False
+        snapshot = fresh
+    app.logger.info('Reloaded %d car makes from %s', len(fresh.mmdb),
+                    car_data_path())
+    return True
+
+
+def start_reloader(interval):
+    """Check the car data file for changes every interval seconds."""
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                reload_car_data()
+            except Exception:
+                app.logger.exception('Reloading %s failed', car_data_path())
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def prerender_models(mmdb):
+    """
+    Render the /models/ response of every make in mmdb once, as UTF-8
+    bytes with an ETag (a hash of the bytes). A snapshot's data does not
+    change, so a request only has to look its response up.
+    """
+    return {make: render_models(models) for make, models in mmdb.items()}
+
+
+def render_level(tree, depth, node):
+    """
+    Return the /level/ response body for node's children at depth and its
+    ETag: their options, plus every deeper select emptied out of band. An
+    unknown node (or None below depth 0) has no children.
+    """
+    try:
+        options = tree.options(depth, node)
+    except IndexError:
+        options = []
+    html = render_fragment('level_options', level=tree.levels[depth],
+                           options=options)
+    html += ''.join(level_select(tree, deeper, oob=True)
+                    for deeper in range(depth + 1, len(tree.levels)))
+    body = html.encode('utf-8')
+    return body, hashlib.blake2b(body, digest_size=12).hexdigest()
+
+
+def level_select(tree, depth, options=(), oob=False):
+    """Render the <select> of level depth holding options."""
+    return render_fragment(
+        'level_select', depth=depth, level=tree.levels[depth],
+        last=depth == len(tree.levels) - 1, oob=oob,
+        options=Markup(render_fragment('level_options',
+                                       level=tree.levels[depth],
+                                       options=options)))
+
+
+def render_models(models):
+    """Return the /models/ response body for models and its ETag."""
+    body = render_fragment('model_options', models=models).encode('utf-8')
+    return body, hashlib.blake2b(body, digest_size=12).hexdigest()
+
+
+# Option lists and selects of the dropdown endpoints, compiled at startup
+FRAGMENTS = {
+    'model_options': """
+    <option value="">Select a model...</option>
+    {% for amodel in models %}
+        <option value="{{ amodel }}">{{ amodel }}</option>
+    {% endfor %}
+    """,
+    'make_options': """
+    <option value="">Select a make...</option>
+    {% for amake in makes %}
+        <option value="{{ amake }}">{{ amake }}</option>
+    {% endfor %}
+    {% if more %}
+        <option value="" disabled>{{ more }} more, keep typing</option>
+    {% endif %}
+    """,
+    'level_options': """
+    <option value="">Select a {{ level }}...</option>
+    {% for node, label in options %}
+        <option value="{{ node }}">{{ label }}</option>
+    {% endfor %}
+    """,
+    # Choosing a node loads its children into the next level's select
+    'level_select': """
+    <select id="level-{{ depth }}" name="node" class="form-control"
+            aria-label="{{ level }}"
+            {%- if not last %}
+            hx-get="/level/{{ depth + 1 }}/"
+            hx-target="#level-{{ depth + 1 }}"
+            hx-indicator=".htmx-indicator"
+            {%- endif %}
+            {%- if oob %} hx-swap-oob="true"{% endif %}>
+        {{ options }}
+    </select>
+    """,
+}
+fragments = {name: app.jinja_env.from_string(source)
+             for name, source in FRAGMENTS.items()}
+
+
+def render_fragment(name, **context):
+    """Render a precompiled inline fragment by name."""
+    return fragments[name].render(**context)
 
 
 # Load data on startup
 load_car_data()
+if app.config['RELOAD_INTERVAL']:
+    start_reloader(app.config['RELOAD_INTERVAL'])
 
 
 @app.route('/models/', methods=['GET'])
@@ -38,25 +333,94 @@ def getmodels():
     make.
 
     Expected query parameter: makeselected (the car make)
-    Returns: HTML fragment with <option> elements for models
+    Returns: HTML fragment with <option> elements for models, pre-rendered
+    at load time. Browsers may reuse it for MODELS_MAX_AGE seconds, or one
+    RELOAD_INTERVAL when car data is reloaded, and then revalidate it with
+    its ETag (304 Not Modified).
     """
     selected_make = flask.request.args.get("makeselected")
 
     # Handle missing or invalid make selection
-    if not selected_make or selected_make not in mmdb:
-        return '<option value="">No models available</option>'
+    page = snapshot.model_page(selected_make) if selected_make else None
+    if page is None:
+        return NO_MODELS
 
-    # Get models for the selected make
-    models = mmdb[selected_make]
+    body, etag = page
+    if flask.request.if_none_match.contains(etag):
+        response = flask.Response(status=304)
+    else:
+        response = flask.Response(body, mimetype='text/html')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    max_age = app.config['MODELS_MAX_AGE']
+    if app.config['RELOAD_INTERVAL']:
+        # A reload may change the models; keep them no longer than that
+        max_age = min(max_age, int(app.config['RELOAD_INTERVAL']))
+    response.cache_control.max_age = max_age
+    return response
 
-    # Return HTML fragment with model options
-    templ = """
-    <option value="">Select a model...</option>
-    {% for amodel in models %}
-        <option value="{{ amodel }}">{{ amodel }}</option>
-    {% endfor %}
+
+def make_options(snap, prefix):
+    """
+    Render the make <option>s for prefix: the first MAKES_LIMIT makes that
+    start with it, plus a note on how many more do.
+    """
+    makes, total = snap.makes.search(prefix, app.config['MAKES_LIMIT'])
+    return makes, render_fragment('make_options', makes=makes,
+                                  more=total - len(makes))
+
+
+@app.route('/makes/', methods=['GET'])
+def getmakes():
+    """
+    HTMX type-ahead endpoint that returns the make options matching what
+    has been typed so far.
+
+    Expected query parameter: q (start of a make name, any case)
+    Returns: HTML fragment with at most MAKES_LIMIT <option> elements
     """
-    return flask.render_template_string(templ, models=models)
+    prefix = flask.request.args.get('q', '').strip()
+    return make_options(snapshot, prefix)[1]
+
+
+@app.route('/level/<int:depth>/', methods=['GET'])
+def getlevel(depth):
+    """
+    HTMX endpoint of the N-level cascade: returns the options of level
+    depth for the node chosen one level up, and empties every deeper
+    level's select out of band, since their choices no longer apply.
+
+    Expected query parameter: node (chosen at depth - 1; none for depth 0)
+    Returns: HTML fragment, cached per node; 404 for a depth with no level
+    """
+    snap = snapshot
+    tree = snap.hierarchy
+    if depth >= len(tree.levels):
+        flask.abort(404)
+    node = flask.request.args.get('node', type=int)
+    body, etag = snap.level_page(depth, node)
+    if flask.request.if_none_match.contains(etag):
+        response = flask.Response(status=304)
+    else:
+        response = flask.Response(body, mimetype='text/html')
+    # Node numbers change when the data reloads, so always revalidate
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route('/cascade/')
+def cascade():
+    """
+    Page with one dropdown per level of the hierarchy; the first level is
+    filled in, the others load as choices are made.
+    """
+    tree = snapshot.hierarchy
+    selects = [level_select(tree, 0, tree.options(0))]
+    selects += [level_select(tree, depth)
+                for depth in range(1, len(tree.levels))]
+    return flask.render_template('cascade.html', levels=tree.levels,
+                                 selects=[Markup(s) for s in selects])
 
 
 @app.route('/')
@@ -65,16 +429,29 @@ def index():
     """
     Main page that displays the cascading dropdown interface.
 
-    Returns: HTML page with make dropdown populated and initial models shown
+    Returns: HTML page with the first makes in the make dropdown (the
+    filter box loads others) and initial models shown
     """
-    # Get sorted list of all available makes
-    makers = sorted(mmdb.keys())
+    snap = snapshot
+    makers, options = make_options(snap, '')
 
     # Get models for the first make (default selection)
-    initial_models = mmdb[makers[0]] if makers else []
+    initial_models = snap.mmdb[makers[0]] if makers else []
 
     return flask.render_template('index.html', models=initial_models,
-                                 makers=makers)
+                                 make_options=Markup(options))
+
+
+@app.cli.command('compile-cars')
+@click.argument('csvfile', type=click.File(encoding='utf-8'),
+                default='car.csv')
+@click.option('--db', default='car.db', show_default=True,
+              help='Compiled database to write (set VALUESELECT_DB to it).')
+def compile_cars(csvfile, db):
+    """Compile the make,model rows of CSVFILE into a mappable database."""
+    makes, models = compile_csv(csvfile, db)
+    click.echo('Compiled {} makes with {} models into {}'.format(
+        makes, models, db))
 
 
 if __name__ == '__main__':
@@ -10,9 +10,33 @@ Tests the cascading dropdown functionality with HTMX patterns:
 
 import unittest
 import tempfile
+import io
 import os
 import shutil
-from myapp import app, mmdb, load_car_data
+import sys
+import threading
+import getdata
+import myapp
+from cardb import CarDB, MakeIndex, compile_csv
+from hierarchy import Hierarchy
+from myapp import (app, load_car_data, reload_car_data, read_car_csv,
+                   render_fragment)
+
+# Saved-page fixture for getdata.py: rows come from the first table only
+SUV_PAGE = """<html><body><p>List of SUVs</p>
+<table class="wikitable">
+<tr><th>Make</th><th>Model</th></tr>
+<tr><td><a href="/wiki/Acura">Acura</a></td>
+    <td><a href="/wiki/MDX">MDX</a> (2001&ndash;)</td><td>Japan</td></tr>
+<tr><td>
+  Alfa Romeo <sup>[1]</sup></td><td><i>Stelvio</i></td></tr>
+<tr><td>Footnote without a model</td></tr>
+<tr><td>Ben &amp; Sons</td>
+    <td><a href="#"> </a><a href="#">O'Neil</a></td></tr>
+</table>
+<table><tr><td>Not</td><td>Extracted</td></tr></table>
+</body></html>
+"""
 
 
 class TestValueSelect(unittest.TestCase):
@@ -42,7 +66,6 @@ class TestValueSelect(unittest.TestCase):
         shutil.copy(self.temp_csv.name, self.original_csv_path)
 
         # Reload data with test CSV
-        mmdb.clear()
         load_car_data()
 
     def tearDown(self):
@@ -115,6 +138,342 @@ class TestValueSelect(unittest.TestCase):
         # Should return "No models available"
         self.assertIn('No models available', html)
 
+    def write_csv(self, rows):
+        """Replace car.csv with rows, the way an editor saves a file."""
+        with open('car.csv.new', 'w') as csvfile:
+            csvfile.writelines("'{}','{}'\n".format(*row) for row in rows)
+        os.replace('car.csv.new', 'car.csv')
+
+    def test_models_prerendered_with_etag(self):
+        """Test that /models/ serves cached bytes and honors ETags."""
+        model_pages = myapp.snapshot.pages
+        self.assertEqual(set(model_pages), {'Toyota', 'Honda', 'Ford'})
+        body, etag = model_pages['Honda']
+        self.assertEqual(body, render_fragment(
+            'model_options', models=['CR-V', 'Pilot']).encode('utf-8'))
+
+        response = self.app.get('/models/?makeselected=Honda')
+        self.assertEqual(response.data, body)
+        self.assertEqual(response.headers['ETag'], '"{}"'.format(etag))
+        self.assertTrue(response.cache_control.public)
+        self.assertEqual(response.cache_control.max_age, 3600)
+
+        response = self.app.get('/models/?makeselected=Honda',
+                                headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        response = self.app.get('/models/?makeselected=Ford',
+                                headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+        # Reloaded data must not be cached past the next reload
+        interval = myapp.app.config['RELOAD_INTERVAL']
+        myapp.app.config['RELOAD_INTERVAL'] = 30.5
+        try:
+            response = self.app.get('/models/?makeselected=Honda')
+            self.assertEqual(response.cache_control.max_age, 30)
+        finally:
+            myapp.app.config['RELOAD_INTERVAL'] = interval
+
+    def test_compiled_database(self):
+        """Test the mapped database against the dict read from car.csv."""
+        db = os.path.join(tempfile.mkdtemp(), 'car.db')
+        with open('car.csv', newline='') as csvfile:
+            self.assertEqual(compile_csv(csvfile, db), (3, 6))
+        with CarDB(db) as cars:
+            self.assertEqual(list(cars), ['Ford', 'Honda', 'Toyota'])
+            self.assertEqual(dict(cars), myapp.snapshot.mmdb)
+            self.assertNotIn('Tesla', cars)
+            self.assertEqual([bytes(m) for m in cars.models('Toyota')],
+                             [b'RAV4', b'Highlander'])
+            with self.assertRaises(KeyError):
+                cars.models('Tesla')
+
+        app.config['CAR_DB'] = db
+        try:
+            load_car_data()
+            self.assertIsInstance(myapp.snapshot.mmdb, CarDB)
+            model_pages = myapp.snapshot.pages
+            self.assertEqual(model_pages, {})
+            response = self.app.get('/models/?makeselected=Honda')
+            self.assertIn(b'Pilot', response.data)
+            self.assertEqual(list(model_pages), ['Honda'])
+            response = self.app.get('/models/?makeselected=Tesla')
+            self.assertIn(b'No models available', response.data)
+            self.assertIn(b'Toyota', self.app.get('/').data)
+        finally:
+            app.config['CAR_DB'] = None
+            myapp.snapshot.mmdb.close()
+            load_car_data()
+            shutil.rmtree(os.path.dirname(db))
+
+    def test_reload_swaps_snapshot(self):
+        """Test that a changed car.csv is swapped in as a new snapshot."""
+        old = myapp.snapshot
+        self.assertFalse(reload_car_data())
+        self.assertIs(myapp.snapshot, old)
+
+        self.write_csv([('Toyota', 'Corolla'), ('Tesla', 'Model Y')])
+        self.assertTrue(reload_car_data())
+        self.assertFalse(reload_car_data())
+        new = myapp.snapshot
+        self.assertEqual(new.mmdb, {'Toyota': ['Corolla'],
+                                    'Tesla': ['Model Y']})
+        self.assertEqual(set(new.pages), {'Toyota', 'Tesla'})
+        self.assertNotEqual(new.pages['Toyota'][1], old.pages['Toyota'][1])
+        # A request that already holds the old snapshot still sees it whole
+        self.assertEqual(old.mmdb['Toyota'], ['RAV4', 'Highlander'])
+        self.assertIn(b'RAV4', old.model_page('Toyota')[0])
+
+        response = self.app.get('/models/?makeselected=Toyota')
+        self.assertIn(b'Corolla', response.data)
+        self.assertNotIn(b'RAV4', response.data)
+
+        # A deleted or unparsable file keeps the current snapshot
+        os.remove('car.csv')
+        self.assertFalse(reload_car_data())
+        with open('car.csv', 'w') as csvfile:
+            csvfile.write("'Toyota'\n")
+        with self.assertRaises(ValueError):
+            reload_car_data()
+        self.assertIs(myapp.snapshot, new)
+
+        # Repeated models are served once, from a cascade built on reload
+        self.write_csv([('Ford', 'Edge'), ('Ford', 'Escape'),
+                        ('Ford', 'Edge')])
+        self.assertTrue(reload_car_data())
+        self.assertIn('hierarchy', vars(myapp.snapshot))
+        response = self.app.get('/level/1/?node=0')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.count(b'Edge'), 1)
+
+    def test_reload_never_half_built(self):
+        """Test that concurrent readers only ever see complete snapshots."""
+        makes = ['Make{}'.format(i) for i in range(50)]
+        errors = []
+        done = threading.Event()
+
+        def check(snap):
+            # Every model of a generation is named "<generation>-<n>",
+            # and every make has 5 of them
+            generations = {model.split('-')[0]
+                           for models in snap.mmdb.values()
+                           for model in models}
+            complete = [sorted(snap.mmdb) == sorted(makes),
+                        set(snap.pages) == set(snap.mmdb),
+                        len(generations) == 1]
+            for make, models in snap.mmdb.items():
+                body = snap.model_page(make)[0].decode('utf-8')
+                complete.append(len(models) == 5)
+                complete.extend('value="{}"'.format(model) in body
+                                for model in models)
+            if not all(complete):
+                errors.append(snap)
+
+        def read():
+            client = app.test_client()
+            while not done.is_set():
+                check(myapp.snapshot)
+                html = client.get('/models/?makeselected=Make7').data
+                if html.count(b'<option') != 6:
+                    errors.append(html)
+
+        self.write_csv([(make, '0-{}'.format(i))
+                        for make in makes for i in range(5)])
+        load_car_data()
+        readers = [threading.Thread(target=read) for _ in range(2)]
+        for reader in readers:
+            reader.start()
+        try:
+            for generation in range(1, 30):
+                self.write_csv([(make, '{}-{}'.format(generation, i))
+                                for make in makes for i in range(5)])
+                reload_car_data()
+        finally:
+            done.set()
+            for reader in readers:
+                reader.join()
+        self.assertEqual(errors, [])
+        self.assertIn('29-0', myapp.snapshot.mmdb['Make0'])
+
+    def test_make_index_prefix_search(self):
+        """Test prefix lookups in the casefolded make index."""
+        index = MakeIndex(['bmw', 'Audi', 'BMW Alpina', 'Aston Martin',
+                           'Buick', 'Straße'])
+        self.assertEqual(index.search('', 2), (['Aston Martin', 'Audi'], 6))
+        self.assertEqual(index.search('b', 10),
+                         (['bmw', 'BMW Alpina', 'Buick'], 3))
+        self.assertEqual(index.search('BMW ', 10), (['BMW Alpina'], 1))
+        self.assertEqual(index.search('STRASS', 10), (['Straße'], 1))
+        self.assertEqual(index.search('Z', 10), ([], 0))
+
+    def test_makes_type_ahead(self):
+        """Test the /makes/ type-ahead endpoint and its result limit."""
+        response = self.app.get('/makes/?q=h')
+        self.assertEqual(response.status_code, 200)
+        html = response.data.decode('utf-8')
+        self.assertIn('<option value="Honda">Honda</option>', html)
+        self.assertNotIn('Toyota', html)
+        self.assertNotIn('more', html)
+
+        self.write_csv([('Make{:03d}'.format(i), 'Model')
+                        for i in range(120)])
+        load_car_data()
+        app.config['MAKES_LIMIT'] = 10
+        try:
+            html = self.app.get('/makes/?q=make0').data.decode('utf-8')
+            self.assertEqual(html.count('value="Make0'), 10)
+            self.assertIn('Make009', html)
+            self.assertIn('90 more', html)
+            html = self.app.get('/').data.decode('utf-8')
+            self.assertIn('Make009', html)
+            self.assertNotIn('Make010', html)
+            self.assertIn('110 more', html)
+        finally:
+            app.config['MAKES_LIMIT'] = 50
+
+    def test_hierarchy_from_grouped_rows(self):
+        """Test the integer-coded tree built from grouped rows."""
+        tree = Hierarchy.from_rows(('make', 'model', 'year'), [
+            ('Ford', 'Escape', '2023'), ('Ford', 'Escape', '2024'),
+            ('Ford', 'Escape', '2024'), ('Ford', 'Edge', '2024'),
+            (), ('Honda', 'Pilot', '2024')])
+        self.assertEqual(len(tree), 4)
+        self.assertEqual([tree.size(d) for d in range(3)], [2, 3, 4])
+        self.assertEqual(tree.options(0), [(0, 'Ford'), (1, 'Honda')])
+        self.assertEqual(tree.options(1, 0), [(0, 'Escape'), (1, 'Edge')])
+        self.assertEqual(tree.options(2, 0), [(0, '2023'), (1, '2024')])
+        self.assertEqual(tree.options(2, 2), [(3, '2024')])
+        # Every distinct label is stored once
+        self.assertEqual(len(tree.names), 7)
+        for node in (None, -1, 2):
+            with self.assertRaises(IndexError):
+                tree.children(1, node)
+
+        with self.assertRaisesRegex(ValueError, 'Ford > Escape'):
+            Hierarchy.from_rows(('make', 'model'), [
+                ('Ford', 'Escape'), ('Ford', 'Edge'), ('Ford', 'Escape')])
+        with self.assertRaisesRegex(ValueError, 'row 2'):
+            Hierarchy.from_rows(('make', 'model'), [
+                ('Ford', 'Escape'), ('Ford',)])
+        # A make may list a model twice; it is one option
+        tree = Hierarchy.from_mapping(('make', 'model'), {
+            'Ford': ['Edge', 'Escape', 'Edge'], 'Honda': ['Pilot']})
+        self.assertEqual(tree.options(1, 0), [(0, 'Edge'), (1, 'Escape')])
+
+    def test_level_cascade(self):
+        """Test /level/ options, out-of-band clears and caching."""
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, 'trims.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write('make,model,trim,year\n'
+                          'Ford,Escape,Active,2023\n'
+                          'Ford,Escape,Active,2024\n'
+                          'Ford,Explorer,XLT,2024\n'
+                          'Honda,Pilot,EX-L,2024\n')
+        app.config['HIERARCHY_CSV'] = path
+        app.config['LEVEL_CACHE_SIZE'] = 2
+        try:
+            load_car_data()
+            html = self.app.get('/cascade/').data.decode('utf-8')
+            for depth in range(4):
+                self.assertIn('id="level-{}"'.format(depth), html)
+            self.assertIn('<option value="1">Honda</option>', html)
+            self.assertIn('hx-get="/level/3/"', html)
+            self.assertNotIn('hx-get="/level/4/"', html)
+
+            response = self.app.get('/level/1/?node=0')
+            html = response.data.decode('utf-8')
+            self.assertIn('<option value="0">Escape</option>', html)
+            self.assertIn('<option value="1">Explorer</option>', html)
+            self.assertNotIn('Pilot', html)
+            # Trim and year are emptied out of band
+            self.assertEqual(html.count('hx-swap-oob="true"'), 2)
+            self.assertIn('Select a year...', html)
+            self.assertTrue(response.cache_control.no_cache)
+            etag = response.headers['ETag'].strip('"')
+            response = self.app.get('/level/1/?node=0',
+                                    headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+
+            html = self.app.get('/level/3/?node=0').data.decode('utf-8')
+            self.assertIn('2023', html)
+            self.assertNotIn('hx-swap-oob', html)
+            html = self.app.get('/level/2/?node=7').data.decode('utf-8')
+            self.assertNotIn('<option value="0"', html)
+            self.assertIn('Select a trim...', html)
+            self.assertEqual(self.app.get('/level/4/').status_code, 404)
+            self.assertEqual(list(myapp.snapshot.level_pages),
+                             [(3, 0), (2, 7)])
+        finally:
+            app.config['HIERARCHY_CSV'] = None
+            app.config['LEVEL_CACHE_SIZE'] = 10000
+            shutil.rmtree(tmp)
+
+    def test_level_cascade_defaults_to_make_and_model(self):
+        """Test that without a hierarchy CSV the cascade uses mmdb."""
+        tree = myapp.snapshot.hierarchy
+        self.assertEqual(tree.levels, ('make', 'model'))
+        self.assertEqual(len(tree), 6)
+        html = self.app.get('/level/1/?node=1').data.decode('utf-8')
+        self.assertIn('CR-V', html)
+        self.assertIn('Pilot', html)
+
+    def test_getdata_streams_first_table(self):
+        """Test extracting rows from a saved page, in small chunks."""
+        expected = [('Acura', 'MDX'), ('Alfa Romeo', 'Stelvio'),
+                    ('Ben & Sons', "O'Neil")]
+        original_chunk = getdata.CHUNK
+        try:
+            for chunk in (7, 64, getdata.CHUNK):
+                getdata.CHUNK = chunk
+                self.assertEqual(
+                    list(getdata.extract_rows(io.StringIO(SUV_PAGE))),
+                    expected)
+        finally:
+            getdata.CHUNK = original_chunk
+
+    def test_getdata_writes_car_csv(self):
+        """Test that pages parsed in worker processes make a car.csv."""
+        tmp = tempfile.mkdtemp()
+        try:
+            pages = []
+            for i in range(3):
+                pages.append(os.path.join(tmp, 'page{}.html'.format(i)))
+                with open(pages[-1], 'w') as page:
+                    page.write(SUV_PAGE.replace('Acura', 'Acura{}'.format(i)))
+            out = os.path.join(tmp, 'car.csv')
+            rows = getdata.source_rows(pages, jobs=2)
+            self.assertEqual(getdata.write_csv(rows, out), 9)
+            cars = read_car_csv(out)
+            self.assertEqual(list(cars), ['Acura0', 'Alfa Romeo',
+                                          'Ben & Sons', 'Acura1', 'Acura2'])
+            self.assertEqual(cars['Ben & Sons'], ["O'Neil"] * 3)
+            self.assertEqual(os.listdir(tmp).count('car.csv.tmp'), 0)
+
+            # A page without a table leaves the existing car.csv alone
+            empty = os.path.join(tmp, 'empty.html')
+            with open(empty, 'w') as page:
+                page.write('<html><body><p>No table</p></body></html>')
+            rows = getdata.source_rows([empty], jobs=1)
+            self.assertEqual(getdata.write_csv(rows, out), 0)
+            self.assertEqual(list(read_car_csv(out)), list(cars))
+            self.assertNotIn('car.csv.tmp', os.listdir(tmp))
+
+            # Workers never see stdin, so - is read by this process
+            stdin = sys.stdin
+            sys.stdin = io.TextIOWrapper(io.BytesIO(
+                SUV_PAGE.replace('Acura', 'Stdin').encode('utf-8')))
+            try:
+                rows = list(getdata.source_rows(['-', pages[0]], jobs=2))
+            finally:
+                sys.stdin = stdin
+            self.assertEqual([make for make, _ in rows],
+                             ['Stdin', 'Alfa Romeo', 'Ben & Sons',
+                              'Acura0', 'Alfa Romeo', 'Ben & Sons'])
+        finally:
+            shutil.rmtree(tmp)
+
     def test_html_structure_validation(self):
         """Test that HTML structure matches expected patterns."""
         response = self.app.get('/models/?makeselected=Toyota')
@@ -127,6 +486,8 @@ class TestValueSelect(unittest.TestCase):
 
     def test_data_loading(self):
         """Test that car data is loaded correctly."""
+        mmdb = myapp.snapshot.mmdb
+
         # Check that makes are loaded
         self.assertIn('Toyota', mmdb)
         self.assertIn('Honda', mmdb)
@@ -157,6 +518,19 @@ class TestValueSelect(unittest.TestCase):
         self.assertIn('Escape', html)
         self.assertIn('Explorer', html)
 
+    def test_option_fragments(self):
+        """Test the option lists and the out-of-band level select."""
+        html = render_fragment('model_options', models=['A&B'])
+        self.assertIn('<option value="A&amp;B">A&amp;B</option>', html)
+        html = render_fragment('make_options', makes=['Ford'], more=7)
+        self.assertIn('<option value="" disabled>7 more, keep typing', html)
+        self.assertNotIn('disabled', render_fragment('make_options',
+                                                     makes=['Ford'], more=0))
+        html = render_fragment('level_select', depth=1, level='model',
+                               last=True, oob=True, options='')
+        self.assertIn('hx-swap-oob="true"', html)
+        self.assertNotIn('hx-get', html)
+
     def test_css_class_names(self):
         """Test that proper CSS class names are used."""
         response = self.app.get('/')